@@ -0,0 +1,154 @@
+## Concurrency stress check of the request path against in-process fakes (benchmarks/fakes.py)
+##   python benchmarks/concurrency_stress.py --requests 5000 --concurrency 500
+## Thousands of requests for distinct users and countries run interleaved on one event loop and the ranking threads.
+## Every intermediate result is checked against the seeded data, exits with status 1 on any cross talk between requests
+
+import warnings
+warnings.filterwarnings("ignore")
+import sys
+import asyncio
+import argparse
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import fakes
+fakes.setup_service_env()
+
+import numpy as np
+from logzero import loglevel
+
+import internal_reco_api as api
+from retrieval.src.get_feat_from_fs import KEY_PREFIX
+
+
+class Checker:
+    def __init__(self, dataset, asset_columns, user_columns) -> None:
+        """
+        ** Description: ** <em> Expected values of every request, derived from the seeded data </em>
+        """
+        self.country_of = {asset["lomotif_id"]: asset["production_country"] for asset in dataset["assets"]
+                           if asset["moderation_status"] == "ACCEPT"}
+        self.asset_values = {lomotif_id: np.array([float(features[column]) for column in asset_columns],
+                                                  dtype=np.float32)
+                             for lomotif_id, features in ((key.split(":", 1)[1], features)
+                                                          for key, features in dataset["asset_features"].items())}
+        self.users = dataset["users"]
+        self.user_features = dataset["user_features"]
+        self.user_columns = user_columns
+        self.errors = []
+
+    def fail(self, user_id, message):
+        self.errors.append(f"user {user_id}: {message}")
+
+    def check_candidates(self, user_id, user_country, candidates):
+        if not isinstance(candidates, list) or not candidates:
+            return self.fail(user_id, f"no candidates: {candidates!r}")
+        foreign = [c for c in candidates if self.country_of.get(c) != user_country]
+        if foreign:
+            self.fail(user_id, f"{len(foreign)} candidates outside {user_country}")
+        blacklisted = set(candidates) & set(self.users.get(user_id, {}).get("user_blacklist", []))
+        if blacklisted:
+            self.fail(user_id, f"{len(blacklisted)} blacklisted candidates")
+
+    def check_user_features(self, user_id, user_data):
+        expected = self.user_features.get(f"{KEY_PREFIX}_user:{user_id}", {})
+        if user_data != expected:
+            self.fail(user_id, f"user features {user_data} instead of {expected}")
+
+    def check_asset_features(self, user_id, candidates, values):
+        expected = np.stack([self.asset_values[c] for c in candidates])
+        if values is None or not np.array_equal(values, expected):
+            self.fail(user_id, "asset features do not belong to the candidates")
+
+
+async def run_request(checker, user_id, user_country, k):
+    """
+    ** Description: ** <em> It runs the pipeline of `recommend_for_user` step by step and checks every intermediate
+    result, then the endpoint itself </em>
+    """
+    candidates, user_data = await asyncio.gather(
+        api.candidate_retrieval.es_retrieve_candidates(user_country, user_id),
+        api.get_feature_from_fs.get_user_features_from_fs(user_id),
+    )
+    checker.check_candidates(user_id, user_country, candidates)
+    checker.check_user_features(user_id, user_data)
+    if checker.errors:
+        return
+    asset_values = await api.get_feature_from_fs.get_asset_features_from_fs(candidate_list=candidates)
+    checker.check_asset_features(user_id, candidates, asset_values)
+    batch = api.get_feature_from_fs.build_feature_batch(candidates, asset_values, user_data)
+    if api.prediction_batcher is not None:
+        scores = await api.prediction_batcher.predict(batch)
+        expected = api.reco.select_model(batch.columns).inplace_predict(batch.features)
+        if not np.array_equal(scores, expected):
+            checker.fail(user_id, "batched scores differ from a direct predict of its own input")
+    recommendations = await api.recommend_for_user({"user_id": user_id, "user_country": user_country, "k": k})
+    checker.check_candidates(user_id, user_country, recommendations)
+
+
+async def run_ranking_threads(checker, batches, workers):
+    """
+    ** Description: ** <em> It ranks the same inputs sequentially and from many threads at once, results must match </em>
+    """
+    expected = [api.reco.generate_recommendations(batch, 10) for batch in batches]
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = await asyncio.gather(*[loop.run_in_executor(executor, api.reco.generate_recommendations, batch, 10)
+                                         for batch in batches])
+    for i, (result, reference) in enumerate(zip(results, expected)):
+        if result != reference:
+            checker.fail(f"#{i}", "threaded ranking differs from sequential ranking")
+
+
+async def main(args):
+    dataset = fakes.seed_dataset(countries=args.countries, assets_per_country=args.assets_per_country,
+                                 n_users=args.users, seed=args.seed)
+    latency = fakes.FakeLatency(args.latency_ms, args.latency_ms)
+    fakes.install_fakes(api, dataset, es_latency=latency, redis_latency=latency)
+    if not await fakes.start_service(api):
+        return 1
+    checker = Checker(dataset, api.config["asset_features"], api.config["user_features"])
+    users = list(dataset["users"].values())
+    rng = random.Random(args.seed)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user):
+        async with semaphore:
+            await run_request(checker, user["user_id"], user["user_country"], rng.randint(1, 20))
+
+    await asyncio.gather(*[limited(users[i % len(users)]) for i in range(args.requests)])
+
+    batches = []
+    for user in users[:200]:
+        candidates = await api.candidate_retrieval.es_retrieve_candidates(user["user_country"], user["user_id"])
+        user_data = await api.get_feature_from_fs.get_user_features_from_fs(user["user_id"])
+        asset_values = await api.get_feature_from_fs.get_asset_features_from_fs(candidate_list=candidates)
+        batches.append(api.get_feature_from_fs.build_feature_batch(candidates, asset_values, user_data))
+    await run_ranking_threads(checker, batches, args.threads)
+
+    await api.shutdown()
+    print(f"{args.requests} requests, {len(checker.errors)} errors")
+    if api.get_feature_from_fs.asset_cache is not None:
+        print(f"asset feature cache: {api.get_feature_from_fs.asset_cache.stats}")
+    print(f"blacklist filter: {api.candidate_retrieval.blacklist_filter.stats}")
+    if api.prediction_batcher is not None:
+        print(f"prediction batcher: {api.prediction_batcher.stats}")
+    for error in checker.errors[:20]:
+        print(error)
+    return 1 if checker.errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--countries", nargs="+", default=["US", "BR", "IN", "FR", "ID"])
+    parser.add_argument("--assets-per-country", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="mean and jitter of every fake call")
+    parser.add_argument("--threads", type=int, default=16, help="threads ranking concurrently")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    loglevel("WARNING")
+    sys.exit(asyncio.run(main(args)))
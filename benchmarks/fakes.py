@@ -0,0 +1,542 @@
+## In-process stand-ins for OpenSearch and the redis feature store used by the benchmark and stress scripts.
+## They implement only the calls and query shapes this repo sends, with optional injected latency.
+## Scripts call `setup_service_env` before importing the service and `start_service` once the fakes are installed.
+## Configured models that are not deployed are replaced by small boosters trained on synthetic data, see `install_models`.
+
+import os
+import sys
+import asyncio
+import random
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+KEY_PREFIX = "recommendations_preprocessing"
+ROOT = Path(__file__).resolve().parent.parent
+# read by the service when it is imported, every client they configure is replaced by a fake
+SERVICE_ENV = {"AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_REGION": "us-east-2",
+               "ES_HOST": "localhost", "ES_PORT": "9200", "REDIS_IP": "localhost", "REDIS_PORT": "6379",
+               "ASSET_FS_DB": "1", "USER_FS_DB": "2", "RESPONSE_CACHE_DB": "3"}
+
+
+def setup_service_env():
+    """
+    ** Description: ** <em> It makes the service importable from a script of benchmarks/. The repository root is put
+    on the import path and made the working directory, the service resolves config.yml and the models relative to it,
+    and the variables of `SERVICE_ENV` that are not set get a placeholder </em>
+    """
+    sys.path.append(str(ROOT))
+    os.chdir(ROOT)
+    for name, value in SERVICE_ENV.items():
+        os.environ.setdefault(name, value)
+
+
+def train_synthetic_model(columns, seed=0, n_rows=2000):
+    """
+    ** Description: ** <em> It trains a small binary:logistic booster on random data with the given input columns. Its
+    scores mean nothing, it stands in for a model that is not deployed so the request path can run end to end </em>
+
+    Args:
+        columns (list): feature names of the model input, in order
+        seed (int): seed of the random data
+        n_rows (int): training rows
+
+    Returns:
+        (xgb.Booster): the trained model
+    """
+    import xgboost as xgb
+    rng = np.random.default_rng(seed)
+    features = rng.normal(size=(n_rows, len(columns))).astype(np.float32)
+    labels = (features[:, 0] + rng.normal(scale=0.5, size=n_rows) > 0).astype(np.float32)
+    return xgb.train({"objective": "binary:logistic", "max_depth": 4, "nthread": 1},
+                     xgb.DMatrix(features, label=labels, feature_names=list(columns)), num_boost_round=20)
+
+
+_model_dir = None
+
+
+def install_models(api, seed=0):
+    """
+    ** Description: ** <em> It points `model_path` of the imported service at a temporary directory holding the
+    configured models. Deployed ones are linked from the model path, missing ones are replaced by a synthetic booster
+    with the same input columns, see `train_synthetic_model`. Call it before the service loads its models </em>
+
+    Args:
+        api (module): the imported `internal_reco_api` module
+        seed (int): seed of the synthetic training data
+
+    Returns:
+        (list): names of the models replaced by synthetic ones
+    """
+    from ranking.inference import resolve_model_path
+    global _model_dir
+    config = api.config
+    model_path = Path(config["model_path"]).resolve()
+    _model_dir = tempfile.TemporaryDirectory(prefix="reco_models_")
+    synthetic = []
+    for name, columns in ((config["model_name"], api.reco.prediction_columns),
+                          (config["cold_start_model_name"], api.reco.cold_start_columns)):
+        path = Path(resolve_model_path(str(model_path / name)))
+        if path.exists():
+            os.symlink(path, Path(_model_dir.name) / path.name)
+        else:
+            train_synthetic_model(columns, seed=seed).save_model(str(Path(_model_dir.name) / name))
+            synthetic.append(name)
+    config["model_path"] = _model_dir.name + "/"
+    return synthetic
+
+
+async def start_service(api):
+    """
+    ** Description: ** <em> It starts the imported service with the configured models, synthetic ones standing in for
+    those that are not deployed (see `install_models`), and waits for its warm up. When it does not get ready with
+    both models loaded, it prints why and shuts the service down </em>
+
+    Args:
+        api (module): the imported `internal_reco_api` module, with the fakes installed
+
+    Returns:
+        (bool): whether the service is ready
+    """
+    synthetic = install_models(api)
+    if synthetic:
+        print(f"{', '.join(synthetic)} not deployed, scoring with synthetic models in their place")
+    await api.startup()
+    await api.warmup_task
+    if api.service_ready and api.reco.model is not None and api.reco.cold_start_model is not None:
+        return True
+    # requests without both models fail in ranking, which would say nothing about what the script measures
+    print(f"the service did not get ready with {api.config['model_name']} and {api.config['cold_start_model_name']}, "
+          f"see the log above")
+    await api.shutdown()
+    return False
+
+
+class FakeLatency:
+    def __init__(self, mean_ms=0.0, jitter_ms=0.0, slow_share=0.0, slow_ms=0.0) -> None:
+        """
+        ** Description: ** <em> Latency injected into every fake call, uniformly drawn from mean +/- jitter. A share of
+        the calls is slow and takes `slow_ms` on top, like a dependency with a latency tail </em>
+
+        Args:
+            mean_ms (float): mean latency of a call in milliseconds
+            jitter_ms (float): maximum deviation from the mean in milliseconds
+            slow_share (float): share of the calls that are slow
+            slow_ms (float): extra latency of a slow call in milliseconds
+        """
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+        self.slow_share = slow_share
+        self.slow_ms = slow_ms
+
+    async def wait(self):
+        delay = self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if self.slow_share and random.random() < self.slow_share:
+            delay += self.slow_ms
+        # always yield to the event loop so concurrent requests interleave like they would over the network
+        await asyncio.sleep(max(delay, 0.0) / 1000.0)
+
+
+class FakeOpenSearch:
+    def __init__(self, asset_index, user_index, assets, users, latency=None) -> None:
+        """
+        ** Description: ** <em> Minimal async OpenSearch stand-in serving the asset and user indices from memory. It
+        understands the query shapes built by `CandidateRetrieval`: country match, moderation filter, creation date
+        range, blacklist `must_not` (list or terms lookup), creation date sort, `random_score`, `_source: false`,
+        `filter_path`, `count` and `msearch` </em>
+
+        Args:
+            asset_index (str): name of the asset index
+            user_index (str): name of the user index
+            assets (list): asset documents, see `seed_dataset`
+            users (dict): user documents keyed by user_id
+            latency (FakeLatency): latency injected into every call
+        """
+        self.indices = {asset_index: {asset["lomotif_id"]: asset for asset in assets},
+                        user_index: dict(users)}
+        self.latency = latency or FakeLatency()
+        self.calls = {"search": 0, "count": 0, "msearch": 0}
+        self._field_index = {}
+
+    async def ping(self):
+        return True
+
+    async def close(self):
+        pass
+
+    async def count(self, index=None, body=None, **kwargs):
+        self.calls["count"] += 1
+        await self.latency.wait()
+        return {"count": len(self._match(index, (body or {}).get("query", {})))}
+
+    async def search(self, index=None, body=None, filter_path=None, **kwargs):
+        self.calls["search"] += 1
+        await self.latency.wait()
+        return self._search(index, body or {}, filter_path)
+
+    async def msearch(self, body=None, index=None, filter_path=None, **kwargs):
+        self.calls["msearch"] += 1
+        await self.latency.wait()
+        responses = []
+        for header, query in zip(body[::2], body[1::2]):
+            response = self._search(header.get("index", index), query, None)
+            responses.append(response)
+        return _filter_response({"responses": responses}, filter_path)
+
+    def _search(self, index, body, filter_path):
+        query = body.get("query", {})
+        docs = self._match(index, query)
+        if "function_score" in query and "random_score" in query["function_score"]:
+            random.shuffle(docs)
+        for field, order in _sort_fields(body.get("sort")):
+            docs.sort(key=lambda doc: doc.get(field, ""), reverse=order == "desc")
+        hits = []
+        for doc in docs[: body.get("size", 10)]:
+            hit = {"_id": doc.get("lomotif_id", doc.get("user_id")), "_index": index}
+            if body.get("_source", True) is not False:
+                hit["_source"] = _project_source(doc, body.get("_source"))
+            hits.append(hit)
+        response = {"hits": {"total": {"value": len(docs), "relation": "eq"}, "hits": hits}}
+        return _filter_response(response, filter_path)
+
+    def _match(self, index, query):
+        if "function_score" in query:
+            query = query["function_score"].get("query", {})
+        return [doc for doc in self._candidates(index, query) if self._matches(doc, query)]
+
+    def _candidates(self, index, query):
+        # narrows the scan with an equality clause so the fake does not dominate the measured latency
+        clauses = [query] + query.get("bool", {}).get("must", []) + query.get("bool", {}).get("filter", [])
+        for clause in clauses:
+            for kind in ("match", "match_phrase", "term"):
+                if kind in clause:
+                    (field, value), = clause[kind].items()
+                    if isinstance(value, dict):
+                        value = value.get("query", value.get("value"))
+                    return self._by_field(index, field.replace(".keyword", "")).get(value, [])
+        return list(self.indices.get(index, {}).values())
+
+    def _by_field(self, index, field):
+        key = (index, field)
+        if key not in self._field_index:
+            by_value = {}
+            for doc in self.indices.get(index, {}).values():
+                by_value.setdefault(doc.get(field), []).append(doc)
+            self._field_index[key] = by_value
+        return self._field_index[key]
+
+    def _matches(self, doc, query):
+        if not query or "match_all" in query:
+            return True
+        if "query_string" in query:
+            return True
+        if "bool" in query:
+            clauses = query["bool"]
+            return (all(self._matches(doc, clause) for clause in clauses.get("must", []))
+                    and all(self._matches(doc, clause) for clause in clauses.get("filter", []))
+                    # should clauses are only sent with minimum_should_match 1
+                    and any(self._matches(doc, clause) for clause in clauses.get("should", []) or [{}])
+                    and not any(self._matches(doc, clause) for clause in clauses.get("must_not", [])))
+        for kind in ("match", "match_phrase", "term"):
+            if kind in query:
+                (field, value), = query[kind].items()
+                if isinstance(value, dict):
+                    value = value.get("query", value.get("value"))
+                return doc.get(field.replace(".keyword", "")) == value
+        if "terms" in query:
+            (field, values), = query["terms"].items()
+            if isinstance(values, dict):
+                lookup = self.indices.get(values["index"], {}).get(values["id"], {})
+                values = lookup.get(values["path"], [])
+            field_value = doc.get(field.replace(".keyword", ""))
+            if isinstance(field_value, list):
+                return any(value in values for value in field_value)
+            return field_value in set(values)
+        if "range" in query:
+            (field, bounds), = query["range"].items()
+            value = doc.get(field)
+            for op, bound in bounds.items():
+                bound = _resolve_date(bound)
+                if (op == "gte" and not value >= bound) or (op == "gt" and not value > bound) \
+                        or (op == "lte" and not value <= bound) or (op == "lt" and not value < bound):
+                    return False
+            return True
+        raise NotImplementedError(f"query not supported by the fake: {query}")
+
+
+class FakePipeline:
+    def __init__(self, store) -> None:
+        self.store = store
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
+
+    def hgetall(self, key):
+        self.commands.append(("hgetall", key, None))
+        return self
+
+    def hset(self, key, mapping=None, **kwargs):
+        self.commands.append(("hset", key, mapping))
+        return self
+
+    def set(self, key, value, **kwargs):
+        self.commands.append(("set", key, value))
+        return self
+
+    def get(self, key):
+        self.commands.append(("get", key, None))
+        return self
+
+    def delete(self, key):
+        self.commands.append(("delete", key, None))
+        return self
+
+    async def execute(self):
+        await self.store.latency.wait()
+        self.store.round_trips += 1
+        commands, self.commands = self.commands, []
+        return [self.store._run(*command) for command in commands]
+
+
+class FakeRedis:
+    def __init__(self, data=None, latency=None, decode_responses=True) -> None:
+        """
+        ** Description: ** <em> Minimal `redis.asyncio` stand-in over a dict of hashes and strings. Pipelines, hash and
+        string commands, `mget` and `scan_iter` are supported </em>
+
+        Args:
+            data (dict): initial keys, dict values are hashes and bytes/str values are strings
+            latency (FakeLatency): latency injected into every round trip
+            decode_responses (bool): whether string values are returned as str instead of bytes
+        """
+        self.data = data if data is not None else {}
+        self.latency = latency or FakeLatency()
+        self.decode_responses = decode_responses
+        self.round_trips = 0
+
+    async def ping(self):
+        return True
+
+    async def aclose(self, *args, **kwargs):
+        pass
+
+    @property
+    def connection_pool(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def hgetall(self, key):
+        await self._round_trip()
+        return self._run("hgetall", key, None)
+
+    async def hset(self, key, mapping=None, **kwargs):
+        await self._round_trip()
+        return self._run("hset", key, mapping)
+
+    async def get(self, key):
+        await self._round_trip()
+        return self._run("get", key, None)
+
+    async def set(self, key, value, **kwargs):
+        await self._round_trip()
+        return self._run("set", key, value)
+
+    async def delete(self, key):
+        await self._round_trip()
+        return self._run("delete", key, None)
+
+    async def mget(self, keys):
+        await self._round_trip()
+        return [self._decode(self.data.get(key)) if not isinstance(self.data.get(key), dict) else None
+                for key in keys]
+
+    async def scan_iter(self, match=None, count=None):
+        prefix = (match or "*").rstrip("*")
+        for key in list(self.data):
+            if key.startswith(prefix):
+                yield key
+
+    async def _round_trip(self):
+        await self.latency.wait()
+        self.round_trips += 1
+
+    def _run(self, command, key, value):
+        if command == "hgetall":
+            return dict(self.data.get(key, {}))
+        if command == "hset":
+            self.data.setdefault(key, {}).update({field: str(v) for field, v in value.items()})
+            return len(value)
+        if command == "get":
+            return self._decode(self.data.get(key))
+        if command == "set":
+            self.data[key] = value
+            return True
+        if command == "delete":
+            return int(self.data.pop(key, None) is not None)
+        raise NotImplementedError(command)
+
+    def _decode(self, value):
+        if value is None:
+            return None
+        if self.decode_responses and isinstance(value, bytes):
+            return value.decode()
+        if not self.decode_responses and isinstance(value, str):
+            return value.encode()
+        return value
+
+
+def seed_dataset(countries=("US", "BR", "IN", "FR", "ID"), assets_per_country=2000, n_users=5000, blacklist_size=20,
+                 seed=0):
+    """
+    ** Description: ** <em> It builds synthetic ES documents and feature store hashes following the schemas in the
+    README: asset documents (lomotif_id, creation_date, production_country, moderation_status, primary_category,
+    secondary_category), user documents (user_id, user_country, user_blacklist, preferred_categories) and the asset /
+    user feature hashes </em>
+
+    Args:
+        countries (tuple): ISO 2 country codes
+        assets_per_country (int): number of assets per country
+        n_users (int): number of users, spread over the countries
+        blacklist_size (int): number of blacklisted assets per user
+        seed (int): random seed
+
+    Returns:
+        (dict): assets (list), users (dict), asset_features (dict) and user_features (dict) keyed by redis key
+    """
+    rng = np.random.default_rng(seed)
+    categories = ["dance", "comedy", "music", "sports", "food", "travel", "pets", "beauty"]
+    now = datetime.utcnow()
+    assets, asset_features, by_country = [], {}, {}
+    for country in countries:
+        for _ in range(assets_per_country):
+            lomotif_id = str(uuid.UUID(bytes=rng.bytes(16), version=4))
+            assets.append({
+                "lomotif_id": lomotif_id,
+                "creation_date": (now - timedelta(minutes=int(rng.integers(0, 60 * 24 * 60)))).isoformat(),
+                "production_country": country,
+                "moderation_status": "ACCEPT" if rng.random() < 0.9 else "REJECT",
+                "primary_category": categories[int(rng.integers(len(categories)))],
+                "secondary_category": categories[int(rng.integers(len(categories)))],
+            })
+            by_country.setdefault(country, []).append(lomotif_id)
+            asset_features[f"{KEY_PREFIX}_asset:{lomotif_id}"] = {
+                "prob_pc_1_watch": f"{rng.random():.9f}",
+                "prob_asset_watch": f"{rng.random():.9f}",
+                "lomotif_vv": str(int(rng.integers(0, 5000))),
+            }
+    users, user_features = {}, {}
+    # separate stream, the ids, blacklists and features stay those of earlier versions of the fakes
+    category_rng = np.random.default_rng(seed + 1)
+    for i in range(n_users):
+        user_id = str(10000000 + i)
+        country = countries[i % len(countries)]
+        pool = by_country[country]
+        users[user_id] = {
+            "user_id": user_id,
+            "user_country": country,
+            "user_blacklist": [pool[j] for j in rng.choice(len(pool), size=blacklist_size, replace=False)],
+            "preferred_categories": [categories[j] for j in category_rng.choice(len(categories), size=2, replace=False)],
+        }
+        user_features[f"{KEY_PREFIX}_user:{user_id}"] = {
+            "prob_user_watch": f"{rng.random():.9f}",
+            "user_vv": str(int(rng.integers(0, 500))),
+        }
+    return {"assets": assets, "users": users, "asset_features": asset_features, "user_features": user_features}
+
+
+def _sort_fields(sort):
+    if not sort:
+        return []
+    if isinstance(sort, dict):
+        sort = [sort]
+    fields = []
+    for item in sort:
+        if isinstance(item, str):
+            fields.append((item, "asc"))
+        else:
+            for field, spec in item.items():
+                fields.append((field, spec.get("order", "asc") if isinstance(spec, dict) else spec))
+    return fields
+
+
+def _project_source(doc, source):
+    if isinstance(source, dict):
+        include = source.get("includes", source.get("include"))
+        if include:
+            return {field: doc[field] for field in include if field in doc}
+    return dict(doc)
+
+
+def _resolve_date(bound):
+    if isinstance(bound, str) and bound.startswith("now"):
+        expression = bound.split("/")[0][3:]
+        if not expression:
+            return datetime.utcnow().isoformat()
+        unit = {"d": "days", "h": "hours", "m": "minutes"}[expression[-1]]
+        return (datetime.utcnow() + timedelta(**{unit: int(expression[:-1])})).isoformat()
+    return bound
+
+
+def _filter_response(response, filter_path):
+    if not filter_path:
+        return response
+    paths = [path.split(".") for path in filter_path.split(",")]
+    return _keep(response, paths) or {}
+
+
+def _keep(node, paths):
+    if any(len(path) == 0 for path in paths):
+        return node
+    if isinstance(node, list):
+        kept = [_keep(item, paths) for item in node]
+        kept = [item for item in kept if item not in (None, {}, [])]
+        return kept or None
+    if not isinstance(node, dict):
+        return None
+    out = {}
+    for key, value in node.items():
+        sub = [path[1:] for path in paths if path[0] in (key, "*")]
+        if sub:
+            kept = _keep(value, sub)
+            if kept not in (None, {}, []):
+                out[key] = kept
+    return out or None
+
+
+def install_fakes(api, dataset, es_latency=None, redis_latency=None):
+    """
+    ** Description: ** <em> It swaps the ES and feature store clients of an imported `internal_reco_api` for fakes
+    serving `dataset` </em>
+
+    Args:
+        api (module): the imported `internal_reco_api` module
+        dataset (dict): output of `seed_dataset`
+        es_latency (FakeLatency): latency of every ES call
+        redis_latency (FakeLatency): latency of every feature store round trip
+
+    Returns:
+        (tuple): the fake ES client and the fake asset and user feature stores, the raw clients that read vectors
+        share their data
+    """
+    es = FakeOpenSearch(api.config["ES_INDEX_NAME"], api.config["ES_USER_INDEX_NAME"], dataset["assets"],
+                        dataset["users"], latency=es_latency)
+    asset_fs = FakeRedis(dict(dataset["asset_features"]), latency=redis_latency)
+    user_fs = FakeRedis(dict(dataset["user_features"]), latency=redis_latency)
+    api.candidate_retrieval.es = es
+    api.get_feature_from_fs.asset_fs = asset_fs
+    api.get_feature_from_fs.user_fs = user_fs
+    api.get_feature_from_fs.asset_fs_raw = FakeRedis(asset_fs.data, latency=redis_latency, decode_responses=False)
+    api.get_feature_from_fs.user_fs_raw = FakeRedis(user_fs.data, latency=redis_latency, decode_responses=False)
+    return es, asset_fs, user_fs
@@ -0,0 +1,105 @@
+## Quality / latency benchmark of pre-ranking (ranking/src/pre_ranker.py) against in-process fakes (benchmarks/fakes.py)
+##   python benchmarks/pre_ranking_benchmark.py --users 500 --top-n 100 200
+##   python benchmarks/pre_ranking_benchmark.py --reference-user    # full model pre-scores for the average seeded user
+## For every sampled user the full model scores the whole blacklist filtered pool of its country, the top k of that is
+## the reference. Candidates picked at random and candidates picked by pre-score are then ranked like a request does,
+## the recall of the reference top k and the full model latency are reported per mode. How well cold start pre-scores
+## do depends on how close the cold start model is to the full model, compare both on the models being served
+
+import warnings
+warnings.filterwarnings("ignore")
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+import fakes
+fakes.setup_service_env()
+
+import numpy as np
+from logzero import loglevel
+
+import internal_reco_api as api
+
+
+async def rank(candidates, user_data, k):
+    """
+    ** Description: ** <em> It ranks candidates with the full model like a request does </em>
+
+    Returns:
+        (tuple): top k lomotif ids, full model score per ranked id and the seconds spent predicting
+    """
+    values = await api.get_feature_from_fs.get_asset_features_from_fs(candidate_list=candidates)
+    batch = api.get_feature_from_fs.build_feature_batch(candidates, values, user_data)
+    start_time = time.perf_counter()
+    scores = api.reco.predict(batch)
+    seconds = time.perf_counter() - start_time
+    return api.reco.top_k(batch.ids, scores, k), dict(zip(batch.ids, scores.tolist())), seconds
+
+
+async def main(args):
+    loglevel(40)
+    dataset = fakes.seed_dataset(countries=args.countries, assets_per_country=args.assets_per_country,
+                                 n_users=args.users, seed=args.seed)
+    fakes.install_fakes(api, dataset)
+    if args.reference_user:
+        api.pre_ranker.reference_user = {column: float(np.mean([float(features[column]) for features
+                                                                in dataset["user_features"].values()]))
+                                         for column in api.get_feature_from_fs.user_columns}
+    if not await fakes.start_service(api):
+        return 1
+    retrieval = api.candidate_retrieval
+    if api.pre_ranker is None:
+        print("pre_ranking is disabled in config.yml")
+        return 1
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    users = rng.sample(list(dataset["users"].values()), min(args.users, len(dataset["users"])))
+    modes = [("random", None, retrieval.pre_ranking["top_n"])] + [("pre-ranked", True, n) for n in args.top_n]
+    results = {mode: {"recall": [], "score": [], "seconds": [], "rows": []} for mode in ["full pool"] + modes}
+    for user in users:
+        pool = await retrieval.get_candidate_pool(user["user_country"])
+        blacklist = await retrieval.blacklist_filter.get(user["user_id"])
+        user_data = await api.get_feature_from_fs.get_user_features_from_fs(user["user_id"])
+        allowed = [pool.assets[i] for i in np.flatnonzero(retrieval.blacklist_filter.allowed(blacklist, pool.hashes))] \
+            if len(blacklist) > 0 else pool.assets
+        reference, full_scores, seconds = await rank(allowed, user_data, args.k)
+        modes_results = [("full pool", reference, seconds, len(allowed))]
+        for mode in modes:
+            _, pre_ranked, top_n = mode
+            retrieval.pre_ranking["top_n"] = top_n
+            candidates = retrieval.merge_sources(pool if pre_ranked else pool._replace(scores=None), blacklist, {})
+            recs, _, seconds = await rank(candidates, user_data, args.k)
+            modes_results.append((mode, recs, seconds, len(candidates)))
+        for mode, recs, seconds, rows in modes_results:
+            results[mode]["recall"].append(len(set(recs) & set(reference)) / max(len(reference), 1))
+            results[mode]["score"].append(np.mean([full_scores[asset] for asset in recs]) if recs else np.nan)
+            results[mode]["seconds"].append(seconds)
+            results[mode]["rows"].append(rows)
+    await api.shutdown()
+
+    scorer = "full model for the average user" if args.reference_user else "cold start model"
+    print(f"pre-scores of the {scorer}, {len(users)} users, recall of the full pool top {args.k} and full model "
+          f"latency per candidate set")
+    print(f"{'candidates':<22}{'rows':>8}{'recall':>10}{'mean score':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode, result in results.items():
+        label = mode if isinstance(mode, str) else f"{mode[0]} {mode[2]}"
+        seconds = np.array(result["seconds"]) * 1000.0
+        print(f"{label:<22}{np.mean(result['rows']):>8.0f}{np.mean(result['recall']):>10.3f}"
+              f"{np.nanmean(result['score']):>12.4f}{np.percentile(seconds, 50):>10.3f}{np.percentile(seconds, 99):>10.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--countries", nargs="+", default=["US", "BR", "IN", "FR", "ID"])
+    parser.add_argument("--assets-per-country", type=int, default=5000)
+    parser.add_argument("--top-n", type=int, nargs="+", default=[100], help="candidates passed to the full model")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--reference-user", action="store_true",
+                        help="pre-score with the full model for the average seeded user instead of the cold start model")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
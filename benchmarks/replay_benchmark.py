@@ -0,0 +1,266 @@
+## Latency / throughput benchmark of /get_recommendations/ against in-process fakes (benchmarks/fakes.py)
+##   python benchmarks/replay_benchmark.py --concurrency 64 --requests 5000 --es-latency-ms 8 --redis-latency-ms 1
+##   python benchmarks/replay_benchmark.py --traffic traffic.jsonl --baseline benchmarks/results/previous.json
+##   python benchmarks/replay_benchmark.py --slow-share 0.02 --slow-ms 500   # dependencies with a latency tail
+## Traffic is a JSONL file of request payloads ({"user_id": ..., "user_country": ..., "k": ...}), replayed by
+## `concurrency` clients in a closed loop. p50/p95/p99 and RPS are reported for the endpoint and every pipeline stage and
+## saved as JSON, with --baseline the relative change against an earlier result is printed as well. Stages served with a
+## fallback (see `deadlines` in config.yml) are counted per stage and fallback
+
+import warnings
+warnings.filterwarnings("ignore")
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import functools
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import fakes
+fakes.setup_service_env()
+
+import numpy as np
+from logzero import loglevel
+
+import internal_reco_api as api
+from jobs.migrate_feature_encoding import migrate
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer:
+    def __init__(self) -> None:
+        """
+        ** Description: ** <em> Collects the wall time of every call of the wrapped pipeline stages </em>
+        """
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, owner, method, stage):
+        """
+        ** Description: ** <em> It replaces `owner.method` by a wrapper that times every call as `stage` </em>
+        """
+        original = getattr(owner, method)
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        setattr(owner, method, timed)
+
+    def summary(self, wall_seconds):
+        """
+        ** Description: ** <em> Percentiles in milliseconds, mean and calls per second of every stage </em>
+        """
+        summary = {}
+        for stage, samples in self.samples.items():
+            samples = np.asarray(samples) * 1000.0
+            summary[stage] = {"count": len(samples), "rps": len(samples) / wall_seconds, "mean_ms": float(samples.mean()),
+                              **{f"p{p}_ms": float(np.percentile(samples, p)) for p in PERCENTILES},
+                              "max_ms": float(samples.max())}
+        return summary
+
+
+def instrument(timer):
+    """
+    ** Description: ** <em> It times the stages of `recommend_for_user` on the live objects of `internal_reco_api` </em>
+    """
+    timer.wrap(api.candidate_retrieval, "es_retrieve_candidates", "retrieve_candidates")
+    # the caches hold their loaders, those are wrapped instead of the retrieval methods
+    timer.wrap(api.candidate_retrieval.blacklist_filter, "loader", "blacklist_lookup")
+    if api.candidate_retrieval.pool_cache is not None:
+        timer.wrap(api.candidate_retrieval.pool_cache, "loader", "candidate_pool_fetch")
+    timer.wrap(api.get_feature_from_fs, "get_user_features_from_fs", "user_features")
+    timer.wrap(api.get_feature_from_fs, "get_asset_features_from_fs", "asset_features")
+    timer.wrap(api.get_feature_from_fs, "fetch_asset_features", "asset_features_redis")
+    timer.wrap(api.get_feature_from_fs, "build_feature_batch", "build_feature_batch")
+    if api.prediction_batcher is not None:
+        timer.wrap(api.prediction_batcher, "predict", "ranking")
+    timer.wrap(api.reco, "generate_recommendations", "ranking_unbatched")
+
+
+def synthetic_traffic(dataset, n_requests, anonymous_share, seed):
+    """
+    ** Description: ** <em> It draws request payloads for the seeded users, a share of them without a user id </em>
+    """
+    rng = random.Random(seed)
+    users = list(dataset["users"].values())
+    traffic = []
+    for _ in range(n_requests):
+        user = rng.choice(users)
+        user_id = "" if rng.random() < anonymous_share else user["user_id"]
+        traffic.append({"user_id": user_id, "user_country": user["user_country"], "k": 10})
+    return traffic
+
+
+def load_traffic(path, n_requests):
+    """
+    ** Description: ** <em> It reads request payloads from a JSONL file, cycling through it up to `n_requests` </em>
+    """
+    with open(path) as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+    return [payloads[i % len(payloads)] for i in range(n_requests)]
+
+
+async def replay(traffic, concurrency, timer):
+    """
+    ** Description: ** <em> It sends the payloads through the endpoint from `concurrency` clients, each waiting for its
+    response before sending the next request </em>
+
+    Returns:
+        (tuple): wall time in seconds and the number of failed requests
+    """
+    queue = asyncio.Queue()
+    for payload in traffic:
+        queue.put_nowait(payload)
+    failures = 0
+
+    async def client():
+        nonlocal failures
+        while not queue.empty():
+            payload = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await api.fetch_recommendations(api.recommendations_schema(**payload))
+                if not isinstance(response, list):
+                    failures += 1
+            except Exception:
+                failures += 1
+            timer.record("endpoint", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - start, failures
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=fakes.ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_report(summary, baseline=None):
+    stages = ["endpoint"] + sorted(stage for stage in summary if stage != "endpoint")
+    print(f"{'stage':<24}{'count':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage in stages:
+        if stage not in summary:
+            continue
+        s = summary[stage]
+        line = f"{stage:<24}{s['count']:>8}{s['rps']:>10.1f}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}"
+        previous = (baseline or {}).get(stage)
+        if previous:
+            changes = [f"{key} {100.0 * (s[key] / previous[key] - 1):+.1f}%" for key in ("rps", "p50_ms", "p99_ms")
+                       if previous.get(key)]
+            line += "   vs baseline: " + ", ".join(changes)
+        print(line)
+
+
+async def main(args):
+    dataset = fakes.seed_dataset(countries=args.countries, assets_per_country=args.assets_per_country,
+                                 n_users=args.users, seed=args.seed)
+    _, asset_fs, user_fs = fakes.install_fakes(api, dataset,
+                        es_latency=fakes.FakeLatency(args.es_latency_ms, args.latency_jitter * args.es_latency_ms,
+                                                     args.slow_share, args.slow_ms),
+                        redis_latency=fakes.FakeLatency(args.redis_latency_ms,
+                                                        args.latency_jitter * args.redis_latency_ms,
+                                                        args.slow_share, args.slow_ms))
+    if args.feature_encoding:
+        api.get_feature_from_fs.encoding = args.feature_encoding
+    if api.get_feature_from_fs.encoding != "hash":
+        # the seeded hashes are migrated to vectors like jobs/migrate_feature_encoding.py does, `vector` drops them
+        for fs, codec in ((asset_fs, api.get_feature_from_fs.asset_codec), (user_fs, api.get_feature_from_fs.user_codec)):
+            await migrate(fs, codec, 1000, drop_hashes=api.get_feature_from_fs.encoding == "vector")
+    if args.traffic:
+        traffic = load_traffic(args.traffic, args.requests)
+    else:
+        traffic = synthetic_traffic(dataset, args.requests, args.anonymous_share, args.seed)
+        if args.save_traffic:
+            with open(args.save_traffic, "w") as f:
+                f.writelines(json.dumps(payload) + "\n" for payload in traffic)
+
+    if not await fakes.start_service(api):
+        return 1
+    # warm up caches, pools and the models, then measure from a clean slate
+    await replay(traffic[:args.warmup], args.concurrency, StageTimer())
+    timer = StageTimer()
+    instrument(timer)
+    degraded_before = api.degraded_total.values()
+    wall_seconds, failures = await replay(traffic, args.concurrency, timer)
+    degraded = {"/".join(labels): value - degraded_before.get(labels, 0)
+                for labels, value in sorted(api.degraded_total.values().items())
+                if value > degraded_before.get(labels, 0)}
+    await api.shutdown()
+
+    summary = timer.summary(wall_seconds)
+    results = {
+        "created_at": datetime.utcnow().isoformat(),
+        "git_revision": git_revision(),
+        "args": vars(args),
+        "config": api.config,
+        "wall_seconds": wall_seconds,
+        "requests": len(traffic),
+        "failures": failures,
+        "rps": len(traffic) / wall_seconds,
+        "degraded": degraded,
+        "stages": summary,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+    print(f"{len(traffic)} requests at concurrency {args.concurrency} in {wall_seconds:.2f}s, "
+          f"{results['rps']:.1f} RPS, {failures} failures")
+    print_report(summary, baseline)
+    if degraded:
+        print("degraded stages: " + ", ".join(f"{labels} {value}" for labels, value in degraded.items()))
+
+    output = Path(args.output or fakes.ROOT / "benchmarks" / "results" / f"replay_{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"results saved to {output}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--traffic", help="JSONL file of request payloads, synthetic traffic when omitted")
+    parser.add_argument("--save-traffic", help="write the synthetic traffic to this JSONL file")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--anonymous-share", type=float, default=0.2)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--countries", nargs="+", default=["US", "BR", "IN", "FR", "ID"])
+    parser.add_argument("--assets-per-country", type=int, default=5000)
+    parser.add_argument("--es-latency-ms", type=float, default=8.0)
+    parser.add_argument("--redis-latency-ms", type=float, default=1.0)
+    parser.add_argument("--latency-jitter", type=float, default=0.5, help="jitter as a share of the mean latency")
+    parser.add_argument("--slow-share", type=float, default=0.0, help="share of ES and feature store calls that are slow")
+    parser.add_argument("--slow-ms", type=float, default=0.0, help="extra latency of a slow call")
+    parser.add_argument("--feature-encoding", choices=["hash", "vector", "dual"],
+                        help="feature_encoding.read of config.yml by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file, benchmarks/results/replay_<time>.json by default")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args()
+    loglevel("WARNING")
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,103 @@
+## Equivalence check and benchmark of ranking/src/tree_predictor.py against XGBoost on the shipped models
+##   python benchmarks/tree_predictor_benchmark.py --rows 1 10 100 1000
+## exits with status 1 when a prediction differs from Booster.predict
+
+import warnings
+warnings.filterwarnings("ignore")
+import sys
+import time
+import pickle
+import argparse
+from pathlib import Path
+
+import fakes
+fakes.setup_service_env()
+
+import numpy as np
+import xgboost as xgb
+from ranking.src.tree_predictor import TreePredictor
+
+MODEL_DIR = fakes.ROOT / "ranking" / "models"
+
+
+def load_booster(path):
+    """
+    ** Description: ** <em> It loads a shipped model, pickled boosters and XGBoost model files alike </em>
+
+    Args:
+        path (Path): model file
+
+    Returns:
+        (xgb.Booster): loaded model
+    """
+    if path.suffix == ".pkl":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return xgb.Booster(model_file=str(path))
+
+
+def synthetic_features(n_rows, n_features, rng, missing_rate=0.05):
+    """
+    ** Description: ** <em> It draws probability-like features with a view count in the last column and some missing
+    values, the shape of the cold start input </em>
+    """
+    features = rng.random((n_rows, n_features), dtype=np.float32)
+    features[:, -1] = rng.integers(0, 5000, n_rows)
+    features[rng.random((n_rows, n_features)) < missing_rate] = np.nan
+    return features
+
+
+def check_equivalence(booster, predictor, rng, n_rows=20000):
+    """
+    ** Description: ** <em> It compares margins and predictions of both evaluators bit for bit </em>
+
+    Returns:
+        (tuple): number of differing margins and of differing predictions
+    """
+    features = synthetic_features(n_rows, predictor.num_feature, rng)
+    dmatrix = xgb.DMatrix(features, feature_names=booster.feature_names)
+    margin_diff = int((booster.predict(dmatrix, output_margin=True) != predictor.predict_margin(features)).sum())
+    prediction_diff = int((booster.predict(dmatrix) != predictor.inplace_predict(features)).sum())
+    return margin_diff, prediction_diff
+
+
+def time_call(fn, repeat):
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--models", nargs="+", default=sorted(str(p) for p in MODEL_DIR.iterdir()))
+    parser.add_argument("--rows", nargs="+", type=int, default=[1, 10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--nthread", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    failed = False
+    for path in map(Path, args.models):
+        booster = load_booster(path)
+        booster.set_param({"nthread": args.nthread})
+        predictor = TreePredictor.from_booster(booster)
+        margin_diff, prediction_diff = check_equivalence(booster, predictor, rng)
+        print(f"{path.name}: {len(predictor.roots)} trees, max depth {predictor.max_depth}, "
+              f"compiled={predictor.compiled}")
+        print(f"  differing margins: {margin_diff}, differing predictions: {prediction_diff}")
+        failed |= margin_diff > 0 or (predictor.compiled and prediction_diff > 0)
+        print(f"  {'rows':>6} {'xgboost ms':>12} {'tree_predictor ms':>18} {'speedup':>8}")
+        for n_rows in args.rows:
+            features = synthetic_features(n_rows, predictor.num_feature, rng)
+            xgb_ms = time_call(lambda: booster.inplace_predict(features), args.repeat)
+            tree_ms = time_call(lambda: predictor.inplace_predict(features), args.repeat)
+            print(f"  {n_rows:>6} {xgb_ms:>12.3f} {tree_ms:>18.3f} {xgb_ms / tree_ms:>7.2f}x")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
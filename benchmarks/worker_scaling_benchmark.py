@@ -0,0 +1,229 @@
+## RPS scaling of the multi-worker mode (gunicorn_conf.py) with the number of cores, against in-process fakes
+##   python benchmarks/worker_scaling_benchmark.py --workers 1 2 4 8
+##   python benchmarks/worker_scaling_benchmark.py --workers 1 2 4 --output benchmarks/results/scaling.json
+## For every worker count the service runs under gunicorn with the settings of gunicorn_conf.py, one worker per core,
+## pinned to that many cores. Client processes pinned to the remaining cores send /get_recommendations/ requests in a
+## closed loop over HTTP. The fakes (benchmarks/fakes.py) are installed in the gunicorn master before it forks, the
+## response cache is off so every request runs the whole pipeline. Efficiency is the RPS of n workers over n times
+## the RPS of one worker, it needs at least max(workers) + 1 cores to mean anything
+
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+
+import fakes
+fakes.setup_service_env()
+
+import numpy as np
+
+
+def serve(args):
+    """
+    ** Description: ** <em> It runs the service under gunicorn with fakes installed in the master, in the process the
+    benchmark started for one worker count </em>
+    """
+    from gunicorn.app.base import BaseApplication
+    from logzero import loglevel
+
+    os.environ["WEB_CONCURRENCY"] = str(args.serve)
+    import gunicorn_conf
+    gunicorn_conf.config["response_cache"]["enabled"] = args.response_cache
+    import internal_reco_api as api
+    loglevel(30)
+    dataset = fakes.seed_dataset(countries=args.countries, assets_per_country=args.assets_per_country,
+                                 n_users=args.users, seed=args.seed)
+    fakes.install_fakes(api, dataset,
+                        es_latency=fakes.FakeLatency(args.es_latency_ms, 0.5 * args.es_latency_ms),
+                        redis_latency=fakes.FakeLatency(args.redis_latency_ms, 0.5 * args.redis_latency_ms))
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for name in ("workers", "worker_class", "preload_app", "timeout", "graceful_timeout", "keepalive",
+                         "when_ready"):
+                self.cfg.set(name, getattr(gunicorn_conf, name))
+            self.cfg.set("bind", f"127.0.0.1:{args.port}")
+            self.cfg.set("loglevel", "warning")
+
+        def load(self):
+            return api.app
+
+    Application().run()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_ready(url, timeout_seconds):
+    """
+    ** Description: ** <em> It polls /ready until enough answers in a row are 200 that every worker should be ready </em>
+    """
+    import aiohttp
+    deadline = time.monotonic() + timeout_seconds
+    in_a_row = 0
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url + "/ready") as response:
+                    in_a_row = in_a_row + 1 if response.status == 200 else 0
+            except aiohttp.ClientError:
+                in_a_row = 0
+            if in_a_row >= 50:
+                return True
+            await asyncio.sleep(0.05 if in_a_row else 0.5)
+    return False
+
+
+async def load(url, traffic, concurrency, warmup_seconds, seconds):
+    """
+    ** Description: ** <em> It sends requests from `concurrency` connections, each waiting for its response before
+    sending the next one, and records the latency of those completed during the measured window </em>
+
+    Returns:
+        (tuple): latencies in seconds and the number of failed requests of the measured window
+    """
+    import aiohttp
+    start = time.monotonic()
+    measure_from, measure_to = start + warmup_seconds, start + warmup_seconds + seconds
+    latencies, failures = [], 0
+
+    async def client(session, offset):
+        nonlocal failures
+        i = offset
+        while time.monotonic() < measure_to:
+            payload = traffic[i % len(traffic)]
+            i += concurrency
+            sent = time.monotonic()
+            try:
+                async with session.post(url + "/get_recommendations/", json=payload) as response:
+                    ok = response.status == 200 and isinstance(await response.json(), list)
+            except aiohttp.ClientError:
+                ok = False
+            done = time.monotonic()
+            if measure_from <= sent and done <= measure_to:
+                latencies.append(done - sent)
+                failures += not ok
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session, i) for i in range(concurrency)])
+    return latencies, failures
+
+
+def client_process(cores, url, traffic, concurrency, warmup_seconds, seconds, results):
+    if cores:
+        os.sched_setaffinity(0, cores)
+    results.put(asyncio.run(load(url, traffic, concurrency, warmup_seconds, seconds)))
+
+
+def run(args, workers, cores, traffic):
+    """
+    ** Description: ** <em> It starts the service with `workers` workers pinned to as many cores, loads it from client
+    processes on the other cores and stops it </em>
+
+    Returns:
+        (dict): RPS, latency percentiles and failures of the measured window
+    """
+    server_cores, client_cores = cores[:workers], cores[workers:] or cores
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    command = [sys.executable, __file__, "--serve", str(workers), "--port", str(port),
+               "--countries", *args.countries, "--assets-per-country", str(args.assets_per_country),
+               "--users", str(args.users), "--seed", str(args.seed),
+               "--es-latency-ms", str(args.es_latency_ms), "--redis-latency-ms", str(args.redis_latency_ms)]
+    if args.response_cache:
+        command.append("--response-cache")
+    server = subprocess.Popen(command, preexec_fn=lambda: os.sched_setaffinity(0, server_cores))
+    try:
+        if not asyncio.run(wait_ready(url, args.ready_timeout)):
+            raise RuntimeError(f"the service with {workers} workers did not get ready")
+        n_clients = args.clients or len(client_cores)
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client_process,
+                                           args=([client_cores[i % len(client_cores)]], url, traffic[i::n_clients],
+                                                 args.concurrency_per_worker * workers // n_clients + 1,
+                                                 args.warmup_seconds, args.seconds, results))
+                   for i in range(n_clients)]
+        for client in clients:
+            client.start()
+        outcomes = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = np.array([latency for outcome in outcomes for latency in outcome[0]]) * 1000.0
+    return {"workers": workers, "server_cores": len(server_cores), "client_processes": n_clients,
+            "requests": len(latencies), "failures": sum(outcome[1] for outcome in outcomes),
+            "rps": len(latencies) / args.seconds,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+
+def main(args):
+    from utils import available_cores
+    cores = sorted(os.sched_getaffinity(0))
+    if max(args.workers) >= available_cores():
+        print(f"only {available_cores()} cores, clients share cores with the workers and the scaling is not meaningful")
+    dataset = fakes.seed_dataset(countries=args.countries, assets_per_country=args.assets_per_country,
+                                 n_users=args.users, seed=args.seed)
+    rng = random.Random(args.seed)
+    users = list(dataset["users"].values())
+    traffic = [{"user_id": user["user_id"], "user_country": user["user_country"], "k": 10}
+               for user in (rng.choice(users) for _ in range(args.traffic_size))]
+    results = []
+    for workers in args.workers:
+        result = run(args, workers, cores, traffic)
+        result["efficiency"] = result["rps"] / (workers * results[0]["rps"] / results[0]["workers"]) \
+            if results else 1.0
+        results.append(result)
+        print(f"{workers:>3} workers on {result['server_cores']} cores: {result['rps']:8.1f} RPS, "
+              f"p50 {result['p50_ms']:.2f}ms, p99 {result['p99_ms']:.2f}ms, {result['failures']} failures, "
+              f"efficiency {result['efficiency']:.2f}")
+    if args.output:
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({"created_at": datetime.utcnow().isoformat(), "args": vars(args), "results": results}, f,
+                      indent=2)
+        print(f"results saved to {output}")
+    return 1 if any(result["failures"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seconds", type=float, default=20.0, help="measured window per worker count")
+    parser.add_argument("--warmup-seconds", type=float, default=5.0)
+    parser.add_argument("--concurrency-per-worker", type=int, default=32, help="open connections per worker")
+    parser.add_argument("--clients", type=int, default=0, help="client processes, one per remaining core by default")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--countries", nargs="+", default=["US", "BR", "IN", "FR", "ID"])
+    parser.add_argument("--assets-per-country", type=int, default=2000)
+    parser.add_argument("--traffic-size", type=int, default=20000)
+    parser.add_argument("--es-latency-ms", type=float, default=2.0)
+    parser.add_argument("--redis-latency-ms", type=float, default=0.5)
+    parser.add_argument("--response-cache", action="store_true", help="keep the response cache on")
+    parser.add_argument("--ready-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file, printed only when omitted")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+    else:
+        sys.exit(main(args))
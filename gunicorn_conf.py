@@ -0,0 +1,40 @@
+## gunicorn settings of the multi-worker mode, read from `serving` in config.yml
+##   gunicorn -c gunicorn_conf.py internal_reco_api:app
+##   WEB_CONCURRENCY=4 gunicorn -c gunicorn_conf.py internal_reco_api:app    # overrides serving.workers
+## The service is imported and its models are loaded once in the master (preload_app, see `internal_reco_api.preload`),
+## the forked workers share them copy-on-write. Every worker creates its own ES and feature store clients when it
+## starts, and its ranking threads get an even share of the cores, see `utils.ranking_threads`. Set the number of
+## workers here or with WEB_CONCURRENCY, not with `-w`, the thread budget is computed from it before workers fork
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent))
+
+from utils import get_config, worker_count
+
+config = get_config()
+serving = config["serving"]
+
+workers = worker_count(config)
+# read by `utils.ranking_threads` in the master while it imports the service, and inherited by the workers
+os.environ["SERVING_WORKERS"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.environ.get("BIND", serving["bind"])
+preload_app = True
+timeout = serving["timeout_seconds"]
+graceful_timeout = serving["graceful_timeout_seconds"]
+keepalive = 5
+
+
+def when_ready(server):
+    """
+    ** Description: ** <em> It loads what the workers share, in the master after the service was imported and before
+    the first worker is forked </em>
+    """
+    import internal_reco_api
+    if internal_reco_api.preload():
+        server.log.info(f"Models preloaded, forking {workers} workers")
+    else:
+        server.log.info("Could not preload the models, every worker loads its own")
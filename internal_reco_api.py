@@ -7,6 +7,15 @@ warnings.filterwarnings("ignore")
 import os
 import sys
 import time
+import json
+import asyncio
+import gc
+import hmac
+import traceback
+import contextvars
+from collections import defaultdict
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 sys.path.append(str(Path(os.getcwd()).parent))
@@ -17,24 +26,258 @@ sys.path.append(str(Path(os.getcwd())))
 from retrieval.es_queries.retrieve_candidates import CandidateRetrieval
 from retrieval.src.get_feat_from_fs import GetFeaturesFromFS
 from ranking.inference import GetRecommendations
+from ranking.src.batcher import PredictionBatcher, BATCH_ROWS_BUCKETS
+from ranking.src.cold_start_rankings import ColdStartRankings
+from ranking.src.pre_ranker import PreRanker
+from ranking.src.model_reloader import ModelReloader
+from ranking.src.shadow import ShadowScorer
+from serving.response_cache import ResponseCache
+from serving.deadline import Deadline, DeadlineExceeded
+from serving.metrics import MetricsRegistry
+from serving.tracing import Tracer
 
 
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from pydantic import BaseModel, Field
 import uvicorn
 import time
 # from utils import get_logger
+import logging
+import logzero
 from logzero import logger
+from utils import get_config, ranking_threads
+
+config = get_config()
+# per request messages of the pipeline are logged at DEBUG, logzero logs everything by default
+logzero.loglevel(logging.getLevelName(config["observability"]["log_level"]))
 
-candidate_retrieval = CandidateRetrieval()
 get_feature_from_fs = GetFeaturesFromFS()
-reco = GetRecommendations()
+# models are loaded by `warm_up` after start up, see /ready
+reco = GetRecommendations(load=False)
+# ranking is CPU bound, it runs off the event loop so slow predictions do not stall other requests. No thread is
+# started before the first prediction, so a gunicorn master can import the service and fork
+ranking_executor_workers, _ = ranking_threads(config)
+ranking_executor = ThreadPoolExecutor(max_workers=ranking_executor_workers)
+# pools are pre-scored once when they are loaded, requests pass their best pre-scored candidates to the full model
+pre_ranker = None
+if config["pre_ranking"]["enabled"]:
+    pre_ranker = PreRanker(get_feature_from_fs, reco, ranking_executor,
+                           reference_user=config["pre_ranking"]["reference_user"])
+# the popular candidate source ranks by an asset feature
+candidate_retrieval = CandidateRetrieval(get_feature_from_fs,
+                                         pre_scorer=None if pre_ranker is None else pre_ranker.score)
+prediction_batcher = None
+if config["prediction_batching"]["enabled"]:
+    prediction_batcher = PredictionBatcher(reco, ranking_executor,
+                                           max_wait_ms=config["prediction_batching"]["max_wait_ms"],
+                                           max_batch_rows=config["prediction_batching"]["max_batch_rows"])
+cold_start_rankings = None
+if config["cold_start_rankings"]["enabled"]:
+    cold_start_rankings = ColdStartRankings(candidate_retrieval, get_feature_from_fs, reco, ranking_executor,
+                                            refresh_seconds=config["cold_start_rankings"]["refresh_seconds"],
+                                            sample_from_top=config["cold_start_rankings"]["sample_from_top"],
+                                            idle_seconds=config["cold_start_rankings"]["idle_seconds"])
+# models are reloaded and shadow scored in their own threads, ranking keeps all of its workers meanwhile
+model_executor = ThreadPoolExecutor(max_workers=1)
+shadow_executor = ThreadPoolExecutor(max_workers=1)
+model_reloader = ModelReloader(reco, model_executor, warmup_rows=config["readiness"]["warmup_rows"],
+                               check_seconds=config["model_reload"]["check_seconds"])
+if cold_start_rankings is not None:
+    # rankings built with the previous cold start model are rebuilt right away instead of at the next refresh
+    model_reloader.on_swap.append(lambda models: cold_start_rankings.refresh_all())
+
+response_cache = None
+if config["response_cache"]["enabled"]:
+    # the client of the shared tier is created by `startup`, in the serving process
+    response_cache = ResponseCache(ttl_seconds=config["response_cache"]["ttl_seconds"],
+                                   max_items=config["response_cache"]["max_items"])
+
+metrics = MetricsRegistry("reco")
+stage_latency = metrics.histogram("stage_latency_ms", "latency of every request and pipeline stage in milliseconds",
+                                  labelnames=("stage",))
+requests_total = metrics.counter("requests_total", "requests by endpoint and outcome", labelnames=("endpoint", "outcome"))
+payload_size = metrics.gauge("payload_size", "size of the last payload handed between stages", labelnames=("payload",))
+payload_items = metrics.counter("payload_items_total", "items handed between stages", labelnames=("payload",))
+degraded_total = metrics.counter("degraded_total", "stages served with a fallback, by stage and fallback",
+                                 labelnames=("stage", "fallback"))
+shadow_scorer = ShadowScorer(reco, shadow_executor, metrics,
+                             sample_rate=config["shadow_scoring"]["sample_rate"],
+                             max_pending=config["shadow_scoring"]["max_pending"])
+tracer = Tracer(stage_latency,
+                trace_sample_rate=config["observability"]["trace_sample_rate"],
+                debug_sample_rate=config["observability"]["debug_sample_rate"])
+if prediction_batcher is not None:
+    prediction_batcher.rows_histogram = metrics.histogram("prediction_batch_rows",
+                                                          "rows scored by every combined predict of the batcher",
+                                                          buckets=BATCH_ROWS_BUCKETS)
+metrics.register_stats("blacklist_filter", lambda: candidate_retrieval.blacklist_filter.stats)
+for component, owner in (("feature_store", get_feature_from_fs),
+                         ("candidate_pool_cache", candidate_retrieval.pool_cache),
+                         ("pre_ranker", pre_ranker),
+                         ("asset_feature_snapshot", get_feature_from_fs.asset_snapshot),
+                         ("asset_feature_cache", get_feature_from_fs.asset_cache),
+                         ("prediction_batcher", prediction_batcher),
+                         ("cold_start_rankings", cold_start_rankings),
+                         ("response_cache", response_cache),
+                         ("model_reloader", model_reloader),
+                         ("shadow_scorer", shadow_scorer)):
+    if owner is not None:
+        metrics.register_stats(component, lambda owner=owner: owner.stats)
+if get_feature_from_fs.encoding != "hash":
+    for component, owner in (("asset_feature_codec", get_feature_from_fs.asset_codec),
+                             ("user_feature_codec", get_feature_from_fs.user_codec)):
+        metrics.register_stats(component, lambda owner=owner: owner.stats)
+
+
+def record_payload(payload, size):
+    """
+    ** Description: ** <em> It records the size of a payload handed from one stage to the next </em>
+
+    Args:
+        payload (str): payload name, e.g. candidates
+        size (int): number of items
+    """
+    payload_size.set(size, payload)
+    payload_items.inc(size, payload)
+
+def new_deadline():
+    """
+    ** Description: ** <em> It starts the latency budget of a request, see `deadlines` in config.yml </em>
+
+    Returns:
+        (Deadline): budget of the request and of its stages, unbounded when deadlines are disabled
+    """
+    deadline_config = config["deadlines"]
+    if not deadline_config["enabled"]:
+        return Deadline()
+    return Deadline(deadline_config["request_ms"],
+                    {stage: deadline_config[f"{stage}_ms"]
+                     for stage in ("response_cache", "retrieve_candidates", "user_features", "asset_features",
+                                   "ranking")})
+
+def record_degraded(stage, fallback, error):
+    """
+    ** Description: ** <em> It counts a stage served with a fallback. Timeouts are expected under load and only logged
+    at DEBUG like other reasons given as text, errors are logged with their traceback </em>
+
+    Args:
+        stage (str): stage that failed or ran out of time
+        fallback (str): what was served instead
+        error (Exception or str): why
+    """
+    degraded_total.inc(1, stage, fallback)
+    stages = degraded_stages.get()
+    if stages is not None:
+        stages.append(stage)
+    tracer.annotate(**{f"degraded_{stage}": fallback})
+    if not isinstance(error, Exception) or isinstance(error, DeadlineExceeded):
+        logger.debug(f"{stage}: {error}, serving {fallback}")
+    else:
+        trace = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        logger.info(f"{stage} failed, serving {fallback}: {trace}")
+
+# stages of the current request served with a fallback, collected for `cacheable_recommendations`. It holds a list
+# so that the tasks the stages run in, which get a copy of the context, append to the same one
+degraded_stages = contextvars.ContextVar("degraded_stages", default=None)
+service_ready = False
+warmup_task = None
 
 app = FastAPI()
 
+def preload():
+    """
+    ** Description: ** <em> It loads the models and maps the asset feature snapshot before the serving processes fork,
+    called in the gunicorn master by gunicorn_conf.py. The forked workers share them copy-on-write instead of loading
+    a copy each, and `gc.freeze` keeps the garbage collector of the workers from writing to (and so copying) the pages
+    of everything loaded so far. Nothing is predicted and no connection is opened here, OpenMP threads and sockets do
+    not survive a fork, workers warm up and connect in `startup` </em>
+
+    Returns:
+        (bool): whether the models were loaded, workers load them themselves otherwise
+    """
+    loaded = reco.load_models()
+    if get_feature_from_fs.asset_snapshot is not None:
+        get_feature_from_fs.asset_snapshot.maybe_reload()
+    gc.collect()
+    gc.freeze()
+    return loaded
+
+@app.on_event("startup")
+async def startup():
+    """
+    ** Description: ** <em> It creates the ES, feature store and response cache clients and checks the connections once
+    the event loop of the serving process is running, then starts loading (unless preloaded) and warming up the models
+    in the background, the server accepts connections in the meantime and /ready reports when it can serve </em>
+    """
+    global warmup_task
+    if response_cache is not None and response_cache.shared is None and config["response_cache"]["shared_tier"]:
+        import redis.asyncio as redis
+        # bounded and timed out like the feature store clients
+        response_cache.shared = redis.StrictRedis(
+            connection_pool=get_feature_from_fs.connection_pool(os.environ["RESPONSE_CACHE_DB"], decode_responses=False))
+    await asyncio.gather(candidate_retrieval.connect(), get_feature_from_fs.connect())
+    warmup_task = asyncio.ensure_future(warm_up())
+
+async def warm_up():
+    """
+    ** Description: ** <em> It loads the models unless `preload` did, runs a synthetic predict on every ranking thread,
+    builds the candidate pools and cold start rankings of `readiness.warm_countries` and starts the background refresh
+    of the cold start rankings and the model watcher. The service reports ready once all of it is done, shadow models
+    are loaded afterwards </em>
+    """
+    global service_ready
+    start_time = time.time()
+    try:
+        loop = asyncio.get_running_loop()
+        if reco.models is None and not await loop.run_in_executor(ranking_executor, reco.load_models):
+            return
+        await asyncio.gather(*[loop.run_in_executor(ranking_executor, reco.warmup, config["readiness"]["warmup_rows"])
+                               for _ in range(ranking_executor_workers)])
+        countries = config["readiness"]["warm_countries"]
+        await asyncio.gather(*[candidate_retrieval.get_candidate_pool(country) for country in countries])
+        if cold_start_rankings is not None:
+            await asyncio.gather(*[cold_start_rankings.refresh(country) for country in countries])
+            cold_start_rankings.start()
+        service_ready = True
+        logger.info(f"Service ready {time.time() - start_time:.2f}s after start up")
+        if config["model_reload"]["watch"]:
+            model_reloader.start()
+        shadow = config["shadow_scoring"]
+        if shadow["model_name"] is not None or shadow["cold_start_model_name"] is not None:
+            # loaded while the service already serves, shadow models that do not load are logged by the reloader
+            await asyncio.gather(model_reloader.load_shadow(shadow["model_name"], shadow["cold_start_model_name"]),
+                                 return_exceptions=True)
+    except Exception:
+        logger.info(f"Warm up failed: {traceback.format_exc()}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    ** Description: ** <em> It closes the async ES and feature store clients and the ranking executor </em>
+    """
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await model_reloader.stop()
+    if cold_start_rankings is not None:
+        await cold_start_rankings.stop()
+    await asyncio.gather(candidate_retrieval.close(), get_feature_from_fs.close())
+    if response_cache is not None and response_cache.shared is not None:
+        await response_cache.shared.aclose()
+    for executor in (ranking_executor, model_executor, shadow_executor):
+        executor.shutdown(wait=False)
+
 class recommendations_schema(BaseModel):
     user_id : str
     user_country: str
+    k: int = Field(10, gt=0, le=1000)
+
+class batch_recommendations_schema(BaseModel):
+    records: List[recommendations_schema]
+
+class models_schema(BaseModel):
+    model_name: Optional[str] = None
+    cold_start_model_name: Optional[str] = None
 
 @app.get("/")
 def read_root():
@@ -46,14 +289,99 @@ def read_root():
     """
     return {"Welcome to AI-Internal Recommendation system"}
 
+@app.get("/ready")
+def read_ready():
+    """
+    ** Description: ** <em> Readiness probe, 200 once the models are loaded and warmed up, 503 before </em>
+
+    Returns:
+        (dict): {"ready": bool}
+    """
+    if service_ready:
+        return {"ready": True}
+    return JSONResponse(status_code=503, content={"ready": False})
+
+@app.get("/metrics")
+def read_metrics():
+    """
+    ** Description: ** <em> It returns the stage latency histograms, request counters, payload sizes and the cache and
+    batcher stats in the Prometheus text format </em>
+
+    Returns:
+        (PlainTextResponse): metrics exposition text
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def check_admin_token(token):
+    """
+    ** Description: ** <em> Admin endpoints are refused unless ADMIN_TOKEN is set and the x-admin-token header matches
+    it. The comparison takes the same time whatever the header, so the token cannot be guessed from response times </em>
+    """
+    expected = os.environ.get("ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=403, detail="admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    if token is None or not hmac.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail="invalid admin token")
+
+@app.get("/admin/models")
+def read_models(x_admin_token: Optional[str] = Header(None)):
+    """
+    ** Description: ** <em> It returns the file names and load time of the served and the shadow models </em>
+
+    Returns:
+        (dict): {"serving": ..., "shadow": ...}
+    """
+    check_admin_token(x_admin_token)
+    return model_reloader.describe()
+
+@app.post("/admin/models/reload")
+async def reload_models(models: models_schema, x_admin_token: Optional[str] = Header(None)):
+    """
+    ** Description: ** <em> It loads, warms up and then serves the given models, names left out keep the served file,
+    so an empty body reloads model files replaced in place. The current models serve until the swap and stay if the
+    load fails </em>
+
+    Args:
+        models (dict): model_name and cold_start_model_name, file names in `model_path`
+
+    Returns:
+        (dict): the served and the shadow models
+    """
+    check_admin_token(x_admin_token)
+    if not service_ready:
+        raise HTTPException(status_code=503, detail="models are still loading")
+    try:
+        await model_reloader.reload(models.model_name, models.cold_start_model_name)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"could not load models: {e!r}")
+    return model_reloader.describe()
+
+@app.post("/admin/models/shadow")
+async def shadow_models(models: models_schema, x_admin_token: Optional[str] = Header(None)):
+    """
+    ** Description: ** <em> It loads the given candidate models for shadow scoring, an empty body stops shadow scoring </em>
+
+    Args:
+        models (dict): model_name and cold_start_model_name, file names in `model_path`
+
+    Returns:
+        (dict): the served and the shadow models
+    """
+    check_admin_token(x_admin_token)
+    try:
+        await model_reloader.load_shadow(models.model_name, models.cold_start_model_name)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"could not load models: {e!r}")
+    return model_reloader.describe()
+
 ################################################################
 ######################## API endpoints #########################
 ################################################################
 @app.post("/get_recommendations/")
 async def fetch_recommendations(record: recommendations_schema):
     """
-    ** Description: ** <em> Given a user record, retrieve a candidate set of assets, fetch features from the feature store, \
-    and generate recommendations </em>
+    ** Description: ** <em> Given a user record, return its recommendations. Responses are served from the response cache \
+    when enabled, identical requests in flight share one run of the pipeline </em>
     
     Args:
         record (dict): This is the input data that we will be passing to the function
@@ -61,13 +389,176 @@ async def fetch_recommendations(record: recommendations_schema):
     Returns:
         (list): A list of recommendations
     """
-    start_time = time.time()
+    if not service_ready:
+        raise HTTPException(status_code=503, detail="models are still loading")
     record = record.dict()
+    with tracer.trace("get_recommendations", user_country=record["user_country"], k=record["k"],
+                      anonymous=record["user_id"] == ""):
+        try:
+            if response_cache is None or (record["user_id"] == "" and not config["response_cache"]["cache_anonymous"]):
+                recommendations = await recommend_for_user(record)
+            else:
+                key = f'{record["user_id"]}|{record["user_country"]}|{record["k"]}'
+                # the shared tier lookup and the pipeline share one budget
+                deadline = new_deadline()
+                recommendations = await response_cache.get_or_compute(
+                    key, lambda: cacheable_recommendations(record, deadline), deadline)
+        except Exception:
+            requests_total.inc(1, "get_recommendations", "error")
+            raise
+        requests_total.inc(1, "get_recommendations", "ok" if recommendations else "empty")
+        record_payload("recommendations", len(recommendations))
+        return recommendations
+
+
+async def cacheable_recommendations(record, deadline):
+    """
+    ** Description: ** <em> It computes the recommendations of a response cache miss. Responses served with a fallback
+    by any stage, or empty, are not cached, so the next request is not held to them for the whole ttl </em>
+
+    Returns:
+        (tuple): the recommendations and whether they may be cached
+    """
+    stages = []
+    token = degraded_stages.set(stages)
+    try:
+        recommendations = await recommend_for_user(record, deadline)
+    finally:
+        degraded_stages.reset(token)
+    return recommendations, bool(recommendations) and not stages
+
+
+async def retrieve_candidates(user_country, user_id, deadline):
+    """
+    ** Description: ** <em> Candidate retrieval within its budget, falls back to a sample of the cached candidate pool
+    of the country. In pool mode, a country without a cached pool waits for its pool load with what is left of the
+    request budget, the load is not cut by the retrieval budget. Lean retrieval keeps no pool, its failures are served
+    by the ranking fallback </em>
+
+    Returns:
+        (list): lomotif ids, empty when the country has no lomotif, None when retrieval failed and no candidate could \
+        be sampled instead
+    """
+    try:
+        return await deadline.run("retrieve_candidates",
+                                  candidate_retrieval.es_retrieve_candidates(user_country, user_id))
+    except Exception as e:
+        error = e
+    candidates = []
+    if candidate_retrieval.config["retrieval_mode"] != "lean":
+        candidates = candidate_retrieval.fallback_candidates(user_country, user_id)
+        if not candidates:
+            try:
+                if await deadline.run("pool_load", candidate_retrieval.wait_for_pool(user_country)):
+                    candidates = candidate_retrieval.fallback_candidates(user_country, user_id)
+            except Exception:
+                # the load keeps running and fills the pool cache for the next requests
+                pass
+    record_degraded("retrieve_candidates", "cached_pool" if candidates else "no_candidates", error)
+    return candidates or None
+
+async def user_features(user_id, deadline):
+    """
+    ** Description: ** <em> User feature lookup within its budget, falls back to no user features so the candidates
+    are scored with the cold start model </em>
+
+    Returns:
+        (dict): user level features
+    """
+    try:
+        return await deadline.run("user_features", get_feature_from_fs.get_user_features_from_fs(user_id))
+    except Exception as e:
+        record_degraded("user_features", "cold_start", e)
+        return {}
+
+async def asset_features(candidates, deadline):
+    """
+    ** Description: ** <em> Asset feature lookup within its budget, falls back to the features held by the snapshot and
+    the local cache. Candidates without features there are dropped when the model input is built </em>
+
+    Returns:
+        (np.ndarray): asset level features, one row per candidate
+    """
+    try:
+        return await deadline.run("asset_features",
+                                  get_feature_from_fs.get_asset_features_from_fs(candidate_list=candidates))
+    except Exception as e:
+        record_degraded("asset_features", "local_features", e)
+        return get_feature_from_fs.get_local_asset_features(candidates)
+
+async def rank(record, model_input, deadline):
+    """
+    ** Description: ** <em> Ranking within its budget, falls back to the most viewed assets of the country's cached
+    pool, or to the country's cold start ranking without one, when scoring fails, runs out of time or has no rows with
+    features to score </em>
+
+    Returns:
+        (tuple): the recommended lomotif ids and whether the model ranked them
+    """
+    async def score():
+        if prediction_batcher is not None:
+            # scored together with concurrent requests, only the cheap top-k selection runs here
+            test_res = await prediction_batcher.predict(model_input)
+            return reco.top_k(model_input.ids, test_res, record["k"])
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(ranking_executor, reco.generate_recommendations, model_input, record["k"])
+
+    if len(model_input.ids) == 0:
+        error = "no candidate has asset features"
+    else:
+        try:
+            return await deadline.run("ranking", score()), True
+        except Exception as e:
+            error = e
+    return ranking_fallback(record, error), False
+
+def ranking_fallback(record, error):
+    """
+    ** Description: ** <em> Recommendations served when nothing could be ranked, the most viewed assets of the
+    country's cached pool, or the country's cold start ranking without one </em>
+
+    Returns:
+        (list): up to k lomotif ids, empty when the country has neither
+    """
+    recommendations = candidate_retrieval.popular_candidates(record["user_country"], record["user_id"], record["k"])
+    fallback = "popular"
+    if not recommendations and cold_start_rankings is not None:
+        recommendations = cold_start_rankings.recommend(record["user_country"], record["k"]) or []
+        fallback = "cold_start_ranking"
+    record_degraded("ranking", fallback if recommendations else "no_candidates", error)
+    return recommendations
+
+
+async def recommend_for_user(record, deadline=None):
+    """
+    ** Description: ** <em> Given a user record, retrieve a candidate set of assets, fetch features from the feature store, \
+    and generate recommendations. Retrieval and the user feature lookup run concurrently, ranking runs in an executor. \
+    Every stage runs within its share of the request's latency budget and is served with a fallback when it fails or \
+    runs out of time, see `new_deadline` </em>
+    
+    Args:
+        record (dict): user_id, user_country and k of the request
+        deadline (Deadline): budget of the request when it started before, a new one by default
+
+    Returns:
+        (list): A list of recommendations
+    """
+    ## 0. Requests without a user are served from the precomputed cold start ranking of their country
+    with tracer.span("cold_start_rankings"):
+        recommendations = precomputed_cold_start(record)
+    if recommendations is not None:
+        tracer.annotate(path="precomputed_cold_start")
+        return recommendations
     
-    ## 1. Retrieve candidate set
-    candidate_set = candidate_retrieval.es_retrieve_candidates(record["user_country"], record["user_id"],)
-    logger.info(f"candidate set: {candidate_set}")
-    logger.info(f"time taken to retrieve candidates {time.time() - start_time}")
+    deadline = deadline or new_deadline()
+
+    ## 1. Retrieve candidate set (and user features, which do not depend on the candidates)
+    candidate_set, user_data = await asyncio.gather(
+        tracer.timed("retrieve_candidates", retrieve_candidates(record["user_country"], record["user_id"], deadline)),
+        tracer.timed("user_features", user_features(record["user_id"], deadline)),
+    )
+    record_payload("candidates", len(candidate_set or []))
+    tracer.debug("candidate set", lambda: candidate_set)
     
     ####### UNCOMMENT FOR LOCAL TESTING
     # candidate_set = ["96245856-cd68-43b4-a7ae-ec53cc109d9c",
@@ -108,27 +599,156 @@ async def fetch_recommendations(record: recommendations_schema):
     # record["user_id"] = ""
 
     ## 2. Fetch data from feature store 
-    fs_time = time.time()   
-    if record["user_id"] != "":
-        _ = get_feature_from_fs.get_asset_features_from_fs(candidate_list=candidate_set)
-        model_df = get_feature_from_fs.get_user_features_from_fs(record['user_id'])
-        logger.info(model_df)
-    else:
-        model_df = get_feature_from_fs.get_asset_features_from_fs(candidate_list=candidate_set)
-        logger.info(model_df)
-    logger.info(f"time taken to extract features from feature store {time.time() - fs_time}")
+    if candidate_set is None:
+        # retrieval failed and there was no candidate to sample instead
+        with tracer.span("ranking"):
+            return ranking_fallback(record, "no candidates to rank")
+    if not candidate_set:
+        # the country has no lomotif
+        return []
+    with tracer.span("asset_features"):
+        asset_values = await asset_features(candidate_set, deadline)
+    with tracer.span("build_feature_batch"):
+        model_input = get_feature_from_fs.build_feature_batch(candidate_set, asset_values, user_data)
+    record_payload("model_rows", len(model_input.ids))
+    tracer.debug("model input", lambda: model_input)
     
     ## 3. Generate Recommendation (Ranking)
-    ranking_time = time.time()   
-    recommendations = reco.generate_recommendations(model_df)
-
-    logger.info(recommendations)
-    logger.info(f"time taken Generate recommendations {time.time() - ranking_time}")  
-    logger.info(f"API response time {time.time() - start_time}")
+    with tracer.span("ranking"):
+        recommendations, ranked = await rank(record, model_input, deadline)
+    if ranked:
+        # compared in the background, the response does not wait for the shadow models
+        shadow_scorer.maybe_score(model_input, record["k"])
+    tracer.debug("recommendations", lambda: recommendations)
     
     return recommendations
 
 
+def precomputed_cold_start(record):
+    """
+    ** Description: ** <em> Recommendations of a request without a user from the precomputed cold start ranking of
+    its country </em>
+
+    Args:
+        record (dict): request record (user_id, user_country, k)
+
+    Returns:
+        (list): recommendations, None when the request has a user or its country is not ranked yet
+    """
+    if record["user_id"] != "" or cold_start_rankings is None:
+        return None
+    return cold_start_rankings.recommend(record["user_country"], record["k"])
+
+
+async def recommend_country_group(user_country, records):
+    """
+    ** Description: ** <em> It generates recommendations for users of the same country. The candidate pool and the
+    asset features of the union of all candidates are fetched once, user features are read in one pipeline and every
+    model scores the whole group in a single call </em>
+
+    Args:
+        user_country (str): country shared by every record
+        records (list): request records (user_id, user_country, k) of the group
+
+    Returns:
+        (list): one dict per record with the user, country and its recommendations
+    """
+    user_ids = [record["user_id"] for record in records]
+    # batches have no latency target, stages are not cut off but still fall back when they fail
+    deadline = Deadline()
+
+    async def users_features():
+        try:
+            return await get_feature_from_fs.get_users_features_from_fs(user_ids)
+        except Exception as e:
+            record_degraded("user_features", "cold_start", e)
+            return [{} for _ in user_ids]
+
+    candidate_sets, users_data = await asyncio.gather(
+        tracer.timed("batch_retrieve_candidates", asyncio.gather(
+            *[retrieve_candidates(user_country, user_id, deadline) for user_id in user_ids])),
+        tracer.timed("batch_user_features", users_features()),
+    )
+    # users whose retrieval failed without a fallback get no candidates, batches have no per user fallback
+    candidate_sets = [candidates or [] for candidates in candidate_sets]
+    union = list(dict.fromkeys(candidate for candidates in candidate_sets for candidate in candidates))
+    record_payload("batch_candidates", len(union))
+    with tracer.span("batch_asset_features"):
+        asset_values = await asset_features(union, deadline)
+
+    row = {candidate: i for i, candidate in enumerate(union)}
+    model_inputs = [get_feature_from_fs.build_feature_batch(candidates, asset_values[[row[candidate] for candidate in candidates]],
+                                                            user_data)
+                    for candidates, user_data in zip(candidate_sets, users_data)]
+
+    loop = asyncio.get_running_loop()
+    with tracer.span("batch_ranking"):
+        try:
+            recommendations = await loop.run_in_executor(ranking_executor, reco.generate_recommendations_batch,
+                                                         model_inputs, [record["k"] for record in records])
+        except Exception as e:
+            record_degraded("ranking", "popular", e)
+            recommendations = [candidate_retrieval.popular_candidates(user_country, record["user_id"], record["k"])
+                               for record in records]
+    return [{"user_id": record["user_id"], "user_country": user_country, "recommendations": user_recommendations}
+            for record, user_recommendations in zip(records, recommendations)]
+
+
+@app.post("/get_recommendations_batch/")
+async def fetch_recommendations_batch(batch: batch_recommendations_schema):
+    """
+    ** Description: ** <em> Given many user records, generate recommendations for all of them. Users are grouped by
+    country so retrieval and feature work is shared within a group, results are streamed back as NDJSON (one line per
+    user) as soon as their country group is ranked </em>
+
+    Args:
+        batch (dict): a list of user records in the `/get_recommendations/` format
+
+    Returns:
+        (StreamingResponse): NDJSON lines of {"user_id", "user_country", "recommendations"}
+    """
+    if not service_ready:
+        raise HTTPException(status_code=503, detail="models are still loading")
+    if len(batch.records) > config["batch_recommendations"]["max_records"]:
+        requests_total.inc(1, "get_recommendations_batch", "too_large")
+        raise HTTPException(status_code=413, detail=f"at most {config['batch_recommendations']['max_records']} "
+                                                    f"records per batch")
+    # requests without a user are answered from the cold start rankings like `/get_recommendations/`
+    precomputed, groups = [], defaultdict(list)
+    for record in batch.dict()["records"]:
+        recommendations = precomputed_cold_start(record)
+        if recommendations is not None:
+            precomputed.append({"user_id": "", "user_country": record["user_country"],
+                                "recommendations": recommendations})
+        else:
+            groups[record["user_country"]].append(record)
+    record_payload("batch_users", len(batch.records))
+
+    async def stream():
+        # a span, not a trace, the generator may be resumed outside the context the trace was opened in
+        with tracer.span("get_recommendations_batch"):
+            tasks = [asyncio.ensure_future(recommend_country_group(user_country, records))
+                     for user_country, records in groups.items()]
+            # the status is only known once every line is sent, the response has started before
+            status = "error"
+            try:
+                for line in precomputed:
+                    yield json.dumps(line) + "\n"
+                for task in asyncio.as_completed(tasks):
+                    for line in await task:
+                        yield json.dumps(line) + "\n"
+                status = "ok"
+            except (asyncio.CancelledError, GeneratorExit):
+                # the client went away before the end of the stream
+                status = "cancelled"
+                raise
+            finally:
+                for task in tasks:
+                    task.cancel()
+                requests_total.inc(1, "get_recommendations_batch", status)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 
 if __name__ == "__main__":
     uvicorn.run("internal_reco_api:app", host="0.0.0.0", port=8000, log_level="info")
@@ -0,0 +1,43 @@
+## Converts pickled boosters to XGBoost's UBJSON model format, which the service loads without unpickling
+##   python jobs/convert_models.py ranking/models/asset_user_model_gpu.pkl ranking/models/cold_start_model_gpu.pkl
+## writes <name>.ubj next to every input and checks that the converted model predicts exactly the same
+## run it with the XGBoost version that pickled the models, then point model_name / cold_start_model_name
+## (config.yml) to the .ubj files
+
+import warnings
+warnings.filterwarnings("ignore")
+import pickle
+import argparse
+from pathlib import Path
+
+import numpy as np
+import xgboost as xgb
+
+
+def convert(path):
+    """
+    ** Description: ** <em> It saves a pickled booster as UBJSON and compares predictions on random rows </em>
+
+    Args:
+        path (Path): pickled model
+
+    Returns:
+        (Path): the converted model file
+    """
+    with open(path, "rb") as f:
+        booster = pickle.load(f)
+    output = path.with_suffix(".ubj")
+    booster.save_model(str(output))
+    converted = xgb.Booster(model_file=str(output))
+    features = np.random.default_rng(0).random((10000, booster.num_features()), dtype=np.float32)
+    if not np.array_equal(booster.inplace_predict(features), converted.inplace_predict(features)):
+        raise ValueError(f"{output} does not predict like {path}")
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", nargs="+", type=Path, help="pickled boosters")
+    args = parser.parse_args()
+    for path in args.models:
+        print(f"{path} -> {convert(path)}")
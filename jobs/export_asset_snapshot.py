@@ -0,0 +1,111 @@
+## Exports every asset hash (or vector, see feature_encoding in config.yml) of the feature store into a memory-mappable
+## snapshot file
+##   python jobs/export_asset_snapshot.py --output snapshots/asset_features.bin
+## run it on a schedule (cron, k8s CronJob) next to the workers, they pick the new file up within
+## asset_feature_snapshot.check_seconds (config.yml)
+
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import redis
+import numpy as np
+from logzero import logger
+from dotenv import load_dotenv
+from more_itertools import chunked
+
+from utils import load_config
+from retrieval.src.asset_feature_snapshot import write_snapshot
+from retrieval.src.feature_codec import FeatureCodec, schema_key
+
+load_dotenv("./.env")
+KEY_PREFIX = "recommendations_preprocessing"
+
+
+def export_asset_features(asset_fs, columns, batch_size):
+    """
+    ** Description: ** <em> It scans the asset hashes of the feature store and reads them with pipelined `hgetall`,
+    `batch_size` keys per round trip </em>
+
+    Args:
+        asset_fs (redis.StrictRedis): asset feature store, with decode_responses
+        columns (list): asset feature names, in the column order of the matrix
+        batch_size (int): keys per scan page and per pipeline
+
+    Returns:
+        (tuple): lomotif ids and the float32 matrix of their features, NaN for missing values
+    """
+    ids, chunks = [], []
+    prefix = KEY_PREFIX + "_asset:"
+    for n, keys in enumerate(chunked(asset_fs.scan_iter(match=prefix + "*", count=batch_size), batch_size), 1):
+        pipe = asset_fs.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        records = pipe.execute()
+        chunks.append(np.array([[float(record.get(column, "nan")) for column in columns] for record in records],
+                               dtype=np.float32).reshape(len(records), len(columns)))
+        ids.extend(key[len(prefix):] for key in keys)
+        if n % 100 == 0:
+            logger.info(f"Read {len(ids)} assets")
+    values = np.concatenate(chunks) if chunks else np.empty((0, len(columns)), dtype=np.float32)
+    return ids, values
+
+
+def export_asset_vectors(asset_fs, columns, batch_size):
+    """
+    ** Description: ** <em> It scans the asset vectors of the feature store and reads them with `MGET`, `batch_size`
+    keys per round trip </em>
+
+    Args:
+        asset_fs (redis.StrictRedis): asset feature store, without decode_responses
+        columns (list): asset feature names, in the column order of the matrix
+        batch_size (int): keys per scan page and per MGET
+
+    Returns:
+        (tuple): lomotif ids and the float32 matrix of their features, NaN for missing values
+    """
+    codec = FeatureCodec("asset", columns)
+    ids, chunks = [], []
+    prefix = codec.key("")
+    for n, keys in enumerate(chunked(asset_fs.scan_iter(match=prefix + "*", count=batch_size), batch_size), 1):
+        blobs = asset_fs.mget(keys)
+        for fingerprint in codec.unknown_fingerprints(blobs):
+            schema = asset_fs.get(schema_key("asset", fingerprint))
+            codec.add_schema(fingerprint, None if schema is None else json.loads(schema))
+        chunks.append(codec.decode_many(blobs)[0])
+        ids.extend(key.decode()[len(prefix):] for key in keys)
+        if n % 100 == 0:
+            logger.info(f"Read {len(ids)} assets")
+    values = np.concatenate(chunks) if chunks else np.empty((0, len(columns)), dtype=np.float32)
+    return ids, values
+
+
+if __name__ == "__main__":
+    config = load_config("config.yml")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=config["asset_feature_snapshot"]["path"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--encoding", choices=["hash", "vector"],
+                        help="vector unless feature_encoding.read in config.yml is hash")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    encoding = args.encoding or ("hash" if config["feature_encoding"]["read"] == "hash" else "vector")
+    asset_fs = redis.StrictRedis(host=os.environ["REDIS_IP"],
+                                 port=os.environ["REDIS_PORT"],
+                                 db=os.environ["ASSET_FS_DB"],
+                                 decode_responses=encoding == "hash")
+    if encoding == "hash":
+        ids, values = export_asset_features(asset_fs, config["asset_features"], args.batch_size)
+    else:
+        ids, values = export_asset_vectors(asset_fs, config["asset_features"], args.batch_size)
+    n_rows = write_snapshot(args.output, ids, values, config["asset_features"])
+    logger.info(f"Wrote {n_rows} assets ({os.path.getsize(args.output)} bytes) to {args.output} "
+                f"in {time.time() - start_time:.1f}s")
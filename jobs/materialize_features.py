@@ -0,0 +1,284 @@
+## Materializes the feature store hashes the service reads from parquet tables
+##   python jobs/materialize_features.py asset s3://bucket/asset_features/
+##   python jobs/materialize_features.py user data/user_features/ --concurrency 16 --categorify user_country
+## The table (a file or a directory of files) is streamed in record batches, so user tables larger than memory are
+## fine. Every row becomes the hash recommendations_preprocessing_<entity>:<id> with one field per feature, written
+## with pipelined HSET from `concurrency` connections at once. Columns passed to --categorify are encoded like
+## `ranking.src.utils.categorify` and written as <column>_Categorify fields. With --encoding vector (or both) every row
+## is (also) written as a packed float32 vector, recommendations_preprocessing_<entity>_f32:<id>, see
+## retrieval/src/feature_codec.py
+
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import numpy as np
+import redis.asyncio as redis
+from logzero import logger
+from dotenv import load_dotenv
+from more_itertools import chunked
+
+from utils import load_config
+from ranking.src.utils import StreamingCategorify
+from retrieval.src.feature_codec import FeatureCodec
+
+load_dotenv("./.env")
+KEY_PREFIX = "recommendations_preprocessing"
+# id column, feature list in config.yml and feature store db of every entity
+ENTITIES = {"asset": ("lomotif_id", "asset_features", "ASSET_FS_DB"),
+            "user": ("user_id", "user_features", "USER_FS_DB")}
+
+
+class Progress:
+    def __init__(self, total_rows, interval_seconds=10) -> None:
+        """
+        ** Description: ** <em> Rows read and written, logged with the write throughput every `interval_seconds` </em>
+        """
+        self.total_rows = total_rows
+        self.interval_seconds = interval_seconds
+        self.read = 0
+        self.written = 0
+        self.start = time.monotonic()
+        self._logged_at = self.start
+
+    def add_written(self, rows):
+        self.written += rows
+        now = time.monotonic()
+        if now - self._logged_at >= self.interval_seconds:
+            self._logged_at = now
+            self.log()
+
+    def log(self):
+        elapsed = time.monotonic() - self.start
+        logger.info(f"Wrote {self.written} of {self.total_rows} rows ({100.0 * self.written / max(self.total_rows, 1):.1f}%), "
+                    f"read {self.read}, {self.written / max(elapsed, 1e-9):.0f} rows/s")
+
+
+def iter_batches(source, columns, batch_rows):
+    """
+    ** Description: ** <em> It streams the columns of a parquet file or directory in record batches, only one batch per
+    file is held in memory at a time </em>
+
+    Args:
+        source (str): parquet file or directory, local or s3://
+        columns (list): columns to read
+        batch_rows (int): largest number of rows in a batch
+
+    Returns:
+        (iterator): pyarrow record batches
+    """
+    return ds.dataset(source, format="parquet").to_batches(columns=columns, batch_size=batch_rows)
+
+
+def fit_encoders(source, categorify, batch_rows, freq_treshhold):
+    """
+    ** Description: ** <em> First pass over the categorical columns only, it counts their values and assigns the codes </em>
+
+    Args:
+        source (str): parquet file or directory
+        categorify (list): categorical columns
+        batch_rows (int): largest number of rows in a batch
+        freq_treshhold (int): values seen fewer times get the low frequency code
+
+    Returns:
+        (dict): fitted `StreamingCategorify` per column
+    """
+    encoders = {column: StreamingCategorify(column, freq_treshhold=freq_treshhold) for column in categorify}
+    for batch in iter_batches(source, categorify, batch_rows):
+        for encoder in encoders.values():
+            encoder.observe(batch)
+    return encoders
+
+
+def hset_commands(batch, prefix, id_column, columns, encoders):
+    """
+    ** Description: ** <em> It turns a record batch into HSET commands. Every column is cast to strings by pyarrow in one
+    call, null values are left out of the hash (the service reads missing fields as NaN) and rows without an id are
+    skipped </em>
+
+    Args:
+        batch (pa.RecordBatch): rows of the table
+        prefix (str): key prefix, e.g. recommendations_preprocessing_user:
+        id_column (str): column holding the entity id
+        columns (list): feature columns written as they are
+        encoders (dict): `StreamingCategorify` of the categorical columns
+
+    Returns:
+        (list): (key, mapping) of every row
+    """
+    names = list(columns) + [column + "_Categorify" for column in encoders]
+    values = [pc.cast(batch.column(column), pa.string()).to_pylist() for column in columns]
+    values += [[str(code) for code in encoder.encode(batch).tolist()] for encoder in encoders.values()]
+    ids = pc.cast(batch.column(id_column), pa.string()).to_pylist()
+    return [(prefix + entity_id, {name: value for name, value in zip(names, row) if value is not None})
+            for entity_id, *row in zip(ids, *values) if entity_id is not None]
+
+
+def vector_commands(batch, codec, id_column, columns, encoders):
+    """
+    ** Description: ** <em> It turns a record batch into SET commands of packed float32 vectors in `codec.columns`
+    order, null values are stored as NaN and rows without an id are skipped </em>
+
+    Args:
+        batch (pa.RecordBatch): rows of the table
+        codec (FeatureCodec): codec of the entity, its columns are `columns` followed by the categorical columns
+        id_column (str): column holding the entity id
+        columns (list): numeric feature columns
+        encoders (dict): `StreamingCategorify` of the categorical columns
+
+    Returns:
+        (list): (key, vector) of every row
+    """
+    values = np.empty((batch.num_rows, len(codec.columns)), dtype=np.float32)
+    for j, column in enumerate(columns):
+        values[:, j] = pc.cast(batch.column(column), pa.float32()).to_numpy(zero_copy_only=False)
+    for j, encoder in enumerate(encoders.values(), len(columns)):
+        values[:, j] = encoder.encode(batch)
+    ids = pc.cast(batch.column(id_column), pa.string()).to_pylist()
+    return [(codec.key(entity_id), vector) for entity_id, vector in zip(ids, codec.encode_many(values))
+            if entity_id is not None]
+
+
+async def write_commands(fs, commands, retries):
+    """
+    ** Description: ** <em> It sends one pipeline of HSET (hashes) and SET (vectors) commands, both are idempotent so a
+    failed pipeline is sent again up to `retries` times </em>
+    """
+    for attempt in range(retries + 1):
+        try:
+            pipe = fs.pipeline(transaction=False)
+            for key, value in commands:
+                if isinstance(value, bytes):
+                    pipe.set(key, value)
+                else:
+                    pipe.hset(key, mapping=value)
+            await pipe.execute()
+            return
+        except (redis.ConnectionError, redis.TimeoutError):
+            if attempt == retries:
+                raise
+            logger.info(f"Pipeline of {len(commands)} commands failed, retrying ({attempt + 1}/{retries})")
+            await asyncio.sleep(2 ** attempt)
+
+
+async def materialize(fs, batches, prefix, id_column, columns, encoders, pipeline_size, concurrency, progress,
+                      codec=None, write_hashes=True, retries=3):
+    """
+    ** Description: ** <em> It writes the rows of every batch to the feature store. Batches are read in a thread while
+    `concurrency` writers each keep one pipeline of `pipeline_size` commands in flight. The queue between them is
+    bounded, so reading waits for the writers and memory stays flat whatever the size of the table </em>
+
+    Args:
+        fs (redis.StrictRedis): feature store of the entity
+        batches (iterator): record batches, see `iter_batches`
+        prefix (str): key prefix
+        id_column (str): column holding the entity id
+        columns (list): feature columns
+        encoders (dict): fitted `StreamingCategorify` per categorical column
+        pipeline_size (int): HSET commands per pipeline
+        concurrency (int): pipelines in flight
+        progress (Progress): read and written rows
+        codec (FeatureCodec): also writes every row as a vector when given
+        write_hashes (bool): whether rows are written as hashes
+        retries (int): attempts of a failed pipeline
+    """
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+
+    async def writer():
+        while True:
+            commands = await queue.get()
+            if commands is None:
+                return
+            await write_commands(fs, commands, retries)
+            progress.add_written(sum(1 for _, value in commands if not isinstance(value, bytes))
+                                 if write_hashes else len(commands))
+
+    async def reader():
+        iterator = iter(batches)
+        while True:
+            # decoding parquet happens off the event loop, the writers keep sending meanwhile
+            batch = await asyncio.to_thread(next, iterator, None)
+            if batch is None:
+                break
+            progress.read += batch.num_rows
+            commands = []
+            if write_hashes:
+                commands += hset_commands(batch, prefix, id_column, columns, encoders)
+            if codec is not None:
+                commands += vector_commands(batch, codec, id_column, columns, encoders)
+            for chunk in chunked(commands, pipeline_size):
+                await queue.put(chunk)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    await asyncio.gather(reader(), *[writer() for _ in range(concurrency)])
+
+
+async def main(args):
+    config = load_config("config.yml")
+    id_column, feature_list, db_variable = ENTITIES[args.entity]
+    id_column = args.id_column or id_column
+    columns = args.columns or config[feature_list]
+    start_time = time.time()
+
+    encoders = {}
+    if args.categorify:
+        encoders = fit_encoders(args.source, args.categorify, args.batch_rows, args.freq_threshold)
+        for column, encoder in encoders.items():
+            vocabulary = encoder.fit()
+            logger.info(f"Categorify {column}: {len(vocabulary)} values")
+            if args.vocabulary_dir:
+                os.makedirs(args.vocabulary_dir, exist_ok=True)
+                pq.write_table(vocabulary, os.path.join(args.vocabulary_dir, f"{column}.parquet"))
+
+    progress = Progress(ds.dataset(args.source, format="parquet").count_rows())
+    fs = redis.StrictRedis(connection_pool=redis.BlockingConnectionPool(host=os.environ["REDIS_IP"],
+                                                                        port=os.environ["REDIS_PORT"],
+                                                                        db=os.environ[db_variable],
+                                                                        decode_responses=True,
+                                                                        max_connections=args.concurrency))
+    encoding = args.encoding or config["feature_encoding"]["write"]
+    codec = None
+    if encoding in ("vector", "both"):
+        codec = FeatureCodec(args.entity, list(columns) + [column + "_Categorify" for column in encoders])
+    try:
+        if codec is not None:
+            # readers map vectors of other feature lists by name through the published schema
+            await fs.set(*codec.schema_record())
+        await materialize(fs, iter_batches(args.source, list(dict.fromkeys([id_column, *columns, *encoders])), args.batch_rows),
+                          f"{KEY_PREFIX}_{args.entity}:", id_column, columns, encoders,
+                          pipeline_size=args.pipeline_size, concurrency=args.concurrency, progress=progress,
+                          codec=codec, write_hashes=encoding in ("hash", "both"))
+    finally:
+        await fs.aclose()
+    progress.log()
+    logger.info(f"Materialized {progress.written} {args.entity} rows ({encoding}) in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("entity", choices=sorted(ENTITIES))
+    parser.add_argument("source", help="parquet file or directory, local or s3://")
+    parser.add_argument("--id-column", help="lomotif_id for assets and user_id for users by default")
+    parser.add_argument("--columns", nargs="+", help="asset_features / user_features of config.yml by default")
+    parser.add_argument("--categorify", nargs="+", default=[], help="categorical columns written as <column>_Categorify")
+    parser.add_argument("--freq-threshold", type=int, default=20)
+    parser.add_argument("--vocabulary-dir", help="write the value to code mapping of every categorical column here")
+    parser.add_argument("--batch-rows", type=int, default=65536, help="rows per record batch read from parquet")
+    parser.add_argument("--pipeline-size", type=int, default=2000, help="HSET commands per pipeline")
+    parser.add_argument("--concurrency", type=int, default=8, help="pipelines in flight")
+    parser.add_argument("--encoding", choices=["hash", "vector", "both"],
+                        help="feature_encoding.write of config.yml by default")
+    args = parser.parse_args()
+    asyncio.run(main(args))
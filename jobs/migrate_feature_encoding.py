@@ -0,0 +1,105 @@
+## Writes a packed float32 vector next to every feature hash of the feature store (retrieval/src/feature_codec.py)
+##   python jobs/migrate_feature_encoding.py asset
+##   python jobs/migrate_feature_encoding.py user --drop-hashes    # once every worker reads feature_encoding: vector
+## Hashes are scanned and read with pipelined HGETALL, `batch_size` keys per round trip, and their vectors written with
+## pipelined SET. Running it again rewrites the vectors from the current hashes, so it can be repeated until the
+## writers (jobs/materialize_features.py --encoding both) cover every key
+
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import redis.asyncio as redis
+from logzero import logger
+from dotenv import load_dotenv
+
+from utils import load_config
+from retrieval.src.feature_codec import KEY_PREFIX, FeatureCodec
+
+load_dotenv("./.env")
+# feature list in config.yml and feature store db of every entity
+ENTITIES = {"asset": ("asset_features", "ASSET_FS_DB"), "user": ("user_features", "USER_FS_DB")}
+
+
+async def migrate(fs, codec, batch_size, drop_hashes=False):
+    """
+    ** Description: ** <em> It encodes every hash of the entity as a vector. Fields missing from a hash become NaN,
+    fields that are not in `codec.columns` are not migrated </em>
+
+    Args:
+        fs (redis.StrictRedis): feature store of the entity, with decode_responses
+        codec (FeatureCodec): codec of the entity
+        batch_size (int): keys per scan page and per pipeline
+        drop_hashes (bool): delete every hash once its vector is written
+
+    Returns:
+        (int): number of migrated keys
+    """
+    prefix = f"{KEY_PREFIX}_{codec.entity}:"
+    await fs.set(*codec.schema_record())
+    migrated = 0
+
+    async def write(keys):
+        async with fs.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            records = await pipe.execute()
+        values = np.array([[float(record.get(column, "nan")) for column in codec.columns] for record in records],
+                          dtype=np.float32).reshape(len(records), len(codec.columns))
+        async with fs.pipeline(transaction=False) as pipe:
+            for key, vector in zip(keys, codec.encode_many(values)):
+                pipe.set(codec.key(key[len(prefix):]), vector)
+                if drop_hashes:
+                    pipe.delete(key)
+            await pipe.execute()
+
+    # keys are migrated page by page as the scan returns them, the key space is never held in memory
+    keys = []
+    async for key in fs.scan_iter(match=prefix + "*", count=batch_size):
+        keys.append(key)
+        if len(keys) == batch_size:
+            await write(keys)
+            migrated += len(keys)
+            keys = []
+            if migrated % (100 * batch_size) == 0:
+                logger.info(f"Migrated {migrated} {codec.entity} hashes")
+    if keys:
+        await write(keys)
+        migrated += len(keys)
+    return migrated
+
+
+async def main(args):
+    config = load_config("config.yml")
+    feature_list, db_variable = ENTITIES[args.entity]
+    codec = FeatureCodec(args.entity, args.columns or config[feature_list])
+    start_time = time.time()
+    fs = redis.StrictRedis(host=os.environ["REDIS_IP"],
+                           port=os.environ["REDIS_PORT"],
+                           db=os.environ[db_variable],
+                           decode_responses=True)
+    try:
+        migrated = await migrate(fs, codec, args.batch_size, drop_hashes=args.drop_hashes)
+    finally:
+        await fs.aclose()
+    logger.info(f"Migrated {migrated} {args.entity} hashes to {codec.nbytes} byte vectors "
+                f"{'and dropped the hashes ' if args.drop_hashes else ''}in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("entity", choices=sorted(ENTITIES))
+    parser.add_argument("--columns", nargs="+", help="asset_features / user_features of config.yml by default")
+    parser.add_argument("--batch-size", type=int, default=1000, help="keys per scan page and per pipeline")
+    parser.add_argument("--drop-hashes", action="store_true",
+                        help="delete the hashes, only once no worker reads feature_encoding hash or dual")
+    args = parser.parse_args()
+    asyncio.run(main(args))
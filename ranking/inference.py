@@ -1,81 +1,279 @@
 import warnings
 warnings.filterwarnings("ignore")
+import os
+import time
 import pickle
-import xgboost as xgb 
+from pathlib import Path
+from typing import NamedTuple
 # from ranking.src.utils import load_config
 
 from logzero import logger
 import traceback
-import pandas as pd
-import yaml
+import numpy as np
+from utils import get_config, ranking_threads
 
-def load_config(file_path):
+
+def load_booster(path):
+    """
+    ** Description: ** <em> It loads a model saved with `Booster.save_model` (.ubj, .json or the legacy binary .model).
+    Pickled boosters are still accepted but load slower and depend on the XGBoost version that pickled them, convert
+    them with `jobs/convert_models.py` </em>
+
+    Args:
+        path (str): model file
+    Returns:
+        (xgb.Booster): the loaded model
+    """
+    # imported here, xgboost (and the pandas it pulls in) is only needed once the models are loaded
+    import xgboost as xgb
+    if Path(path).suffix == ".pkl":
+        logger.warning(f"Loading pickled model {path}, convert it with jobs/convert_models.py")
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return xgb.Booster(model_file=str(path))
+
+
+def resolve_model_path(path):
+    """
+    ** Description: ** <em> It returns the file a model name refers to. A converted model (.ubj, .json, .model) that
+    is not deployed yet falls back to the pickle of the same name, so config.yml can name the converted files before
+    every deploy ships them </em>
+
+    Args:
+        path (str): model file named in config.yml
+    Returns:
+        (str): the file to load, `path` itself when it exists or has no pickle to fall back to
     """
-    ** Description: ** <em> It opens the file at the given path, reads the contents, and parses the contents as a YAML file </em>
-    
+    pickled = Path(path).with_suffix(".pkl")
+    if not os.path.exists(path) and Path(path).suffix != ".pkl" and pickled.exists():
+        # the model watcher resolves the names on every check, `load_booster` warns when the pickle is loaded
+        return str(pickled)
+    return path
+
+
+def model_identity(path):
+    """
+    ** Description: ** <em> It identifies the current content of a model file, a file replaced or rewritten in place
+    gets a new identity </em>
+
     Args:
-        file_path (str): The path to the YAML file
+        path (str): model file
     Returns:
-        (dict): A dictionary
+        (tuple): inode, modification time and size of the file
+    """
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class ModelSet(NamedTuple):
+    """
+    ** Description: ** <em> The full and the cold start model that are served together. A set is fully loaded, prepared
+    and warmed up before it is published with a single reference assignment, a request reads the reference once and
+    scores with one consistent set </em>
     """
-    with open(file_path, 'r') as f:
-        cfg = yaml.safe_load(f)
-    return cfg
+    model: object
+    cold_start_model: object
+    names: dict
+    identities: dict
+    loaded_at: float
 
-config = load_config("config.yml")
 
 class GetRecommendations:
-    def __init__(self):
+    def __init__(self, load=True):
         """
         ** Description: ** <em> It loads the model and the cold start model from the model path and model name specified in the
-        config file </em>
+        config file. With `load=False` nothing is loaded until `load_models` is called, so the service can start
+        accepting connections while the models load. A second set of models can be loaded as `shadow_models`, they are
+        never served, see `ranking.src.shadow.ShadowScorer` </em>
+
+        Args:
+            load (bool): whether to load the models right away
+        """
+        self.config = get_config()
+        self.prediction_columns = self.config["prediction_features"]
+        self.cold_start_columns = self.config["cold_start_features"]
+        self.models = None
+        self.shadow_models = None
+        if load:
+            self.load_models()
+
+    @property
+    def model(self):
+        return None if self.models is None else self.models.model
+
+    @property
+    def cold_start_model(self):
+        return None if self.models is None else self.models.cold_start_model
+
+    def load_model_set(self, model_name, cold_start_model_name):
+        """
+        ** Description: ** <em> It loads a full and a cold start model from the model path, sets their thread count and
+        flattens them for the tree predictor backend. Nothing served is touched </em>
+
+        Args:
+            model_name (str): file name of the full model, None to leave it out
+            cold_start_model_name (str): file name of the cold start model, None to leave it out
+        Returns:
+            (ModelSet): the prepared models
+        """
+        config = self.config
+        names = {"model": model_name, "cold_start_model": cold_start_model_name}
+        models, identities = {}, {}
+        for role, name in names.items():
+            if name is None:
+                models[role] = None
+                continue
+            if Path(name).name != name:
+                raise ValueError(f"model name {name!r} is not a file name in {config['model_path']}")
+            path = resolve_model_path(config["model_path"] + name)
+            logger.info(f"Loading {role} {path}")
+            identities[role] = model_identity(path)
+            booster = load_booster(path)
+            # every predict runs on at most this many threads, requests are parallelised by the ranking executor
+            booster.set_param({"nthread": ranking_threads(config)[1]})
+            if config["ranking_backend"] == "tree_predictor":
+                # imported here, numba is only loaded when this backend is used
+                from ranking.src.tree_predictor import TreePredictor
+                booster = TreePredictor.from_booster(booster)
+            models[role] = booster
+            logger.info(f"{role} {name} successfully loaded")
+        return ModelSet(models["model"], models["cold_start_model"], names, identities, time.time())
+
+    def load_models(self):
+        """
+        ** Description: ** <em> It loads the models named in the config file and serves them </em>
+
+        Returns:
+            (bool): whether both models were loaded
         """
         try:
-            logger.info("Loading Recommendation Model")
-            self.model = pickle.load(open(config["model_path"] + config["model_name"], "rb"))
-            logger.info("ML model successfully loaded")
-            logger.info("Loading cold start Model")
-            self.cold_start_model = pickle.load(open(config["model_path"] + config["cold_start_model_name"], "rb"))
-            logger.info("ML model successfully loaded")
-            self.prediction_columns = config["prediction_features"]
-            self.cold_start_columns = config["cold_start_features"]
+            self.models = self.load_model_set(self.config["model_name"], self.config["cold_start_model_name"])
+            return True
         except:
-            logger.info(f"Couldnt load Recommendation model: {traceback.print_exc()}" )
-            
-    def generate_recommendations(self, candidate_set):
+            logger.info(f"Couldnt load Recommendation model: {traceback.format_exc()}" )
+            return False
+
+    def warmup(self, n_rows, models=None):
+        """
+        ** Description: ** <em> It runs predictions on synthetic rows with both models, for a single row and for
+        `n_rows` rows, so lazily initialised predictor state (and the compiled tree kernel) is ready before the first
+        request </em>
+
+        Args:
+            n_rows (int): rows of the larger warmup batch
+            models (ModelSet): models to warm up, the served ones by default
+        """
+        models = models or self.models
+        rng = np.random.default_rng(0)
+        for model, columns in ((models.model, self.prediction_columns),
+                               (models.cold_start_model, self.cold_start_columns)):
+            if model is None:
+                continue
+            for rows in (1, n_rows):
+                features = rng.random((rows, len(columns)), dtype=np.float32)
+                features[rng.random(features.shape) < 0.05] = np.nan
+                model.inplace_predict(features)
+
+    @staticmethod
+    def top_k(ids, scores, k):
+        """
+        ** Description: ** <em> It selects the k highest scoring ids with a partial selection, only the selected k are
+        sorted </em>
+
+        Args:
+            ids (np.ndarray): lomotif ids
+            scores (np.ndarray): score of every id
+            k (int): number of ids to return
+
+        Returns:
+            (list): k lomotif ids sorted by score, highest first
+        """
+        if k < len(scores):
+            selected = np.argpartition(-scores, k - 1)[:k]
+        else:
+            selected = np.arange(len(scores))
+        selected = selected[np.argsort(-scores[selected], kind="stable")]
+        return ids[selected].tolist()
+
+    def predict(self, candidate_set):
+        """
+        ** Description: ** <em> It scores the candidate matrix with in-place prediction, using the full model when user
+        features are present and the cold start model otherwise </em>
+
+        Args:
+            candidate_set (FeatureBatch): model input, see `retrieval.src.get_feat_from_fs.build_feature_batch`
+
+        Returns:
+            (np.ndarray): predicted probability of every row
+        """
+        return self.select_model(candidate_set.columns).inplace_predict(candidate_set.features)
+
+    def select_model(self, columns, models=None):
+        """
+        ** Description: ** <em> It returns the full model for `prediction_features` input and the cold start model otherwise </em>
+
+        Args:
+            columns (list): column order of the model input
+            models (ModelSet): set to pick from, the served models by default
+
+        Returns:
+            (xgb.Booster): the model scoring this input
+        """
+        models = models or self.models
+        if list(columns) == self.prediction_columns:
+            logger.debug("using full model")
+            return models.model
+        logger.debug("using coldstart model")
+        return models.cold_start_model
+
+    def generate_recommendations(self, candidate_set, k = 10):
         """
         ** Description: ** <em> If the user has a user vector, then we use the trained model to predict the scores for the
         candidate set. If the user doesn't have a user vector, then we use the cold start model to
         predict the scores for the candidate set </em>
         
         Args:
-            candidate_set (pd.DataFrame): This is the set of items that we want to generate recommendations for
+            candidate_set (FeatureBatch): This is the set of items that we want to generate recommendations for, \
+            see `retrieval.src.get_feat_from_fs.build_feature_batch`
+            k (int): number of lomotif ids to return
         Returns:
-            (list): a list of 10 lomotif_ids to be recommended in sorted probability order (e.g. highest probability lomotif_id will be ranked at the top) 
+            (list): a list of k lomotif_ids to be recommended in sorted probability order (e.g. highest probability lomotif_id will be ranked at the top). \
+            Prediction errors are raised, the API serves a fallback for them
         """
-        try:
-            logger.info("Making predictions")
-            if "user_vv" in candidate_set.columns:
-                logger.info("using full model")
-                candidate_set = candidate_set[["lomotif_id"] + self.prediction_columns]
-                candidate_set[self.prediction_columns] = candidate_set[self.prediction_columns].astype("float")
-                dtest = xgb.DMatrix(data=candidate_set[self.prediction_columns], enable_categorical = True)
-                self.test_res = self.model.predict(dtest)
-                candidate_set["predictions"] = self.test_res
-                # logger.info(candidate_set[["lomotif_id", "predictions"]].dropna().sort_values("predictions", ascending = False).reset_index(drop = True))
-                recommendations = candidate_set[["lomotif_id", "predictions"]].dropna().sort_values("predictions", ascending = False).reset_index(drop = True)["lomotif_id"][:10].tolist()
-                return recommendations
-            else:
-                logger.info("using coldstart model")
-                candidate_set[self.cold_start_columns] = candidate_set[self.cold_start_columns].astype("float")
-                dtest = xgb.DMatrix(data=candidate_set[self.cold_start_columns], enable_categorical = True)
-                self.test_res = self.cold_start_model.predict(dtest)
-                candidate_set["predictions"] = self.test_res
-                recommendations = candidate_set[["lomotif_id", "predictions"]].dropna().sort_values("predictions", ascending = False).reset_index(drop = True)["lomotif_id"][:10].tolist()
-                return recommendations
-        except:
-            logger.info(f"Couldnt Generate recommendations: {traceback.print_exc()}" )
-            
+        logger.debug("Making predictions")
+        if len(candidate_set.ids) == 0:
+            return []
+        test_res = self.predict(candidate_set)
+        return self.top_k(candidate_set.ids, test_res, k)
+
+    def generate_recommendations_batch(self, candidate_sets, ks):
+        """
+        ** Description: ** <em> It generates recommendations for many users at once. The inputs of all users scored by the
+        same model are stacked and scored in a single predict call, the scores are then split back per user </em>
+
+        Args:
+            candidate_sets (list): `FeatureBatch` of every user, None for users without candidates
+            ks (list): number of lomotif ids to return for every user
+
+        Returns:
+            (list): a list of recommendations (list of lomotif ids) per user, empty for users without candidates. \
+            Prediction errors are raised
+        """
+        recommendations = [[] for _ in candidate_sets]
+        # read once, a reload in the middle of the batch does not mix models
+        models = self.models
+        scored = [i for i, batch in enumerate(candidate_sets) if batch is not None and len(batch.ids) > 0]
+        for columns in (self.prediction_columns, self.cold_start_columns):
+            members = [i for i in scored if list(candidate_sets[i].columns) == columns]
+            if not members:
+                continue
+            features = np.concatenate([candidate_sets[i].features for i in members])
+            test_res = self.select_model(columns, models).inplace_predict(features)
+            offsets = np.cumsum([0] + [len(candidate_sets[i].ids) for i in members])
+            for n, i in enumerate(members):
+                recommendations[i] = self.top_k(candidate_sets[i].ids, test_res[offsets[n]:offsets[n + 1]], ks[i])
+        return recommendations
+
 
 # if __name__ == "__main__":
 #     # data = cd.read_parquet(config["preprocessed_data_path"] + config["preprocessed_file_name"], engine= "parquet")
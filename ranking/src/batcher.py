@@ -0,0 +1,95 @@
+import asyncio
+import traceback
+
+import numpy as np
+from logzero import logger
+
+# upper bounds of the rows per combined predict, powers of two up to well above `max_batch_rows`
+BATCH_ROWS_BUCKETS = tuple(1 << i for i in range(15))
+
+
+class PredictionBatcher:
+    def __init__(self, reco, executor, max_wait_ms, max_batch_rows) -> None:
+        """
+        ** Description: ** <em> Dynamic batching in front of `GetRecommendations`. Scoring work of concurrent requests is
+        collected per model (full or cold start) for at most `max_wait_ms` or until `max_batch_rows` rows are waiting,
+        scored with one combined predict in the ranking executor and the scores are handed back to every waiting
+        request </em>
+
+        Args:
+            reco (GetRecommendations): owner of the models
+            executor (concurrent.futures.Executor): executor the combined predict runs in
+            max_wait_ms (float): longest time the first request of a batch waits for others to join
+            max_batch_rows (int): a batch is scored as soon as this many rows are waiting
+        """
+        self.reco = reco
+        self.executor = executor
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_rows = max_batch_rows
+        self._pending = {}
+        self._pending_rows = {}
+        self._timers = {}
+        self.stats = {"batches": 0, "requests": 0, "rows": 0, "max_rows": 0, "errors": 0}
+        # rows of every combined predict, a `serving.metrics.Histogram` with `BATCH_ROWS_BUCKETS` set by the service
+        self.rows_histogram = None
+
+    async def predict(self, candidate_set):
+        """
+        ** Description: ** <em> It scores one request's model input as part of the next batch of its model </em>
+
+        Args:
+            candidate_set (FeatureBatch): model input, see `retrieval.src.get_feat_from_fs.build_feature_batch`
+
+        Returns:
+            (np.ndarray): predicted probability of every row
+        """
+        if len(candidate_set.features) == 0:
+            return np.empty(0, dtype=np.float32)
+        loop = asyncio.get_running_loop()
+        key = tuple(candidate_set.columns)
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append((candidate_set.features, future))
+        self._pending_rows[key] = self._pending_rows.get(key, 0) + len(candidate_set.features)
+        if self._pending_rows[key] >= self.max_batch_rows:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        items = self._pending.pop(key, [])
+        self._pending_rows.pop(key, None)
+        if items:
+            asyncio.ensure_future(self._run(key, items))
+
+    async def _run(self, key, items):
+        features = np.concatenate([item_features for item_features, _ in items])
+        try:
+            model = self.reco.select_model(key)
+            loop = asyncio.get_running_loop()
+            test_res = await loop.run_in_executor(self.executor, model.inplace_predict, features)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.info(f"Batched prediction failed: {traceback.format_exc()}")
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self._record(len(items), len(features))
+        offset = 0
+        for item_features, future in items:
+            # requests that were cancelled while waiting simply drop their share
+            if not future.done():
+                future.set_result(test_res[offset:offset + len(item_features)])
+            offset += len(item_features)
+
+    def _record(self, n_requests, n_rows):
+        self.stats["batches"] += 1
+        self.stats["requests"] += n_requests
+        self.stats["rows"] += n_rows
+        self.stats["max_rows"] = max(self.stats["max_rows"], n_rows)
+        if self.rows_histogram is not None:
+            self.rows_histogram.observe(n_rows)
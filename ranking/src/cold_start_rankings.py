@@ -0,0 +1,188 @@
+import asyncio
+import random
+import time
+import traceback
+from typing import NamedTuple
+
+import numpy as np
+from logzero import logger
+
+
+class CountryRanking(NamedTuple):
+    """
+    ** Description: ** <em> Cold start ranking of a country's candidate pool, ids and scores sorted by score (highest
+    first) </em>
+    """
+    ids: np.ndarray
+    scores: np.ndarray
+    built_at: float
+
+
+class ColdStartRankings:
+    def __init__(self, candidate_retrieval, feature_store, reco, executor, refresh_seconds, sample_from_top,
+                 idle_seconds) -> None:
+        """
+        ** Description: ** <em> Precomputed cold start rankings per country for requests without a user id. Cold start
+        scores only depend on asset features, so the whole candidate pool of a country is scored once with
+        `cold_start_model` and kept sorted in memory. Rankings are refreshed in the background, only assets that are new
+        to the pool or whose features changed are scored again. Requests get a sample from the top of the list with no
+        feature store or model call. Countries come from the requests, a country not requested for `idle_seconds` is
+        dropped instead of being refreshed, so the background work does not grow with every `user_country` ever sent </em>
+
+        Args:
+            candidate_retrieval (CandidateRetrieval): provides the candidate pool of a country
+            feature_store (GetFeaturesFromFS): provides the asset features
+            reco (GetRecommendations): owner of the cold start model
+            executor (concurrent.futures.Executor): executor the scoring runs in
+            refresh_seconds (float): interval between two refreshes of every known country
+            sample_from_top (int): requests sample from this many top ranked assets
+            idle_seconds (float): countries not requested for this long are dropped
+        """
+        self.candidate_retrieval = candidate_retrieval
+        self.feature_store = feature_store
+        self.reco = reco
+        self.executor = executor
+        self.refresh_seconds = refresh_seconds
+        self.sample_from_top = sample_from_top
+        self.idle_seconds = idle_seconds
+        self._rankings = {}
+        self._requested_at = {}
+        self._scored = {}
+        self._models = {}
+        self._inflight = {}
+        self._refresher = None
+        self.stats = {"served": 0, "not_ready": 0, "refreshes": 0, "refresh_errors": 0, "scored": 0, "reused": 0,
+                      "dropped": 0}
+
+    def recommend(self, user_country, k):
+        """
+        ** Description: ** <em> It samples k assets from the top of the country's ranking and returns them in score order.
+        Countries without a ranking yet get one built in the background and None is returned so the caller can fall
+        back to the regular pipeline </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format
+            k (int): number of lomotif ids to return
+
+        Returns:
+            (list): k lomotif ids sorted by cold start score, empty when the country has no ranked asset, None if the \
+            country is not ranked yet
+        """
+        self._requested_at[user_country] = time.monotonic()
+        ranking = self._rankings.get(user_country)
+        if ranking is None:
+            self.stats["not_ready"] += 1
+            self.schedule_refresh(user_country)
+            return None
+        self.stats["served"] += 1
+        top = min(max(self.sample_from_top, k), len(ranking.ids))
+        if top == 0:
+            # the country has no rankable asset
+            return []
+        chosen = np.sort(np.array(random.sample(range(top), min(k, top)), dtype=np.intp))
+        return ranking.ids[chosen].tolist()
+
+    def schedule_refresh(self, user_country):
+        """
+        ** Description: ** <em> It starts a background refresh of the country unless one is already running </em>
+
+        Args:
+            user_country (str): The country in ISO 2 format
+
+        Returns:
+            (asyncio.Task): the running refresh
+        """
+        task = self._inflight.get(user_country)
+        if task is None:
+            task = asyncio.ensure_future(self.refresh(user_country))
+            self._inflight[user_country] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_country, None))
+        return task
+
+    async def refresh(self, user_country):
+        """
+        ** Description: ** <em> It rebuilds the ranking of a country. Assets whose feature row is unchanged since the last
+        build keep their score, only new and changed assets are scored. Everything is scored again when the cold start
+        model was swapped </em>
+
+        Args:
+            user_country (str): The country in ISO 2 format
+        """
+        try:
+            self.stats["refreshes"] += 1
+            pool = await self.candidate_retrieval.get_candidate_pool(user_country)
+            asset_values = await self.feature_store.get_asset_features_from_fs(candidate_list=pool.assets)
+            batch = self.feature_store.build_feature_batch(pool.assets, asset_values, {})
+            model = self.reco.cold_start_model
+            previous = self._scored.get(user_country, {}) if self._models.get(user_country) is model else {}
+
+            keys = [row.tobytes() for row in batch.features]
+            scores = np.empty(len(batch.ids), dtype=np.float32)
+            stale = []
+            for i, (lomotif_id, key) in enumerate(zip(batch.ids, keys)):
+                cached = previous.get(lomotif_id)
+                if cached is not None and cached[0] == key:
+                    scores[i] = cached[1]
+                else:
+                    stale.append(i)
+            if stale:
+                loop = asyncio.get_running_loop()
+                scores[stale] = await loop.run_in_executor(self.executor, model.inplace_predict, batch.features[stale])
+            self.stats["scored"] += len(stale)
+            self.stats["reused"] += len(batch.ids) - len(stale)
+
+            self._scored[user_country] = {lomotif_id: (key, score)
+                                          for lomotif_id, key, score in zip(batch.ids, keys, scores)}
+            self._models[user_country] = model
+            # warmed up countries count as requested when first built
+            self._requested_at.setdefault(user_country, time.monotonic())
+            order = np.argsort(-scores, kind="stable")
+            self._rankings[user_country] = CountryRanking(batch.ids[order], scores[order], time.monotonic())
+        except Exception:
+            self.stats["refresh_errors"] += 1
+            logger.info(f"Could not refresh cold start ranking for {user_country}: {traceback.format_exc()}")
+
+    def refresh_all(self):
+        """
+        ** Description: ** <em> It starts a background refresh of every known country, e.g. after the cold start model
+        was swapped </em>
+        """
+        for user_country in list(self._rankings):
+            self.schedule_refresh(user_country)
+
+    def start(self):
+        """
+        ** Description: ** <em> It starts the background task refreshing every known country </em>
+        """
+        if self._refresher is None:
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self):
+        """
+        ** Description: ** <em> It stops the background refresh </em>
+        """
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    def drop_idle(self):
+        """
+        ** Description: ** <em> It drops the rankings of the countries not requested for `idle_seconds`, a later request
+        builds theirs again </em>
+        """
+        now = time.monotonic()
+        for user_country in [country for country, requested_at in self._requested_at.items()
+                             if now - requested_at > self.idle_seconds]:
+            del self._requested_at[user_country]
+            self._rankings.pop(user_country, None)
+            self._scored.pop(user_country, None)
+            self._models.pop(user_country, None)
+            self.stats["dropped"] += 1
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            self.drop_idle()
+            for user_country in list(self._rankings):
+                await self.schedule_refresh(user_country)
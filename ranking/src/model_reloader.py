@@ -0,0 +1,203 @@
+import os
+import asyncio
+import traceback
+
+from logzero import logger
+
+from ranking.inference import model_identity, resolve_model_path
+from utils import load_config
+
+NO_MODELS = {"model": None, "cold_start_model": None}
+
+
+class ModelReloader:
+    def __init__(self, reco, executor, warmup_rows, check_seconds, config_path="config.yml") -> None:
+        """
+        ** Description: ** <em> Hot swap of the served and the shadow models without a restart. A new set is loaded and
+        warmed up in `executor` while the current one keeps serving, then published with one reference assignment, so
+        no request sees a half loaded or a mixed set. A failed load leaves the current models in place. Reloads are
+        triggered by `reload` / `load_shadow` (the admin endpoints) or by the watcher, which checks every
+        `check_seconds` whether config.yml names other models or a served model file was replaced </em>
+
+        Args:
+            reco (GetRecommendations): owner of the models
+            executor (concurrent.futures.Executor): executor models are loaded and warmed up in, not the ranking one
+            warmup_rows (int): rows of the synthetic warmup predict run before a set is published
+            check_seconds (float): interval between two checks of the watcher
+            config_path (str): config file the watcher reads the model names from
+        """
+        self.reco = reco
+        self.executor = executor
+        self.warmup_rows = warmup_rows
+        self.check_seconds = check_seconds
+        self.config_path = config_path
+        self.on_swap = []
+        # created on first use, inside the event loop of the serving process, see `lock`
+        self._lock = None
+        self._watcher = None
+        self._config_identity = None
+        # identities of files whose load failed, they are not retried until they change again
+        self._failed = {}
+        self.stats = {"reloads": 0, "shadow_loads": 0, "load_errors": 0}
+
+    @property
+    def lock(self):
+        """
+        ** Description: ** <em> Lock serializing the reloads. The reloader is created when the service is imported,
+        before the serving process (a forked worker) runs its event loop, and an asyncio lock created then is bound to
+        another loop on Python < 3.10, so it is created by the first reload instead </em>
+
+        Returns:
+            (asyncio.Lock): the lock
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _load(self, names):
+        loop = asyncio.get_running_loop()
+        models = await loop.run_in_executor(self.executor, self.reco.load_model_set,
+                                            names["model"], names["cold_start_model"])
+        await loop.run_in_executor(self.executor, self.reco.warmup, self.warmup_rows, models)
+        return models
+
+    async def reload(self, model_name=None, cold_start_model_name=None):
+        """
+        ** Description: ** <em> It loads, warms up and serves a new full and cold start model. Names left out keep the
+        served file name, so a call without names reloads files replaced in place </em>
+
+        Args:
+            model_name (str): file name of the full model in `model_path`
+            cold_start_model_name (str): file name of the cold start model in `model_path`
+
+        Returns:
+            (ModelSet): the models now served
+        """
+        async with self.lock:
+            served = self.reco.models.names
+            names = {"model": model_name or served["model"],
+                     "cold_start_model": cold_start_model_name or served["cold_start_model"]}
+            try:
+                models = await self._load(names)
+            except Exception:
+                self.stats["load_errors"] += 1
+                logger.info(f"Could not reload models {names}, still serving {served}: {traceback.format_exc()}")
+                raise
+            self.reco.models = models
+            self.stats["reloads"] += 1
+            logger.info(f"Serving models {names}")
+            for callback in self.on_swap:
+                callback(models)
+            return models
+
+    async def load_shadow(self, model_name=None, cold_start_model_name=None):
+        """
+        ** Description: ** <em> It loads and warms up candidate models scored in the shadow of the served ones, without
+        names the shadow models are dropped </em>
+
+        Args:
+            model_name (str): file name of the candidate full model, None to not shadow the full model
+            cold_start_model_name (str): file name of the candidate cold start model, None to not shadow it
+
+        Returns:
+            (ModelSet): the shadow models, None when they were dropped
+        """
+        async with self.lock:
+            if model_name is None and cold_start_model_name is None:
+                self.reco.shadow_models = None
+                logger.info("Shadow models dropped")
+                return None
+            names = {"model": model_name, "cold_start_model": cold_start_model_name}
+            try:
+                models = await self._load(names)
+            except Exception:
+                self.stats["load_errors"] += 1
+                logger.info(f"Could not load shadow models {names}: {traceback.format_exc()}")
+                raise
+            self.reco.shadow_models = models
+            self.stats["shadow_loads"] += 1
+            logger.info(f"Shadow scoring models {names}")
+            return models
+
+    def describe(self):
+        """
+        ** Description: ** <em> File names and load time of the served and the shadow models </em>
+
+        Returns:
+            (dict): {"serving": ..., "shadow": ...}
+        """
+        return {role: None if models is None else {**models.names, "loaded_at": models.loaded_at}
+                for role, models in (("serving", self.reco.models), ("shadow", self.reco.shadow_models))}
+
+    def start(self):
+        """
+        ** Description: ** <em> It starts watching config.yml and the served model files </em>
+        """
+        if self._watcher is None:
+            self._config_identity = model_identity(self.config_path)
+            self._watcher = asyncio.ensure_future(self._watch_forever())
+
+    async def stop(self):
+        """
+        ** Description: ** <em> It stops the watcher </em>
+        """
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+
+    async def _watch_forever(self):
+        while True:
+            await asyncio.sleep(self.check_seconds)
+            try:
+                await self.check()
+            except Exception:
+                logger.info(f"Model watcher check failed: {traceback.format_exc()}")
+
+    def _changed_files(self, models):
+        changed = {}
+        for role, name in models.names.items():
+            if name is None:
+                continue
+            try:
+                identity = model_identity(resolve_model_path(self.reco.config["model_path"] + name))
+            except FileNotFoundError:
+                # removed while a new copy is moved in, or removed for good, the loaded model keeps serving
+                continue
+            if identity != models.identities[role] and identity != self._failed.get(name):
+                changed[name] = identity
+        return changed
+
+    async def check(self):
+        """
+        ** Description: ** <em> It reloads the served models when config.yml names other models or one of their files
+        was replaced, and loads or drops the shadow models when their names in config.yml changed </em>
+        """
+        served, shadow = self.reco.models, self.reco.shadow_models
+        names = served.names
+        shadow_names = NO_MODELS if shadow is None else shadow.names
+        config_identity = model_identity(self.config_path)
+        if config_identity != self._config_identity:
+            self._config_identity = config_identity
+            config = load_config(self.config_path)
+            names = {"model": config["model_name"], "cold_start_model": config["cold_start_model_name"]}
+            shadow_names = {"model": config["shadow_scoring"]["model_name"],
+                            "cold_start_model": config["shadow_scoring"]["cold_start_model_name"]}
+
+        changed = self._changed_files(served)
+        if names != served.names or changed:
+            await self._retry_guarded(self.reload, names, changed)
+        changed = {} if shadow is None else self._changed_files(shadow)
+        if shadow_names != (NO_MODELS if shadow is None else shadow.names) or changed:
+            await self._retry_guarded(self.load_shadow, shadow_names, changed)
+
+    async def _retry_guarded(self, load, names, changed):
+        try:
+            await load(names["model"], names["cold_start_model"])
+        except Exception:
+            # the same broken files are not loaded again on every check, a new copy is
+            for name in names.values():
+                path = None if name is None else resolve_model_path(self.reco.config["model_path"] + name)
+                if path is not None and os.path.exists(path):
+                    self._failed[name] = model_identity(path)
+            self._failed.update(changed)
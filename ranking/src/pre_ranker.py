@@ -0,0 +1,52 @@
+import asyncio
+
+import numpy as np
+
+
+class PreRanker:
+    def __init__(self, feature_store, reco, executor, reference_user=None) -> None:
+        """
+        ** Description: ** <em> Cheap first ranking stage over the whole candidate pool of a country. Pre-scores do not
+        depend on the requesting user, so every asset of a pool is scored once when the pool is loaded and the scores
+        are cached with it, see `CandidatePool.scores`. Requests then pass the best pre-scored assets to the full model
+        instead of a random sample, at no per request cost but a partial sort. Assets are scored with the cold start
+        model, or with the full model for a fixed reference user when `reference_user` is set </em>
+
+        Args:
+            feature_store (GetFeaturesFromFS): provides the asset features
+            reco (GetRecommendations): owner of the models
+            executor (concurrent.futures.Executor): executor the scoring runs in
+            reference_user (dict): value of every user feature of the reference user, None for the cold start model
+        """
+        self.feature_store = feature_store
+        self.reco = reco
+        self.executor = executor
+        self.reference_user = reference_user or {}
+        self.stats = {"pools": 0, "rows": 0, "without_features": 0}
+
+    async def score(self, assets):
+        """
+        ** Description: ** <em> It pre-scores the assets of a pool </em>
+
+        Args:
+            assets (list): lomotif ids
+
+        Returns:
+            (np.ndarray): float32 score of every asset, -inf for assets without features (the full model drops them), \
+            None while no model is loaded
+        """
+        models = self.reco.models
+        if models is None:
+            return None
+        values = await self.feature_store.get_asset_features_from_fs(candidate_list=assets)
+        batch = self.feature_store.build_feature_batch(assets, values, self.reference_user)
+        model = self.reco.select_model(batch.columns, models)
+        keep = ~np.isnan(values).any(axis=1)
+        scores = np.full(len(assets), -np.inf, dtype=np.float32)
+        if len(batch.ids) > 0:
+            loop = asyncio.get_running_loop()
+            scores[keep] = await loop.run_in_executor(self.executor, model.inplace_predict, batch.features)
+        self.stats["pools"] += 1
+        self.stats["rows"] += len(batch.ids)
+        self.stats["without_features"] += len(assets) - len(batch.ids)
+        return scores
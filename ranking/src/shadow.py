@@ -0,0 +1,95 @@
+import time
+import random
+import asyncio
+
+import numpy as np
+from logzero import logger
+
+# mean absolute difference of the served and the shadow probability of the same rows
+SCORE_DIFF_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# share of the served top k that the shadow model also ranks in its top k
+OVERLAP_BUCKETS = (0, 0.2, 0.4, 0.6, 0.8, 0.9, 1)
+
+
+class ShadowScorer:
+    def __init__(self, reco, executor, metrics, sample_rate, max_pending) -> None:
+        """
+        ** Description: ** <em> Scores a sampled share of requests with the shadow models (`reco.shadow_models`) next to
+        the served ones, off the critical path: the request is answered with the served ranking and the comparison runs
+        afterwards in its own executor. Both models score the same rows in the same thread, so their latencies are
+        comparable. Score differences, top-k overlap and latencies are exported as metrics. Samples are dropped while
+        `max_pending` comparisons are queued, so shadow scoring never builds a backlog </em>
+
+        Args:
+            reco (GetRecommendations): owner of the served and the shadow models
+            executor (concurrent.futures.Executor): executor the comparisons run in, not the ranking one
+            metrics (serving.metrics.MetricsRegistry): registry the comparison metrics are added to
+            sample_rate (float): share of requests scored by the shadow models
+            max_pending (int): most comparisons queued or running at once
+        """
+        self.reco = reco
+        self.executor = executor
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self._pending = 0
+        self.latency = metrics.histogram("shadow_predict_latency_ms",
+                                         "predict latency of the served and the shadow model on the same sampled rows",
+                                         labelnames=("model", "input"))
+        self.score_diff = metrics.histogram("shadow_score_abs_diff",
+                                            "mean absolute difference of the served and the shadow scores per request",
+                                            buckets=SCORE_DIFF_BUCKETS, labelnames=("input",))
+        self.topk_overlap = metrics.histogram("shadow_topk_overlap",
+                                              "share of the served top k also in the shadow top k per request",
+                                              buckets=OVERLAP_BUCKETS, labelnames=("input",))
+        self.stats = {"sampled": 0, "compared": 0, "dropped": 0, "errors": 0}
+
+    def maybe_score(self, candidate_set, k):
+        """
+        ** Description: ** <em> It samples the request and schedules its comparison, it returns right away </em>
+
+        Args:
+            candidate_set (FeatureBatch): model input the served model ranked
+            k (int): number of lomotif ids the request asked for
+        """
+        shadow = self.reco.shadow_models
+        if shadow is None or candidate_set is None or len(candidate_set.ids) == 0:
+            return
+        if random.random() >= self.sample_rate or self.reco.select_model(candidate_set.columns, shadow) is None:
+            return
+        if self._pending >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+        self.stats["sampled"] += 1
+        self._pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.compare, self.reco.models, shadow,
+                                                            candidate_set, k)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._pending -= 1
+        if future.exception() is not None:
+            self.stats["errors"] += 1
+            logger.info(f"Shadow scoring failed: {future.exception()!r}")
+
+    def compare(self, served, shadow, candidate_set, k):
+        """
+        ** Description: ** <em> It scores the rows with both model sets and records the comparison </em>
+
+        Args:
+            served (ModelSet): models the request was answered with
+            shadow (ModelSet): candidate models
+            candidate_set (FeatureBatch): model input
+            k (int): size of the compared top k
+        """
+        input_type = "full" if list(candidate_set.columns) == self.reco.prediction_columns else "cold_start"
+        scores = {}
+        for role, models in (("serving", served), ("shadow", shadow)):
+            model = self.reco.select_model(candidate_set.columns, models)
+            start = time.perf_counter()
+            scores[role] = np.asarray(model.inplace_predict(candidate_set.features), dtype=np.float32)
+            self.latency.observe((time.perf_counter() - start) * 1000.0, role, input_type)
+        self.score_diff.observe(float(np.abs(scores["serving"] - scores["shadow"]).mean()), input_type)
+        top_served = self.reco.top_k(candidate_set.ids, scores["serving"], k)
+        top_shadow = self.reco.top_k(candidate_set.ids, scores["shadow"], k)
+        self.topk_overlap.observe(len(set(top_served) & set(top_shadow)) / len(top_served), input_type)
+        self.stats["compared"] += 1
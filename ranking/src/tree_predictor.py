@@ -0,0 +1,200 @@
+import json
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# objectives whose margin is turned into a probability with the logistic function
+LOGISTIC_OBJECTIVES = ("binary:logistic", "reg:logistic")
+# objectives whose prediction is the raw margin
+IDENTITY_OBJECTIVES = ("reg:squarederror", "binary:logitraw", "reg:linear")
+
+
+def _predict_margin_numpy(features, split_indices, split_conditions, left_children, right_children, default_left,
+                          roots, max_depth, base_margin):
+    n_rows = len(features)
+    rows = np.arange(n_rows)[:, None]
+    nodes = np.broadcast_to(roots, (n_rows, len(roots)))
+    for _ in range(max_depth):
+        values = features[rows, split_indices[nodes]]
+        go_left = np.where(np.isnan(values), default_left[nodes], values < split_conditions[nodes])
+        nodes = np.where(go_left, left_children[nodes], right_children[nodes])
+    contributions = np.empty((n_rows, len(roots) + 1), dtype=np.float32)
+    contributions[:, 0] = base_margin
+    contributions[:, 1:] = split_conditions[nodes]
+    # cumsum adds sequentially, a plain sum would use pairwise summation and round differently
+    return np.cumsum(contributions, axis=1, dtype=np.float32)[:, -1]
+
+
+def _sigmoid_numpy(margin):
+    # float64 exp rounded to float32 can differ from libm's expf by one ulp on rare rows
+    exp = np.exp(np.minimum(-margin, np.float32(88.7)).astype(np.float64)).astype(np.float32)
+    return np.float32(1.0) / (exp + np.float32(1.0))
+
+
+if numba is not None:
+    @numba.njit(nogil=True, cache=True)
+    def _predict_margin_compiled(features, split_indices, split_conditions, left_children, right_children,
+                                 default_left, roots, max_depth, base_margin):
+        n_rows = features.shape[0]
+        margin = np.empty(n_rows, dtype=np.float32)
+        for i in range(n_rows):
+            margin[i] = base_margin
+        # tree by tree keeps the nodes of one tree in cache while all rows walk it
+        for t in range(roots.shape[0]):
+            for i in range(n_rows):
+                node = roots[t]
+                while left_children[node] != node:
+                    value = features[i, split_indices[node]]
+                    if np.isnan(value):
+                        go_left = default_left[node]
+                    else:
+                        go_left = value < split_conditions[node]
+                    node = left_children[node] if go_left else right_children[node]
+                margin[i] += split_conditions[node]
+        return margin
+
+    @numba.njit(nogil=True, cache=True)
+    def _sigmoid_compiled(margin):
+        # same float32 expression as XGBoost's Sigmoid, expf comes from libm as well
+        out = np.empty_like(margin)
+        for i in range(margin.shape[0]):
+            out[i] = np.float32(1.0) / (np.exp(min(-margin[i], np.float32(88.7))) + np.float32(1.0))
+        return out
+
+
+class TreePredictor:
+    def __init__(self, split_indices, split_conditions, left_children, right_children, default_left, roots,
+                 max_depth, base_margin, objective, num_feature) -> None:
+        """
+        ** Description: ** <em> Evaluator of a gbtree ensemble over flattened trees. The nodes of all trees are stored in
+        contiguous arrays (feature, threshold, children, default direction, leaf value). When numba is installed the
+        arrays are walked by a compiled kernel that releases the GIL and has next to no per call overhead, otherwise every
+        row is walked down every tree at once with numpy indexing, one step per tree level. Use `from_booster` to build
+        it from a loaded model </em>
+
+        Args:
+            split_indices (np.ndarray): feature tested by every node
+            split_conditions (np.ndarray): float32 threshold of every split node, leaf value of every leaf
+            left_children (np.ndarray): global index of the left child, a leaf points to itself
+            right_children (np.ndarray): global index of the right child, a leaf points to itself
+            default_left (np.ndarray): whether missing values go to the left child
+            roots (np.ndarray): global index of the root of every tree, in boosting order
+            max_depth (int): depth of the deepest tree
+            base_margin (np.float32): margin every prediction starts from
+            objective (str): training objective, decides the output transformation
+            num_feature (int): number of input features
+        """
+        self.split_indices = np.ascontiguousarray(split_indices, dtype=np.int32)
+        self.split_conditions = np.ascontiguousarray(split_conditions, dtype=np.float32)
+        self.left_children = np.ascontiguousarray(left_children, dtype=np.int32)
+        self.right_children = np.ascontiguousarray(right_children, dtype=np.int32)
+        self.default_left = np.ascontiguousarray(default_left, dtype=np.bool_)
+        self.roots = np.ascontiguousarray(roots, dtype=np.int32)
+        self.max_depth = max_depth
+        self.base_margin = base_margin
+        self.objective = objective
+        self.num_feature = num_feature
+        self.compiled = numba is not None
+
+    @classmethod
+    def from_booster(cls, booster):
+        """
+        ** Description: ** <em> It flattens the trees of a loaded XGBoost booster. Only single target gbtree models with
+        numerical splits are supported, which covers the models shipped in `ranking/models/` </em>
+
+        Args:
+            booster (xgb.Booster): loaded model
+
+        Returns:
+            (TreePredictor): evaluator producing the same predictions as `booster.predict`
+
+        Raises:
+            ValueError: naming the objective, booster type, multi output or categorical splits that are not supported
+        """
+        learner = json.loads(booster.save_raw("json"))["learner"]
+        objective = learner["objective"]["name"]
+        if objective not in LOGISTIC_OBJECTIVES + IDENTITY_OBJECTIVES:
+            raise ValueError(f"TreePredictor does not support the objective {objective!r}")
+        gradient_booster = learner["gradient_booster"]["name"]
+        if gradient_booster != "gbtree":
+            raise ValueError(f"TreePredictor does not support the booster {gradient_booster!r}, only gbtree")
+        model_param = learner["learner_model_param"]
+        if int(model_param["num_class"]) > 1 or int(model_param.get("num_target", 1)) > 1:
+            raise ValueError(f"TreePredictor does not support multi output models (num_class "
+                             f"{model_param['num_class']}, num_target {model_param.get('num_target', 1)})")
+        base_score = np.float32(float(model_param["base_score"].strip("[]")))
+        if objective in LOGISTIC_OBJECTIVES:
+            base_margin = np.float32(-np.log(np.float32(1.0) / base_score - np.float32(1.0)))
+        else:
+            base_margin = base_score
+
+        split_indices, split_conditions, left_children, right_children, default_left, roots = [], [], [], [], [], []
+        max_depth, offset = 0, 0
+        for tree in learner["gradient_booster"]["model"]["trees"]:
+            if any(tree["split_type"]):
+                raise ValueError("TreePredictor does not support categorical splits")
+            left = np.asarray(tree["left_children"], dtype=np.int64)
+            right = np.asarray(tree["right_children"], dtype=np.int64)
+            nodes = np.arange(len(left), dtype=np.int64)
+            is_leaf = left == -1
+            # leaves point to themselves so extra traversal steps keep rows where they are
+            left_children.append(np.where(is_leaf, nodes, left) + offset)
+            right_children.append(np.where(is_leaf, nodes, right) + offset)
+            split_indices.append(np.where(is_leaf, 0, np.asarray(tree["split_indices"], dtype=np.int64)))
+            split_conditions.append(np.asarray(tree["split_conditions"], dtype=np.float32))
+            default_left.append(np.asarray(tree["default_left"], dtype=bool))
+            roots.append(offset)
+            max_depth = max(max_depth, cls._depth(left, right))
+            offset += len(left)
+
+        return cls(np.concatenate(split_indices), np.concatenate(split_conditions), np.concatenate(left_children),
+                   np.concatenate(right_children), np.concatenate(default_left), np.asarray(roots, dtype=np.int64),
+                   max_depth, base_margin, objective, int(model_param["num_feature"]))
+
+    @staticmethod
+    def _depth(left, right):
+        depth, level = 0, [0]
+        while True:
+            level = [child for node in level for child in (left[node], right[node]) if child != -1]
+            if not level:
+                return depth
+            depth += 1
+
+    def predict_margin(self, features):
+        """
+        ** Description: ** <em> It computes the raw margin of every row. Leaf values are accumulated in float32 in boosting
+        order starting from the base margin, the same way XGBoost's CPU predictor does </em>
+
+        Args:
+            features (np.ndarray): matrix of shape (rows, num_feature), NaN marks missing values
+
+        Returns:
+            (np.ndarray): float32 margin of every row
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if features.ndim != 2 or features.shape[1] != self.num_feature:
+            raise ValueError(f"expected a matrix with {self.num_feature} columns, got shape {features.shape}")
+        predict_margin = _predict_margin_compiled if self.compiled else _predict_margin_numpy
+        return predict_margin(features, self.split_indices, self.split_conditions, self.left_children,
+                              self.right_children, self.default_left, self.roots, self.max_depth, self.base_margin)
+
+    def inplace_predict(self, features):
+        """
+        ** Description: ** <em> It predicts every row, same interface as `xgb.Booster.inplace_predict` for numpy input so
+        it can replace a booster in `GetRecommendations`. Margins are always identical to XGBoost's, probabilities are
+        identical with the compiled kernel and may differ by one float32 ulp on rare rows without numba </em>
+
+        Args:
+            features (np.ndarray): matrix of shape (rows, num_feature), NaN marks missing values
+
+        Returns:
+            (np.ndarray): float32 prediction of every row
+        """
+        margin = self.predict_margin(features)
+        if self.objective in LOGISTIC_OBJECTIVES:
+            return _sigmoid_compiled(margin) if self.compiled else _sigmoid_numpy(margin)
+        return margin
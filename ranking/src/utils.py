@@ -1,13 +1,9 @@
-import yaml
 from datetime import datetime
 import os
-
-def load_config(file_path):
-    with open(file_path, 'r') as f:
-        cfg = yaml.safe_load(f)
-    return cfg
-
-config = load_config('config.yml')
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from utils import get_config
 
 def categorify(df, cat, freq_treshhold=20, unkown_id=1, lowfrequency_id=0):
     freq = df[cat].value_counts()
@@ -29,6 +25,70 @@ def save_preprocessed_data(df):
 
 
 def convert_types(df):
+    config = get_config()
     df[config["asset_feature_list"]] = df[config["asset_feature_list"]].astype(str)
     df[config["user_feature_list"]] = df[config["user_feature_list"]].astype(str)
-    return df
\ No newline at end of file
+    return df
+
+class StreamingCategorify:
+    def __init__(self, cat, freq_treshhold=20, unkown_id=1, lowfrequency_id=0):
+        """
+        ** Description: ** <em> `categorify` for tables read in record batches. Value counts are accumulated batch by
+        batch with `observe`, then `encode` maps a batch to its codes with a vectorized lookup, no frame is merged or
+        held in memory. Codes follow `categorify`: the n-th most frequent value gets n + 2, values seen fewer than
+        `freq_treshhold` times get `lowfrequency_id`, null and unseen values get `unkown_id`. Ties are ordered by
+        value so the codes do not depend on the order batches are read in </em>
+
+        Args:
+            cat (str): categorical column
+            freq_treshhold (int): values seen fewer times are encoded as `lowfrequency_id`
+            unkown_id (int): code of null and unseen values
+            lowfrequency_id (int): code of rare values
+        """
+        self.cat = cat
+        self.freq_treshhold = freq_treshhold
+        self.unkown_id = unkown_id
+        self.lowfrequency_id = lowfrequency_id
+        self._counts = None
+        self._vocabulary = None
+        self._codes = None
+
+    def observe(self, batch):
+        """
+        ** Description: ** <em> It adds the value counts of a record batch </em>
+        """
+        counts = pc.value_counts(batch.column(self.cat).drop_null()).flatten()
+        counts = pa.table({"value": counts[0], "count": counts[1].cast(pa.int64())})
+        if self._counts is not None:
+            counts = pa.concat_tables([self._counts, counts]).group_by("value").aggregate([("count", "sum")])
+            counts = counts.rename_columns(["value", "count"])
+        self._counts = counts
+        self._vocabulary = None
+
+    def fit(self):
+        """
+        ** Description: ** <em> It assigns the codes from the counts observed so far </em>
+
+        Returns:
+            (pa.Table): the vocabulary, every value and its code
+        """
+        counts = self._counts.sort_by([("count", "descending"), ("value", "ascending")])
+        codes = np.arange(len(counts), dtype=np.int64) + 2
+        codes[counts.column("count").to_numpy() < self.freq_treshhold] = self.lowfrequency_id
+        self._vocabulary = counts.column("value").combine_chunks()
+        self._codes = np.append(codes, self.unkown_id)
+        return pa.table({self.cat: self._vocabulary, self.cat + "_Categorify": codes})
+
+    def encode(self, batch):
+        """
+        ** Description: ** <em> It encodes the column of a record batch </em>
+
+        Returns:
+            (np.ndarray): int64 code of every row
+        """
+        if self._vocabulary is None:
+            self.fit()
+        index = pc.index_in(batch.column(self.cat), value_set=self._vocabulary)
+        # nulls and unseen values point at the unkown_id appended after the vocabulary
+        index = pc.fill_null(index, len(self._vocabulary)).to_numpy()
+        return self._codes[index]
@@ -2,9 +2,12 @@ import warnings
 warnings.filterwarnings(action = 'ignore')
 import os
 from requests_aws4auth import AWS4Auth
+from botocore.credentials import Credentials
 from opensearchpy import OpenSearch, RequestsHttpConnection
+from opensearchpy import AsyncOpenSearch, AsyncHttpConnection, AWSV4SignerAsyncAuth
 
 from dotenv import load_dotenv
+from utils import get_config
 load_dotenv("./.env")
 
 YOUR_ACCESS_KEY = os.environ["AWS_ACCESS_KEY_ID"]
@@ -29,3 +32,19 @@ es = OpenSearch(
     # ca_certs = ca_certs_path,
     connection_class=RequestsHttpConnection
 )
+
+# async client used on the request path, requests are signed without blocking the event loop. Requests are also cut
+# by their deadline, the client timeout bounds the calls made outside of a request, e.g. candidate pool refreshes
+async_awsauth = AWSV4SignerAsyncAuth(Credentials(YOUR_ACCESS_KEY, YOUR_SECRET_KEY), REGION, 'es')
+
+async_es = AsyncOpenSearch(
+    hosts = [{'host': ES_HOST, 'port': ES_PORT}],
+    http_compress = True,
+    timeout = get_config()["deadlines"]["es_timeout_seconds"],
+    http_auth=async_awsauth,
+    use_ssl = True,
+    verify_certs = True,
+    ssl_assert_hostname = False,
+    ssl_show_warn = False,
+    connection_class=AsyncHttpConnection
+)
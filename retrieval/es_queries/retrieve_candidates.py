@@ -1,12 +1,12 @@
 import warnings
 warnings.filterwarnings("ignore")
 import os
+import asyncio
 import random
 import traceback
 import sys
-import time
 from pathlib import Path
-import redis
+import numpy as np
 
 sys.path.append(str(Path(os.getcwd()).parent))
 sys.path.append(str(Path(os.getcwd())) + "/retrieval")
@@ -14,32 +14,95 @@ sys.path.append(str(Path(os.getcwd())) + "/ranking")
 sys.path.append(str(Path(os.getcwd())))
 
 from logzero import logger
-from utils import load_config
+from utils import get_config
+from retrieval.src.candidate_pool_cache import CandidatePool, CandidatePoolCache
+from retrieval.src.blacklist import BlacklistFilter, EMPTY_BLACKLIST, hash_ids
 
 from dotenv import load_dotenv
 KEY_PREFIX = "recommendations_preprocessing"
 
 load_dotenv("./.env")
+# only the ids and the hit count are read from a lean retrieval response
+LEAN_FILTER_PATH = "hits.total.value,hits.hits._id"
+# the same for every response of a candidate source msearch, errors are kept to tell them from empty sources
+SOURCES_FILTER_PATH = "responses.hits.total.value,responses.hits.hits._id,responses.error.type,responses.error.reason"
+# sources fetched once per country and cached with the pool, the others are fetched per request for the user
+COUNTRY_SOURCES = ("recent", "popular")
+USER_SOURCES = ("preferred_categories",)
+# countries with fewer records than this get 30% of their records as candidates instead of a fixed sample
+FULL_SAMPLE_MIN_RECORDS = 500
 
 class CandidateRetrieval:
-    def __init__(self) -> None:
+    def __init__(self, feature_store=None, pre_scorer=None) -> None:
         """
-        ** Description: ** <em> The function loads the config file, then tries to connect to the OpenSearch database. If it
-        can't connect, it logs the error </em>
+        ** Description: ** <em> The function loads the config file and sets up the per-country candidate pool cache and the
+        per-user blacklist filter. The async OpenSearch client is created on first use, see `es`, and the connection is
+        checked in `connect` once the event loop is running </em>
+
+        Args:
+            feature_store (GetFeaturesFromFS): provides the asset features the `popular` candidate source ranks by,
+            without it the source keeps the newest assets of its window
+            pre_scorer (coroutine function): called with the assets of a pool when it is loaded, returns their \
+            pre-scores, see `PreRanker.score`. Without it candidates are sampled at random
+        """
+        self.config = get_config()
+        self.feature_store = feature_store
+        self.pre_scorer = pre_scorer
+        self.pre_ranking = self.config["pre_ranking"]
+        self.sources = [source for source in self.config["candidate_sources"] if source["quota"] > 0
+                        or source["kind"] == "recent"]
+        self.user_sources = [source for source in self.sources if source["kind"] in USER_SOURCES]
+        self._es = None
+        blacklist_config = self.config["blacklist_cache"]
+        self.blacklist_filter = BlacklistFilter(self.get_blacklist_assets_list,
+                                                max_bytes=blacklist_config["max_bytes"],
+                                                ttl_seconds=blacklist_config["ttl_seconds"])
+        cache_config = self.config["candidate_pool_cache"]
+        self.pool_cache = None
+        if cache_config["enabled"]:
+            self.pool_cache = CandidatePoolCache(self.fetch_candidate_pool,
+                                                 ttl_seconds=cache_config["ttl_seconds"],
+                                                 max_stale_seconds=cache_config["max_stale_seconds"],
+                                                 max_entries=cache_config["max_countries"])
+
+    @property
+    def es(self):
+        """
+        ** Description: ** <em> The async OpenSearch client, opensearchpy and the request signer are only imported when it
+        is first needed so importing the service stays fast </em>
+
+        Returns:
+            (AsyncOpenSearch): the client
+        """
+        if self._es is None:
+            from retrieval.es_connect import async_es
+            self._es = async_es
+        return self._es
+
+    @es.setter
+    def es(self, client):
+        self._es = client
+
+    async def connect(self):
+        """
+        ** Description: ** <em> It pings the OpenSearch database and logs whether the connection could be established </em>
         """
-        self.config = load_config("config.yml")
         try:
-            from retrieval.es_connect import es
-            self.es = es
-            if self.es.ping():
-                logger.info(f"Successfully connected to OpenSeach DB: {es}")
+            if await self.es.ping():
+                logger.info(f"Successfully connected to OpenSeach DB: {self.es}")
             else:
                 logger.info("Could not connect to Opensearch")
         except:
             logger.info(f"Could not connect to Opensearch: {traceback.format_exc()}")
-            # file_logger.info(f"{traceback.print_exception()}")  
+
+    async def close(self):
+        """
+        ** Description: ** <em> It closes the underlying http session of the OpenSearch client </em>
+        """
+        if self._es is not None:
+            await self._es.close()
     
-    def search_sample_asset(self):
+    async def search_sample_asset(self):
         """ ** Description: ** <em> This function returns a sample set from the ES index </em> 
 
         Returns:
@@ -55,12 +118,13 @@ class CandidateRetrieval:
       	    "from": 0,
       	    "sort": []
             }
-        resp = self.es.search(index = self.config["ES_INDEX_NAME"], body=query)
+        resp = await self.es.search(index = self.config["ES_INDEX_NAME"], body=query)
         return resp['hits']['hits']
 
-    def get_blacklist_assets_list(self, user_id):
+    async def get_blacklist_assets_list(self, user_id):
         """
-        ** Description: ** <em> It takes in a user_id and returns a list of assets that the user has blacklisted </em>
+        ** Description: ** <em> It takes in a user_id and returns a list of assets that the user has blacklisted. ES errors \
+        are raised so that `BlacklistFilter` does not cache them as an empty blacklist </em>
         
         Args:
             user_id (str): The user id of the user whose blacklist assets list is to be fetched
@@ -68,6 +132,8 @@ class CandidateRetrieval:
         Returns: 
             (list): A list of assets that is blacklisted for the user.
         """
+        if not user_id:
+            return []
         query =  {
             "_source": {
             "include" :['user_blacklist']
@@ -80,29 +146,23 @@ class CandidateRetrieval:
                 }
             }
         }
-        resp = self.es.search(index = self.config["ES_USER_INDEX_NAME"], body= query)
-        print(resp)
-        try:
-            resp = resp['hits']['hits'][0]['_source']['user_blacklist']
-            return resp
-        except:
-            return [] 
+        resp = await self.es.search(index = self.config["ES_USER_INDEX_NAME"], body= query,
+                                    filter_path = "hits.hits._source.user_blacklist")
+        hits = resp.get('hits', {}).get('hits', [])
+        if len(hits) == 0:
+            return []
+        return hits[0].get('_source', {}).get('user_blacklist', [])
 
-    def es_retrieve_candidates(self, user_country, user_id = None):
-        """ ** Description: ** <em> This function returns a set of lomotif ids that will be passed \
-        on to the ML model for ranking purpose </em>
+    async def get_record_count(self, user_country):
+        """
+        ** Description: ** <em> It counts the number of assets in the ES index for the given country </em>
 
         Args:
-            user_country (str): The country user belongs to in ISO 2 format e.g. (united states = "US", france = "FR")
+            user_country (str): The country user belongs to in ISO 2 format
 
         Returns:
-            (list): A list of lomotif ids based on the country user belongs to
+            (int): number of assets for the country
         """
-        if user_id is not None:
-            assets = self.get_blacklist_assets_list(user_id)
-        else: 
-            assets = []
-
         db_record_count_query =  {
             "query" :{
                 "match":{
@@ -110,82 +170,406 @@ class CandidateRetrieval:
                 }
             }
         }
+        resp = await self.es.count(index=self.config["ES_INDEX_NAME"], body=db_record_count_query)
+        return resp["count"]
 
-        normal_query =  {
-            "size": 1000,
-            "query": { 
-            "bool": { 
-              "must": [
-                { "match": {"production_country" : user_country}},
-              ],
-            #   "must_not" :[
-            #     {
-            #       "terms": {"lomotif_id.keyword" : assets }
-            #     }
-            #   ],
-              "filter": [ 
-                { "term":  { "moderation_status.keyword": "ACCEPT" }},
-              ]
-            }
-          },
-          "sort" :{
-                    "creation_date" :{"order": "desc"}
-                        }
+    def country_source_query(self, source, user_country):
+        """
+        ** Description: ** <em> ES query of a country candidate source, accepted assets of the country newest first. The
+        `popular` source reads a window of `window` assets, optionally no older than `max_age_days`, and ranks it by
+        views afterwards </em>
+
+        Args:
+            source (dict): candidate source from `candidate_sources` in the config file
+            user_country (str): The country user belongs to in ISO 2 format
+
+        Returns:
+            (dict): search body
+        """
+        filters = [{ "term":  { "moderation_status.keyword": "ACCEPT" }}]
+        if source.get("max_age_days"):
+            filters.append({"range": {"creation_date": {"gte": f"now-{source['max_age_days']}d/d"}}})
+        return {
+            "size": source["window"] if source["kind"] == "popular" else source["size"],
+            "_source": False,
+            "query": {
+                "bool": {
+                    "must": [{ "match": {"production_country" : user_country}}],
+                    "filter": filters,
+                }
+            },
+            "sort": {"creation_date": {"order": "desc"}},
+        }
+
+    def user_source_query(self, source, user_country, user_id):
+        """
+        ** Description: ** <em> ES query of a user candidate source. `preferred_categories` matches the categories listed
+        in the `user_field` of the user's document with a terms lookup, so ES resolves them without another round trip
+        (user index documents are expected to be keyed by user_id) </em>
+
+        Args:
+            source (dict): candidate source from `candidate_sources` in the config file
+            user_country (str): The country user belongs to in ISO 2 format
+            user_id (str): user id of the requesting user
+
+        Returns:
+            (dict): search body
+        """
+        lookup = {"index": self.config["ES_USER_INDEX_NAME"], "id": user_id, "path": source["user_field"]}
+        return {
+            "size": source["size"],
+            "_source": False,
+            "query": {
+                "bool": {
+                    "must": [{ "match": {"production_country" : user_country}}],
+                    "filter": [
+                        { "term":  { "moderation_status.keyword": "ACCEPT" }},
+                        {"bool": {"should": [{"terms": {f"{field}.keyword": lookup}}
+                                             for field in source["category_fields"]],
+                                  "minimum_should_match": 1}},
+                    ],
+                }
+            },
+            "sort": {"creation_date": {"order": "desc"}},
         }
-        logger.info("Retrieving candidate list from ES Index")
-        rec_count = self.es.count(index=self.config["ES_INDEX_NAME"], body=db_record_count_query)["count"]
-        print(rec_count)
+
+    async def msearch(self, searches):
+        """
+        ** Description: ** <em> It runs many searches on the asset index in a single `msearch` round trip </em>
+
+        Args:
+            searches (list): search bodies
+
+        Returns:
+            (list): per search, its hit count and the list of hit ids, None for a search that failed
+        """
+        body = []
+        for search in searches:
+            body += [{"index": self.config["ES_INDEX_NAME"]}, search]
+        resp = await self.es.msearch(body=body, filter_path=SOURCES_FILTER_PATH)
+        results = []
+        for response in resp["responses"]:
+            if "error" in response:
+                logger.info(f"Candidate source search failed: {response['error']}")
+                results.append(None)
+                continue
+            # filter_path drops the hits list altogether when nothing matched
+            hits = response.get("hits", {})
+            results.append((hits.get("total", {}).get("value", 0), [hit["_id"] for hit in hits.get("hits", [])]))
+        return results
+
+    async def rank_by_feature(self, assets, feature, size):
+        """
+        ** Description: ** <em> It keeps the `size` assets with the highest value of an asset feature, e.g. the most
+        viewed ones by `lomotif_vv` </em>
+
+        Args:
+            assets (list): lomotif ids
+            feature (str): asset feature to rank by, one of `asset_features`
+            size (int): number of assets to keep
+
+        Returns:
+            (list): up to `size` lomotif ids, highest value first
+        """
+        if self.feature_store is None or feature not in self.feature_store.asset_columns or len(assets) == 0:
+            return assets[:size]
+        try:
+            values = await self.feature_store.get_asset_features_from_fs(candidate_list=assets)
+        except Exception:
+            logger.info(f"Could not rank by {feature}, keeping the newest assets: {traceback.format_exc()}")
+            return assets[:size]
+        values = values[:, self.feature_store.asset_columns.index(feature)]
+        # assets without the feature rank last
+        values = np.where(np.isnan(values), -np.inf, values)
+        order = np.argsort(-values, kind="stable")[:size]
+        return [assets[i] for i in order]
+
+    async def fetch_candidate_pool(self, user_country):
+        """ ** Description: ** <em> This function fetches the country candidate sources (newest accepted assets, most \
+        viewed recent assets) and the number of records of the country from ES in one `msearch`. Their union is the \
+        pool candidates are sampled from </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format e.g. (united states = "US", france = "FR")
+
+        Returns:
+            (CandidatePool): lomotif ids of every source and the number of records for the country
+        """
+        sources = [source for source in self.sources if source["kind"] in COUNTRY_SOURCES]
+        record_count_query = {"size": 0, "track_total_hits": True,
+                              "query": {"match": {"production_country" : user_country}}}
+        results = await self.msearch([record_count_query] +
+                                     [self.country_source_query(source, user_country) for source in sources])
+        if results[0] is None:
+            raise RuntimeError(f"could not count the records of {user_country}")
+        rec_count = results[0][0]
         if rec_count == 0:
-            logger.info("no records in ES for given country")
-            return "no lomotif in ES DB for given country"
-        try:          
-            if rec_count >= 500: 
-                resp = self.es.search(index = self.config["ES_INDEX_NAME"], body= normal_query)
-                resp = resp['hits']['hits']
-                # print(resp)
-                # assetList = [resp[e]['_source']["lomotif_id"] for e in range(len(resp))]
-                assetList = [resp[e]["_id"] for e in range(len(resp))]
-                # assetList = list(set(assetList) - set(assets))
-                candidate_list = random.sample(assetList, 100)
-                logger.info("Candidate list successfully retrieved")
-                return candidate_list
-            elif (rec_count < 1000)  &  (rec_count > 0):
-                less_record_query = {
-                    "size": rec_count,
-                        "query": { 
-                            "bool": { 
-                              "must": [
-                                { "match": {"production_country" : user_country}},
-                              ],
-                            #   "must_not" :[
-                            #     {
-                            #       "terms": {"lomotif_id.keyword" : assets }
-                            #     }
-                            #   ],
-                              "filter": [ 
-                                { "term":  { "moderation_status.keyword": "ACCEPT" }},
-                              ]
-                            }
-                          },
-                          "sort" :{
-                                    "creation_date" :{"order": "desc"}
-                                        }
+            return CandidatePool([], 0, EMPTY_BLACKLIST, {})
+
+        position = {}
+        source_positions = {}
+        for source, result in zip(sources, results[1:]):
+            assets = [] if result is None else result[1]
+            if source["kind"] == "popular":
+                assets = await self.rank_by_feature(assets, source["feature"], source["size"])
+            source_positions[source["name"]] = np.fromiter((position.setdefault(asset, len(position))
+                                                            for asset in assets), dtype=np.intp, count=len(assets))
+        assetList = list(position)
+        scores = None
+        if self.pre_scorer is not None and self.pre_ranking["enabled"]:
+            try:
+                scores = await self.pre_scorer(assetList)
+            except Exception:
+                # the pool is still served, its candidates are sampled at random until the next refresh
+                logger.info(f"Could not pre-score the pool of {user_country}: {traceback.format_exc()}")
+        return CandidatePool(assetList, rec_count, hash_ids(assetList), source_positions, scores)
+
+    async def fetch_user_sources(self, user_country, user_id):
+        """
+        ** Description: ** <em> It fetches the user candidate sources in one `msearch`. A failure leaves the sources
+        empty, their quota goes to the country sources </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format
+            user_id (str): user id of the requesting user
+
+        Returns:
+            (dict): lomotif ids per source name
+        """
+        if not user_id or not self.user_sources:
+            return {}
+        try:
+            results = await self.msearch([self.user_source_query(source, user_country, user_id)
+                                          for source in self.user_sources])
+        except Exception:
+            logger.info(f"Could not fetch the user candidate sources: {traceback.format_exc()}")
+            return {}
+        return {source["name"]: result[1] for source, result in zip(self.user_sources, results) if result is not None}
+
+    def pick(self, positions, n, scores):
+        """
+        ** Description: ** <em> It picks pool positions for a source: at random without pre-scores, otherwise the best
+        pre-scored ones and an `explore_share` of them at random among the others </em>
+
+        Args:
+            positions (np.ndarray): available positions of the source
+            n (int): number of positions to pick
+            scores (np.ndarray): pre-score of every pool asset, None when the pool was not pre-scored
+
+        Returns:
+            (np.ndarray): up to n positions
+        """
+        n = min(n, len(positions))
+        if scores is None:
+            return positions[random.sample(range(len(positions)), n)]
+        n_best = n - int(round(n * self.pre_ranking["explore_share"]))
+        if n_best < len(positions):
+            order = np.argpartition(-scores[positions], n_best)
+            best, others = positions[order[:n_best]], positions[order[n_best:]]
+        else:
+            best, others = positions, positions[:0]
+        return np.concatenate([best, others[random.sample(range(len(others)), n - n_best)]])
+
+    def merge_sources(self, pool, blacklist, user_candidates):
+        """
+        ** Description: ** <em> It picks candidates from every source up to its quota in config order, skipping
+        blacklisted assets and assets already taken from an earlier source. Quota a source cannot fill is filled from the
+        rest of the pool. Country sources of a pre-scored pool give their best pre-scored assets, the quotas are then
+        scaled to `pre_ranking.top_n` candidates, otherwise assets are sampled at random, see `pick`. Countries with
+        fewer than `FULL_SAMPLE_MIN_RECORDS` records get 30% of their records, quotas scaled down alike </em>
+
+        Args:
+            pool (CandidatePool): the country sources
+            blacklist (np.ndarray): sorted hashes of the user's blacklisted assets
+            user_candidates (dict): lomotif ids of the user sources, see `fetch_user_sources`
+
+        Returns:
+            (list): deduplicated lomotif ids
+        """
+        total_quota = sum(source["quota"] for source in self.sources)
+        size = total_quota if pool.scores is None else self.pre_ranking["top_n"]
+        budget = size if pool.record_count >= FULL_SAMPLE_MIN_RECORDS else int(0.3 * float(pool.record_count))
+        scale = budget / max(total_quota, 1)
+        if pool.scores is None:
+            scale = min(1.0, scale)
+        allowed = np.ones(len(pool.assets), dtype=bool)
+        if len(blacklist) > 0:
+            # blacklisted assets are dropped here so no features are fetched or scored for them
+            allowed = BlacklistFilter.allowed(blacklist, pool.hashes)
+        available = allowed.copy()
+        candidate_list = []
+        for source in self.sources:
+            quota = int(round(source["quota"] * scale))
+            if quota == 0:
+                continue
+            if source["name"] in pool.sources:
+                positions = pool.sources[source["name"]]
+                chosen = self.pick(positions[available[positions]], quota, pool.scores)
+                available[chosen] = False
+                candidate_list += [pool.assets[i] for i in chosen]
+            elif source["name"] in user_candidates:
+                taken = set(candidate_list)
+                assets = [asset for asset in user_candidates[source["name"]] if asset not in taken]
+                if len(blacklist) > 0:
+                    assets = [assets[i] for i in np.flatnonzero(BlacklistFilter.allowed(blacklist, hash_ids(assets)))]
+                candidate_list += random.sample(assets, min(quota, len(assets)))
+        # a user source may have taken an asset a later country source took again
+        candidate_list = list(dict.fromkeys(candidate_list))
+        if len(candidate_list) < budget:
+            taken = set(candidate_list)
+            rest = np.array([i for i in np.flatnonzero(available) if pool.assets[i] not in taken], dtype=np.intp)
+            candidate_list += [pool.assets[i] for i in self.pick(rest, budget - len(candidate_list), pool.scores)]
+        return candidate_list
+
+    async def get_candidate_pool(self, user_country):
+        """ ** Description: ** <em> This function returns the candidate pool of a country, from the in-process cache when \
+        it is enabled </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format
+
+        Returns:
+            (CandidatePool): lomotif ids sorted by creation date and the number of records for the country
+        """
+        if self.pool_cache is not None:
+            return await self.pool_cache.get(user_country)
+        return await self.fetch_candidate_pool(user_country)
+
+    async def lean_retrieve_candidates(self, user_country, user_id = None):
+        """ ** Description: ** <em> This function retrieves candidates in a single ES round trip. Sampling is done server \
+        side with `random_score`, the blacklist is applied as a `must_not` terms lookup on the user index and only the \
+        ids and the hit count are sent back </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format e.g. (united states = "US", france = "FR")
+            user_id (str): user id of the requesting user, its user index document holds the blacklist
+
+        Returns:
+            (list): A list of lomotif ids based on the country user belongs to
+        """
+        lean_config = self.config["lean_retrieval"]
+        filters = [{ "term":  { "moderation_status.keyword": "ACCEPT" }}]
+        if lean_config["max_age_days"]:
+            # keeps the sample among recent assets like the creation date sorted pool does
+            filters.append({"range": {"creation_date": {"gte": f"now-{lean_config['max_age_days']}d/d"}}})
+        must_not = []
+        if user_id:
+            must_not.append({"terms": {"lomotif_id.keyword": {"index": self.config["ES_USER_INDEX_NAME"],
+                                                               "id": user_id,
+                                                               "path": "user_blacklist"}}})
+        lean_query = {
+            "size": lean_config["sample_size"],
+            "_source": False,
+            "track_total_hits": FULL_SAMPLE_MIN_RECORDS,
+            "query": {
+                "function_score": {
+                    "query": {
+                        "bool": {
+                            "must": [{ "match": {"production_country" : user_country}}],
+                            "must_not": must_not,
+                            "filter": filters,
                         }
-                resp = self.es.search(index = self.config["ES_INDEX_NAME"], body= less_record_query)
-                resp = resp['hits']['hits']
-                # print(len(resp))
-                # assetList = [resp[e]['_source']["lomotif_id"] for e in range(len(resp))]
-                assetList = [resp[e]["_id"] for e in range(len(resp))]
-                # assetList = list(set(assetList) - set(assets))
-                # print(assetList)
-                # sample_count = int(0.5 * float(rec_count))
-                candidate_list = random.sample(assetList, int(0.3 * float(rec_count)))
-                logger.info("Candidate list successfully retrieved")
-                return candidate_list
-        except:
-            logger.info(f"Got the following exception: {traceback.format_exc()}")
-            # file_logger.info(f"{traceback.print_exc()}") 
-        # return resp
+                    },
+                    "random_score": {},
+                    "boost_mode": "replace",
+                }
+            },
+        }
+        resp = await self.es.search(index = self.config["ES_INDEX_NAME"], body= lean_query,
+                                    filter_path = LEAN_FILTER_PATH)
+        rec_count = resp["hits"]["total"]["value"]
+        # filter_path drops the hits list altogether when nothing matched
+        candidate_list = [hit["_id"] for hit in resp["hits"].get("hits", [])]
+        if rec_count < FULL_SAMPLE_MIN_RECORDS:
+            candidate_list = candidate_list[:int(0.3 * float(rec_count))]
+        return candidate_list
+
+    async def es_retrieve_candidates(self, user_country, user_id = None):
+        """ ** Description: ** <em> This function returns a set of lomotif ids that will be passed \
+        on to the ML model for ranking purpose. In the default `pool` mode the blacklist lookup and the candidate pool \
+        lookup are independent and run concurrently with the user candidate sources, blacklisted assets are removed \
+        and candidates are then sampled from every source in memory, see `merge_sources`. In `lean` mode \
+        everything is done by a single ES query, see `lean_retrieve_candidates` </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format e.g. (united states = "US", france = "FR")
+            user_id (str): user id of the requesting user, used to look up the blacklist
+
+        Returns:
+            (list): A list of lomotif ids based on the country user belongs to, empty when ES holds no lomotif for \
+            the country. ES errors are raised, see `fallback_candidates`
+        """
+        logger.debug("Retrieving candidate list from ES Index")
+        if self.config["retrieval_mode"] == "lean":
+            candidate_list = await self.lean_retrieve_candidates(user_country, user_id)
+        else:
+            blacklist, pool, user_candidates = await asyncio.gather(self.blacklist_filter.get(user_id),
+                                                                    self.get_candidate_pool(user_country),
+                                                                    self.fetch_user_sources(user_country, user_id))
+            candidate_list = self.merge_sources(pool, blacklist, user_candidates) if pool.record_count else []
+        if len(candidate_list) == 0:
+            logger.info(f"no lomotif in ES DB for {user_country}")
+        else:
+            logger.debug("Candidate list successfully retrieved")
+        return candidate_list
+
+    def fallback_candidates(self, user_country, user_id = None):
+        """ ** Description: ** <em> This function samples candidates without any ES call, from the cached pool of the \
+        country however old it is, filtered with the user's cached blacklist. It is the fallback when retrieval fails or \
+        runs out of time </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format
+            user_id (str): user id of the requesting user
+
+        Returns:
+            (list): lomotif ids sampled from the country sources, empty when the country has no cached pool
+        """
+        pool = None if self.pool_cache is None else self.pool_cache.peek(user_country)
+        if pool is None or pool.record_count == 0:
+            return []
+        return self.merge_sources(pool, self.blacklist_filter.peek(user_id), {})
+
+    async def wait_for_pool(self, user_country):
+        """ ** Description: ** <em> This function waits for the candidate pool of a country that has none cached yet, \
+        starting its load unless one is in flight. The load is shielded, it keeps running and fills the cache when the \
+        caller gives up waiting </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format
+
+        Returns:
+            (bool): whether the country has a cached pool
+        """
+        if self.pool_cache is None:
+            return False
+        if self.pool_cache.peek(user_country) is None:
+            await asyncio.shield(self.pool_cache.load(user_country))
+        return True
+
+    def popular_candidates(self, user_country, user_id = None, k = 10):
+        """ ** Description: ** <em> This function returns the most viewed assets of the cached pool of the country (the \
+        `popular` source, the newest assets without it), skipping the user's cached blacklist. It is the precomputed \
+        list served when ranking fails or runs out of time </em>
+
+        Args:
+            user_country (str): The country user belongs to in ISO 2 format
+            user_id (str): user id of the requesting user
+            k (int): number of lomotif ids to return
+
+        Returns:
+            (list): up to k lomotif ids, most viewed first, empty when the country has no cached pool
+        """
+        pool = None if self.pool_cache is None else self.pool_cache.peek(user_country)
+        if pool is None or len(pool.assets) == 0:
+            return []
+        positions = pool.sources.get("popular")
+        if positions is None or len(positions) == 0:
+            positions = np.arange(len(pool.assets))
+        blacklist = self.blacklist_filter.peek(user_id)
+        if len(blacklist) > 0:
+            positions = positions[BlacklistFilter.allowed(blacklist, pool.hashes[positions])]
+        return [pool.assets[i] for i in positions[:k]]
 
 # search_sample_asset()
 
@@ -0,0 +1,110 @@
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class AssetFeatureCache:
+    def __init__(self, columns, max_items, ttl_seconds) -> None:
+        """
+        ** Description: ** <em> Size bounded LRU cache of asset features keyed by lomotif id. Features are kept as rows of a
+        preallocated float32 matrix in `columns` order rather than as dicts of strings, an id only maps to its row.
+        Rows older than `ttl_seconds` count as misses so slowly changing features still get picked up. Lookups and
+        inserts are guarded by a lock so the cache can be shared by threads </em>
+
+        Args:
+            columns (list): asset feature names, in the order the rows are stored
+            max_items (int): maximum number of assets held, least recently used assets are evicted first
+            ttl_seconds (float): age after which a cached row is reloaded from the feature store
+        """
+        self.columns = list(columns)
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self._values = np.full((max_items, len(self.columns)), np.nan, dtype=np.float32)
+        self._loaded_at = np.zeros(max_items, dtype=np.float64)
+        self._slots = OrderedDict()
+        self._free = list(range(max_items - 1, -1, -1))
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        """
+        ** Description: ** <em> Share of lookups served from the cache since start up </em>
+
+        Returns:
+            (float): hits / (hits + misses), 0 before the first lookup
+        """
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def get_many(self, ids):
+        """
+        ** Description: ** <em> It copies the cached rows of the given ids into a new matrix. Rows of missing or expired ids
+        are left as NaN and their positions are returned so only those are requested from the feature store </em>
+
+        Args:
+            ids (list): lomotif ids
+
+        Returns:
+            (tuple): float32 matrix of shape (len(ids), len(columns)) and the list of positions that were not cached
+        """
+        values = np.full((len(ids), len(self.columns)), np.nan, dtype=np.float32)
+        missing, positions, slots = [], [], []
+        with self._lock:
+            now = time.monotonic()
+            for i, lomotif_id in enumerate(ids):
+                slot = self._slots.get(lomotif_id)
+                if slot is None:
+                    missing.append(i)
+                    continue
+                if now - self._loaded_at[slot] >= self.ttl_seconds:
+                    self.stats["expired"] += 1
+                    missing.append(i)
+                    continue
+                self._slots.move_to_end(lomotif_id)
+                positions.append(i)
+                slots.append(slot)
+            # copied while holding the lock, a concurrent insert may reuse the slots right after
+            values[positions] = self._values[slots]
+            self.stats["hits"] += len(positions)
+            self.stats["misses"] += len(missing)
+        return values, missing
+
+    def put_many(self, ids, values):
+        """
+        ** Description: ** <em> It stores feature rows, assets that do not exist in the feature store can be stored as NaN
+        rows so they are not requested again until they expire </em>
+
+        Args:
+            ids (list): lomotif ids
+            values (np.ndarray): matrix of shape (len(ids), len(columns)) in `columns` order
+        """
+        slots = []
+        with self._lock:
+            for lomotif_id in ids:
+                slot = self._slots.get(lomotif_id)
+                if slot is not None:
+                    self._slots.move_to_end(lomotif_id)
+                else:
+                    if self._free:
+                        slot = self._free.pop()
+                    else:
+                        _, slot = self._slots.popitem(last=False)
+                        self.stats["evictions"] += 1
+                    self._slots[lomotif_id] = slot
+                slots.append(slot)
+            self._values[slots] = values
+            self._loaded_at[slots] = time.monotonic()
+
+    def clear(self):
+        """
+        ** Description: ** <em> It drops every cached row </em>
+        """
+        with self._lock:
+            self._slots.clear()
+            self._free = list(range(self.max_items - 1, -1, -1))
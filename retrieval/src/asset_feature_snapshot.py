@@ -0,0 +1,191 @@
+import os
+import mmap
+import json
+import time
+import struct
+import threading
+import traceback
+
+import numpy as np
+from logzero import logger
+
+from retrieval.src.blacklist import hash_ids
+
+# file layout, every section starts on an 8 byte boundary:
+#   header    magic, format version, number of rows, number of columns, length of the column names, export time
+#   columns   json list of the feature names, in the column order of the matrix
+#   hashes    uint64[rows], sorted 64 bit hashes of the lomotif ids (see `hash_ids`)
+#   values    float32[rows, columns], row i holds the features of hashes[i], NaN for missing values
+MAGIC = b"ASSETSNP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIQIId")
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_snapshot(path, ids, values, columns):
+    """
+    ** Description: ** <em> It writes asset features to a snapshot file. The file is written next to `path` and renamed
+    over it, so readers only ever see a complete snapshot </em>
+
+    Args:
+        path (str): snapshot file
+        ids (list): lomotif ids
+        values (np.ndarray): float32 matrix of shape (len(ids), len(columns))
+        columns (list): feature names, in the column order of `values`
+
+    Returns:
+        (int): number of rows written, duplicate ids are written once
+    """
+    hashes = hash_ids(ids)
+    hashes, first = np.unique(hashes, return_index=True)
+    values = np.ascontiguousarray(np.asarray(values, dtype=np.float32)[first])
+    names = json.dumps(list(columns)).encode()
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(hashes), len(columns), len(names), time.time())
+    hashes_offset = _align(len(header) + len(names))
+    values_offset = _align(hashes_offset + hashes.nbytes)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(names)
+        f.write(b"\0" * (hashes_offset - len(header) - len(names)))
+        f.write(hashes.tobytes())
+        f.write(b"\0" * (values_offset - hashes_offset - hashes.nbytes))
+        f.write(values.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(hashes)
+
+
+class AssetFeatureSnapshot:
+    def __init__(self, path, columns) -> None:
+        """
+        ** Description: ** <em> Read-only memory mapping of a snapshot file written by `write_snapshot`. The matrix is not
+        copied into the process, pages are shared through the page cache by every worker mapping the same file. A lookup
+        is a `searchsorted` of the id hashes followed by row indexing </em>
+
+        Args:
+            path (str): snapshot file
+            columns (list): asset feature names the caller expects, in the order rows are returned
+        """
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_rows, n_columns, names_length, self.exported_at = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} asset feature snapshot")
+        snapshot_columns = json.loads(self._mmap[HEADER.size:HEADER.size + names_length])
+        missing_columns = [column for column in columns if column not in snapshot_columns]
+        if missing_columns:
+            raise ValueError(f"{path} has no column {missing_columns}")
+        hashes_offset = _align(HEADER.size + names_length)
+        values_offset = _align(hashes_offset + 8 * n_rows)
+        self.path = path
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.columns = list(columns)
+        self.hashes = np.frombuffer(self._mmap, dtype=np.uint64, count=n_rows, offset=hashes_offset)
+        self.values = np.frombuffer(self._mmap, dtype=np.float32, count=n_rows * n_columns,
+                                    offset=values_offset).reshape(n_rows, n_columns)
+        self._column_index = np.asarray([snapshot_columns.index(column) for column in columns], dtype=np.intp)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def get_many(self, ids):
+        """
+        ** Description: ** <em> It copies the rows of the given ids into a new matrix </em>
+
+        Args:
+            ids (list): lomotif ids
+
+        Returns:
+            (tuple): float32 matrix of shape (len(ids), len(columns)), NaN rows for ids not in the snapshot, and the list of
+            positions that were not in the snapshot
+        """
+        values = np.full((len(ids), len(self.columns)), np.nan, dtype=np.float32)
+        if len(self.hashes) == 0:
+            return values, list(range(len(ids)))
+        hashes = hash_ids(ids)
+        idx = np.searchsorted(self.hashes, hashes)
+        idx[idx == len(self.hashes)] = 0
+        found = self.hashes[idx] == hashes
+        values[found] = self.values[idx[found]][:, self._column_index]
+        return values, np.flatnonzero(~found).tolist()
+
+
+class AssetFeatureSnapshotReader:
+    def __init__(self, path, columns, check_seconds) -> None:
+        """
+        ** Description: ** <em> It serves lookups from the newest snapshot at `path`. At most every `check_seconds` the
+        file is checked for a replacement, a new snapshot is mapped and swapped in with a single reference assignment.
+        Lookups in flight keep using the snapshot they started with, the old mapping is released once they are done.
+        Without a readable snapshot every id is reported missing </em>
+
+        Args:
+            path (str): snapshot file written by `write_snapshot`
+            columns (list): asset feature names, in the order rows are returned
+            check_seconds (float): interval between two checks for a new snapshot
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.check_seconds = check_seconds
+        self.snapshot = None
+        self._checked_at = -float("inf")
+        self._lock = threading.Lock()
+        self._last_error = None
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "load_errors": 0}
+
+    def maybe_reload(self):
+        """
+        ** Description: ** <em> It maps the snapshot file again if it was replaced since it was last mapped </em>
+        """
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            stat = os.stat(self.path)
+            if self.snapshot is not None and self.snapshot.identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                return
+            snapshot = AssetFeatureSnapshot(self.path, self.columns)
+            self.snapshot = snapshot
+            self.stats["reloads"] += 1
+            self._last_error = None
+            logger.info(f"Mapped asset feature snapshot {self.path} with {len(snapshot)} assets")
+        except Exception as e:
+            self.stats["load_errors"] += 1
+            # a missing snapshot is logged once, not on every check
+            if repr(e) != self._last_error:
+                self._last_error = repr(e)
+                if isinstance(e, FileNotFoundError):
+                    logger.info(f"No asset feature snapshot at {self.path}, reading asset features from redis")
+                else:
+                    logger.info(f"Could not map asset feature snapshot {self.path}: {traceback.format_exc()}")
+        finally:
+            self._lock.release()
+
+    def get_many(self, ids):
+        """
+        ** Description: ** <em> It looks the ids up in the current snapshot, see `AssetFeatureSnapshot.get_many` </em>
+
+        Args:
+            ids (list): lomotif ids
+
+        Returns:
+            (tuple): float32 matrix of shape (len(ids), len(columns)) and the list of positions not in the snapshot
+        """
+        self.maybe_reload()
+        snapshot = self.snapshot
+        if snapshot is None:
+            values, missing = np.full((len(ids), len(self.columns)), np.nan, dtype=np.float32), list(range(len(ids)))
+        else:
+            values, missing = snapshot.get_many(ids)
+        self.stats["hits"] += len(ids) - len(missing)
+        self.stats["misses"] += len(missing)
+        return values, missing
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import threading
+import traceback
+from collections import OrderedDict
+from hashlib import blake2b
+
+import numpy as np
+from logzero import logger
+
+EMPTY_BLACKLIST = np.empty(0, dtype=np.uint64)
+# bytes charged per cached user on top of its hashes (key, entry tuple, array header, LRU node), so users without a
+# blacklist still count toward `max_bytes`
+ENTRY_OVERHEAD_BYTES = 256
+
+
+def hash_ids(ids):
+    """
+    ** Description: ** <em> It maps lomotif ids to 64 bit hashes. Blacklists and candidate pools are compared on these
+    hashes, 8 bytes per id instead of a python string, and the collision probability is negligible at our scale </em>
+
+    Args:
+        ids (list): lomotif ids
+
+    Returns:
+        (np.ndarray): uint64 hashes in the order of `ids`
+    """
+    return np.fromiter((int.from_bytes(blake2b(i.encode(), digest_size=8).digest(), "little") for i in ids),
+                       dtype=np.uint64, count=len(ids))
+
+
+class BlacklistFilter:
+    def __init__(self, loader, max_bytes, ttl_seconds) -> None:
+        """
+        ** Description: ** <em> In-process store of per-user blacklists. Every blacklist is kept as a sorted array of id
+        hashes so membership checks for a whole candidate pool are a single `searchsorted`. Users are evicted in LRU order
+        once the arrays and a fixed overhead per user (`ENTRY_OVERHEAD_BYTES`) together exceed `max_bytes`, and
+        blacklists older than `ttl_seconds` are reloaded. Concurrent loads of the same user share one ES lookup. The LRU
+        is guarded by a lock so the filter can be shared by threads </em>
+
+        Args:
+            loader (coroutine function): called with the user id, returns the user's blacklisted lomotif ids
+            max_bytes (int): memory budget for all cached blacklists, overhead per user included
+            ttl_seconds (float): age after which a blacklist is reloaded
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.nbytes = 0
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "load_errors": 0}
+        self._lock = threading.Lock()
+
+    async def get(self, user_id):
+        """
+        ** Description: ** <em> It returns the blacklist of the user, loading it when it is not cached or expired. A failed
+        load is not cached and yields an empty blacklist </em>
+
+        Args:
+            user_id (str): user id of the requesting user
+
+        Returns:
+            (np.ndarray): sorted uint64 hashes of the blacklisted lomotif ids
+        """
+        if not user_id:
+            return EMPTY_BLACKLIST
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(user_id)
+                self.stats["hits"] += 1
+                return entry[0]
+        task = self._inflight.get(user_id)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._load(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        # shield so that a cancelled request does not cancel the load other requests are waiting on
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id):
+        try:
+            blacklist = np.unique(hash_ids(await self.loader(user_id)))
+        except Exception:
+            self.stats["load_errors"] += 1
+            logger.info(f"Could not load blacklist of user {user_id}: {traceback.format_exc()}")
+            return EMPTY_BLACKLIST
+        with self._lock:
+            self._put(user_id, blacklist)
+        return blacklist
+
+    def peek(self, user_id):
+        """
+        ** Description: ** <em> It returns the cached blacklist of the user whatever its age, without loading it </em>
+
+        Args:
+            user_id (str): user id of the requesting user
+
+        Returns:
+            (np.ndarray): sorted uint64 hashes of the blacklisted lomotif ids, empty when the user is not cached
+        """
+        if not user_id:
+            return EMPTY_BLACKLIST
+        with self._lock:
+            entry = self._entries.get(user_id)
+        return EMPTY_BLACKLIST if entry is None else entry[0]
+
+    @staticmethod
+    def allowed(blacklist, hashes):
+        """
+        ** Description: ** <em> It checks which hashes are not part of the blacklist </em>
+
+        Args:
+            blacklist (np.ndarray): sorted blacklist returned by `get`
+            hashes (np.ndarray): hashes of the candidates, see `hash_ids`
+
+        Returns:
+            (np.ndarray): boolean mask, True for candidates that are not blacklisted
+        """
+        if len(blacklist) == 0:
+            return np.ones(len(hashes), dtype=bool)
+        idx = np.searchsorted(blacklist, hashes)
+        idx[idx == len(blacklist)] = 0
+        return blacklist[idx] != hashes
+
+    def _put(self, user_id, blacklist):
+        previous = self._entries.pop(user_id, None)
+        if previous is not None:
+            self.nbytes -= previous[0].nbytes + ENTRY_OVERHEAD_BYTES
+        self._entries[user_id] = (blacklist, time.monotonic())
+        self.nbytes += blacklist.nbytes + ENTRY_OVERHEAD_BYTES
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes + ENTRY_OVERHEAD_BYTES
+            self.stats["evictions"] += 1
@@ -0,0 +1,138 @@
+import asyncio
+import time
+import traceback
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+from logzero import logger
+
+
+class CandidatePool(NamedTuple):
+    """
+    ** Description: ** <em> Accepted lomotif ids of a country, the union of its candidate sources (newest first for
+    the `recent` source), together with the number of records ES holds for the country, the id hashes used for
+    blacklist filtering, per source, the positions of its assets in `assets` in source order and the pre-score of every
+    asset (None when pre-ranking is off), see `PreRanker` </em>
+    """
+    assets: list
+    record_count: int
+    hashes: np.ndarray
+    sources: dict = {}
+    scores: np.ndarray = None
+
+
+class CandidatePoolCache:
+    def __init__(self, loader, ttl_seconds, max_stale_seconds, max_entries) -> None:
+        """
+        ** Description: ** <em> In-process cache of candidate pools keyed by country. Entries younger than `ttl_seconds`
+        are served as is, older entries are still served while a single background refresh reloads them, and entries
+        older than `max_stale_seconds` are reloaded before being served. Concurrent loads of the same country share
+        one in-flight ES query so an expired hot country does not cause a stampede. Keys come from the requests, so at
+        most `max_entries` countries are kept and the least recently used are evicted first </em>
+
+        Args:
+            loader (coroutine function): called with the country, returns the `CandidatePool` to cache
+            ttl_seconds (float): age after which an entry gets refreshed in the background
+            max_stale_seconds (float): age after which an entry is no longer served
+            max_entries (int): maximum number of cached countries
+        """
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max(max_stale_seconds, ttl_seconds)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0, "evictions": 0}
+
+    async def get(self, key):
+        """
+        ** Description: ** <em> It returns the cached pool for the key, loading or refreshing it when needed </em>
+
+        Args:
+            key (str): country in ISO 2 format
+
+        Returns:
+            (CandidatePool): the cached candidate pool
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            value, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age < self.ttl_seconds:
+                self.stats["hits"] += 1
+                return value
+            if age < self.max_stale_seconds:
+                self.stats["stale_hits"] += 1
+                self._refresh(key)
+                return value
+        self.stats["misses"] += 1
+        # shield so that a cancelled request does not cancel the load other requests are waiting on
+        return await asyncio.shield(self._refresh(key))
+
+    def peek(self, key):
+        """
+        ** Description: ** <em> It returns the cached pool for the key whatever its age, without loading or refreshing
+        it </em>
+
+        Args:
+            key (str): country in ISO 2 format
+
+        Returns:
+            (CandidatePool): the cached candidate pool, None when the country was never loaded
+        """
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+    def load(self, key):
+        """
+        ** Description: ** <em> It starts loading the pool of the key unless a load is already in flight, without
+        waiting for it </em>
+
+        Args:
+            key (str): country in ISO 2 format
+
+        Returns:
+            (asyncio.Future): the in-flight load, await it through `asyncio.shield` to leave it running on cancellation
+        """
+        return self._refresh(key)
+
+    def invalidate(self, key=None):
+        """
+        ** Description: ** <em> It drops the cached pool of a country, or of every country when no key is given </em>
+
+        Args:
+            key (str): country in ISO 2 format
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def _refresh(self, key):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_loaded(key, t))
+        return task
+
+    def _on_loaded(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["refresh_errors"] += 1
+
+    async def _load(self, key):
+        self.stats["refreshes"] += 1
+        try:
+            value = await self.loader(key)
+        except:
+            logger.info(f"Could not refresh candidate pool for {key}: {traceback.format_exc()}")
+            raise
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return value
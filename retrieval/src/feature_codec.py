@@ -0,0 +1,171 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+KEY_PREFIX = "recommendations_preprocessing"
+# magic, format version, number of values and schema fingerprint, 12 bytes so the float32 values stay 4 byte aligned
+HEADER = struct.Struct("<2sBxHxxI")
+MAGIC = b"RF"
+FORMAT_VERSION = 1
+ENCODINGS = ("hash", "vector", "dual")
+
+
+def schema_fingerprint(columns):
+    """
+    ** Description: ** <em> It identifies an ordered list of feature names, the fingerprint is part of every vector </em>
+
+    Args:
+        columns (list): feature names in vector order
+
+    Returns:
+        (int): crc32 of the names
+    """
+    return zlib.crc32("\x1f".join(columns).encode())
+
+
+def schema_key(entity, fingerprint):
+    """
+    ** Description: ** <em> Redis key of the feature names (JSON list) of a schema </em>
+    """
+    return f"{KEY_PREFIX}_{entity}_f32_schema:{fingerprint:08x}"
+
+
+class FeatureCodec:
+    def __init__(self, entity, columns) -> None:
+        """
+        ** Description: ** <em> Compact encoding of the features of an asset or user: a header followed by the values as
+        packed little-endian float32 in `columns` order, NaN for missing values, stored as a redis string next to (or
+        instead of) the hash of decimal strings. Vectors written with another list of features are mapped to `columns`
+        by name once their schema is known, see `add_schema`, so the feature list can change during a rollout </em>
+
+        Args:
+            entity (str): asset or user
+            columns (list): feature names the reader wants, in matrix column order
+        """
+        self.entity = entity
+        self.columns = list(columns)
+        self.fingerprint = schema_fingerprint(self.columns)
+        self.header = HEADER.pack(MAGIC, FORMAT_VERSION, len(self.columns), self.fingerprint)
+        self.nbytes = HEADER.size + 4 * len(self.columns)
+        # per fingerprint, the position of every wanted column in the written vector (-1 when it was not written),
+        # None for fingerprints whose schema is not in the feature store
+        self._layouts = {self.fingerprint: np.arange(len(self.columns))}
+        self.stats = {"decoded": 0, "missing": 0, "remapped": 0, "unknown_schema": 0, "corrupt": 0}
+
+    def key(self, entity_id):
+        """
+        ** Description: ** <em> Redis key of the vector of an asset or user </em>
+        """
+        return f"{KEY_PREFIX}_{self.entity}_f32:{entity_id}"
+
+    def schema_record(self):
+        """
+        ** Description: ** <em> The key and value that publish the schema of the vectors this codec writes </em>
+
+        Returns:
+            (tuple): schema key and the JSON list of the feature names
+        """
+        return schema_key(self.entity, self.fingerprint), json.dumps(self.columns)
+
+    def encode_many(self, values):
+        """
+        ** Description: ** <em> It encodes the rows of a matrix </em>
+
+        Args:
+            values (np.ndarray): matrix of shape (n, len(columns)), NaN for missing values
+
+        Returns:
+            (list): one bytes vector per row
+        """
+        values = np.ascontiguousarray(values, dtype="<f4").reshape(-1, len(self.columns))
+        return [self.header + row.tobytes() for row in values]
+
+    def unknown_fingerprints(self, blobs):
+        """
+        ** Description: ** <em> Fingerprints of vectors written with a schema the codec has not seen yet </em>
+
+        Args:
+            blobs (list): vectors as returned by `MGET`, None for missing keys
+
+        Returns:
+            (set): fingerprints to look up with `schema_key` and pass to `add_schema`
+        """
+        unknown = set()
+        for blob in blobs:
+            if blob is not None and len(blob) >= HEADER.size and not blob.startswith(self.header):
+                fingerprint = HEADER.unpack_from(blob)[3]
+                if fingerprint not in self._layouts:
+                    unknown.add(fingerprint)
+        return unknown
+
+    def add_schema(self, fingerprint, columns):
+        """
+        ** Description: ** <em> It registers the feature names of a fingerprint, vectors of unknown schemas are treated
+        as missing </em>
+
+        Args:
+            fingerprint (int): schema fingerprint
+            columns (list): feature names in vector order, None when the schema is not in the feature store
+        """
+        if columns is None:
+            self._layouts[fingerprint] = None
+            return
+        position = {column: i for i, column in enumerate(columns)}
+        self._layouts[fingerprint] = np.array([position.get(column, -1) for column in self.columns], dtype=np.intp)
+
+    def decode_many(self, blobs):
+        """
+        ** Description: ** <em> It decodes vectors into a matrix with `np.frombuffer`, no text is parsed. When every
+        vector has the codec's own schema, all of them are decoded with a single `np.frombuffer` over their
+        concatenation </em>
+
+        Args:
+            blobs (list): vectors as returned by `MGET`, None for missing keys
+
+        Returns:
+            (tuple): float32 matrix of shape (len(blobs), len(columns)) and the positions without a usable vector
+        """
+        if blobs and all(blob is not None and len(blob) == self.nbytes and blob.startswith(self.header)
+                         for blob in blobs):
+            self.stats["decoded"] += len(blobs)
+            rows = np.frombuffer(b"".join(blobs), dtype="<f4").reshape(len(blobs), -1)
+            return rows[:, HEADER.size // 4:].astype(np.float32), []
+        values = np.full((len(blobs), len(self.columns)), np.nan, dtype=np.float32)
+        missing = []
+        for i, blob in enumerate(blobs):
+            row = self._decode(blob)
+            if row is None:
+                missing.append(i)
+            else:
+                values[i] = row
+        self.stats["decoded"] += len(blobs) - len(missing)
+        return values, missing
+
+    def _decode(self, blob):
+        if blob is None:
+            self.stats["missing"] += 1
+            return None
+        if len(blob) < HEADER.size:
+            self.stats["corrupt"] += 1
+            return None
+        magic, version, n_values, fingerprint = HEADER.unpack_from(blob)
+        if magic != MAGIC or version != FORMAT_VERSION or len(blob) != HEADER.size + 4 * n_values:
+            self.stats["corrupt"] += 1
+            return None
+        layout = self._layouts.get(fingerprint)
+        if layout is None:
+            self.stats["unknown_schema"] += 1
+            return None
+        if (fingerprint == self.fingerprint and n_values != len(self.columns)) or layout.max(initial=-1) >= n_values:
+            self.stats["corrupt"] += 1
+            return None
+        vector = np.frombuffer(blob, dtype="<f4", count=n_values, offset=HEADER.size)
+        if fingerprint == self.fingerprint:
+            return vector
+        self.stats["remapped"] += 1
+        row = np.full(len(self.columns), np.nan, dtype=np.float32)
+        written = layout >= 0
+        row[written] = vector[layout[written]]
+        return row
@@ -1,87 +1,361 @@
 import warnings
 warnings.filterwarnings("ignore")
 import os
-import redis
-import pandas as pd
+import json
+import math
+import redis.asyncio as redis
+import numpy as np
 from logzero import logger
 import traceback
+from typing import NamedTuple
 from dotenv import load_dotenv
+from utils import get_config
+from retrieval.src.asset_feature_cache import AssetFeatureCache
+from retrieval.src.asset_feature_snapshot import AssetFeatureSnapshotReader
+from retrieval.src.feature_codec import ENCODINGS, FeatureCodec, schema_key
+from serving.deadline import hedged
 
 load_dotenv("./.env")
 KEY_PREFIX = "recommendations_preprocessing"
 
+class FeatureBatch(NamedTuple):
+    """
+    ** Description: ** <em> Model input for one request, a float32 matrix whose columns follow `columns` and the lomotif
+    id of every row. `columns` is `prediction_features` when user features were found, `cold_start_features` otherwise </em>
+    """
+    ids: np.ndarray
+    features: np.ndarray
+    columns: list
+
 class GetFeaturesFromFS:
     def __init__(self) -> None:
         """
-        ** Description: ** <em> The function tries to connect to the feature store and if it fails, it logs the exception </em>
+        ** Description: ** <em> The function sets up the local asset feature cache and snapshot. The feature store clients
+        are created by `connect`, in the serving process once its event loop runs, so a gunicorn master that imported
+        the service never holds a connection its forked workers would share. The object holds no per request state,
+        every call uses its own pipeline, so it can serve any number of concurrent requests. Every call has a socket
+        timeout and reads not answered within `deadlines.hedge_after_ms` are sent again, see `read`. Features are read
+        as hashes of decimal strings, as packed float32 vectors or both, see `feature_encoding` in config.yml and
+        `retrieval.src.feature_codec` </em>
+        """
+        self.config = get_config()
+        deadline_config = self.config["deadlines"]
+        self.hedge_after = deadline_config["hedge_after_ms"] / 1000.0 if deadline_config["hedge_after_ms"] else None
+        self.stats = {"hedged": 0, "hedge_wins": 0}
+        self.asset_columns = self.config["asset_features"]
+        self.user_columns = self.config["user_features"]
+        self.prediction_columns = self.config["prediction_features"]
+        self.cold_start_columns = self.config["cold_start_features"]
+        self.encoding = self.config["feature_encoding"]["read"]
+        if self.encoding not in ENCODINGS:
+            raise ValueError(f"feature_encoding.read must be one of {ENCODINGS}, not {self.encoding!r}")
+        self.asset_codec = FeatureCodec("asset", self.asset_columns)
+        self.user_codec = FeatureCodec("user", self.user_columns)
+        self.asset_fs = self.user_fs = self.asset_fs_raw = self.user_fs_raw = None
+        cache_config = self.config["asset_feature_cache"]
+        self.asset_cache = None
+        if cache_config["enabled"]:
+            self.asset_cache = AssetFeatureCache(self.asset_columns,
+                                                 max_items=cache_config["max_items"],
+                                                 ttl_seconds=cache_config["ttl_seconds"])
+        snapshot_config = self.config["asset_feature_snapshot"]
+        self.asset_snapshot = None
+        if snapshot_config["enabled"]:
+            self.asset_snapshot = AssetFeatureSnapshotReader(snapshot_config["path"], self.asset_columns,
+                                                             check_seconds=snapshot_config["check_seconds"])
+
+    def connection_pool(self, db, decode_responses=True):
+        """
+        ** Description: ** <em> It creates a bounded connection pool to a db of the feature store redis. A burst of
+        requests waits for a free connection instead of opening new ones, and every connection and command is cut off
+        after `redis_timeout_seconds` </em>
+
+        Args:
+            db (str): redis db number
+            decode_responses (bool): whether replies are decoded to str
+
+        Returns:
+            (redis.BlockingConnectionPool): the pool, no connection is opened until the first command
+        """
+        pool_config = self.config["feature_store_pool"]
+        redis_timeout = self.config["deadlines"]["redis_timeout_seconds"]
+        return redis.BlockingConnectionPool(host=os.environ["REDIS_IP"],
+                                            port=os.environ["REDIS_PORT"],
+                                            db=db,
+                                            decode_responses=decode_responses,
+                                            max_connections=pool_config["max_connections"],
+                                            timeout=pool_config["timeout_seconds"],
+                                            socket_timeout=redis_timeout,
+                                            socket_connect_timeout=redis_timeout)
+
+    def create_clients(self):
+        """
+        ** Description: ** <em> It creates the async clients of both feature stores, if it fails, it logs the exception.
+        Both clients draw from explicitly sized connection pools (shared when both stores live in the same db), vectors
+        are read as raw bytes from pools of their own. No connection is opened until the first command </em>
         """
         try:
             logger.info("Connecting to feature store")
-            self.asset_fs = redis.StrictRedis(host=os.environ["REDIS_IP"], 
-                                              port=os.environ["REDIS_PORT"], 
-                                              db=os.environ["ASSET_FS_DB"], 
-                                              decode_responses=True)
-            self.user_fs = redis.StrictRedis(host=os.environ["REDIS_IP"], 
-                                             port=os.environ["REDIS_PORT"], 
-                                             db=os.environ["USER_FS_DB"], 
-                                             decode_responses=True)
-            self.asset_pipe = self.asset_fs.pipeline()
-            if self.asset_fs.ping() and self.user_fs.ping():
+            pools = {}
+            # vectors are read as bytes, decoding is a property of the connection so they get pools of their own
+            decodings = (True,) if self.encoding == "hash" else (True, False)
+            for db in {os.environ["ASSET_FS_DB"], os.environ["USER_FS_DB"]}:
+                for decode_responses in decodings:
+                    pools[db, decode_responses] = self.connection_pool(db, decode_responses)
+            self.asset_fs = redis.StrictRedis(connection_pool=pools[os.environ["ASSET_FS_DB"], True])
+            self.user_fs = redis.StrictRedis(connection_pool=pools[os.environ["USER_FS_DB"], True])
+            if self.encoding != "hash":
+                self.asset_fs_raw = redis.StrictRedis(connection_pool=pools[os.environ["ASSET_FS_DB"], False])
+                self.user_fs_raw = redis.StrictRedis(connection_pool=pools[os.environ["USER_FS_DB"], False])
+        except:
+            logger.info(f"Got the following exception: {traceback.format_exc()}")
+
+    async def connect(self):
+        """
+        ** Description: ** <em> It creates the feature store clients unless they were set already and pings both feature
+        stores, it logs whether the connection could be established </em>
+        """
+        if self.asset_fs is None:
+            self.create_clients()
+        try:
+            if await self.asset_fs.ping() and await self.user_fs.ping():
                 logger.info("Connection to feature store successfully established !!!")
             else:
                 logger.info("Couldnt connect to Redis !!!")
         except:
-            logger.info(f"Got the following exception: {traceback.format_exc()}")    
+            logger.info(f"Got the following exception: {traceback.format_exc()}")
+
+    async def close(self):
+        """
+        ** Description: ** <em> It closes the connection pools of both feature stores </em>
+        """
+        for fs in (self.asset_fs, self.user_fs, self.asset_fs_raw, self.user_fs_raw):
+            if fs is not None:
+                await fs.aclose()
+                await fs.connection_pool.disconnect()
 
-    def get_asset_features_from_fs(self, candidate_list):
-        """ ** Description: ** <em> This function fetches the lomotif level features from the feature store </em>
+    async def read(self, call):
+        """ ** Description: ** <em> It runs an idempotent feature store read, hedged with a second read on another \
+        connection when the first one is slow </em>
+
+        Args:
+            call (coroutine function): the read, called without arguments
+
+        Returns:
+            the result of the read
+        """
+        if self.hedge_after is None:
+            return await call()
+        return await hedged(call, self.hedge_after, self.stats)
+
+    def decode_asset_features(self, asset_data):
+        """ ** Description: ** <em> This function parses asset hashes from the feature store into a float32 matrix </em>
+
+        Args:
+            asset_data (list): asset hashes as returned by `hgetall`, empty for assets not in the feature store
+
+        Returns:
+            (np.ndarray): matrix of shape (len(asset_data), len(asset_features)), missing values are NaN
+        """
+        return np.array([[float(record.get(column, "nan")) for column in self.asset_columns] for record in asset_data],
+                        dtype=np.float32).reshape(len(asset_data), len(self.asset_columns))
+
+    async def fetch_vectors(self, fs, codec, ids):
+        """ ** Description: ** <em> This function reads feature vectors with a single `MGET` over raw bytes. Schemas of \
+        vectors written with another feature list are read once and kept by the codec </em>
+
+        Args:
+            fs (redis.StrictRedis): raw (not decoding) client of the feature store
+            codec (FeatureCodec): codec of the entity
+            ids (list): lomotif or user ids
+
+        Returns:
+            (tuple): float32 matrix of shape (len(ids), len(codec.columns)) and the positions without a vector
+        """
+        if len(ids) == 0:
+            return np.empty((0, len(codec.columns)), dtype=np.float32), []
+        blobs = await self.read(lambda: fs.mget([codec.key(i) for i in ids]))
+        for fingerprint in codec.unknown_fingerprints(blobs):
+            columns = await fs.get(schema_key(codec.entity, fingerprint))
+            codec.add_schema(fingerprint, None if columns is None else json.loads(columns))
+        return codec.decode_many(blobs)
+
+    async def fetch_asset_features(self, candidate_list):
+        """ ** Description: ** <em> This function reads asset features from redis, bypassing the local cache. Vectors \
+        are read first in `dual` mode, hashes only for the assets without one </em>
+
+        Args:
+            candidate_list (list): lomotif ids
+
+        Returns:
+            (np.ndarray): matrix of shape (len(candidate_list), len(asset_features)), missing values are NaN
+        """
+        if self.encoding == "hash":
+            return await self.fetch_asset_hashes(candidate_list)
+        values, missing = await self.fetch_vectors(self.asset_fs_raw, self.asset_codec, candidate_list)
+        if missing and self.encoding == "dual":
+            values[missing] = await self.fetch_asset_hashes([candidate_list[i] for i in missing])
+        return values
+
+    async def fetch_asset_hashes(self, candidate_list):
+        """ ** Description: ** <em> This function reads asset hashes of decimal strings with pipelined `hgetall` </em>
+
+        Args:
+            candidate_list (list): lomotif ids
+
+        Returns:
+            (np.ndarray): matrix of shape (len(candidate_list), len(asset_features)), missing values are NaN
+        """
+        async def read():
+            # a pipeline per call, a shared one would interleave commands of concurrent requests
+            async with self.asset_fs.pipeline(transaction=False) as asset_pipe:
+                for item in candidate_list:
+                    asset_key = KEY_PREFIX + "_asset:" + item
+                    asset_pipe.hgetall(asset_key)
+                return await asset_pipe.execute()
+        return self.decode_asset_features(await self.read(read))
+
+    async def get_cached_asset_features(self, candidate_list):
+        """ ** Description: ** <em> This function reads asset features through the local cache, only cache misses are \
+        read from the feature store </em>
+
+        Args:
+            candidate_list (list): lomotif ids
+
+        Returns:
+            (np.ndarray): matrix of shape (len(candidate_list), len(asset_features)), missing values are NaN
+        """
+        if self.asset_cache is None:
+            return await self.fetch_asset_features(candidate_list)
+        values, missing = self.asset_cache.get_many(candidate_list)
+        if missing:
+            missing_ids = [candidate_list[i] for i in missing]
+            missing_values = await self.fetch_asset_features(missing_ids)
+            # unknown assets are cached as NaN rows too so they are not requested on every call
+            self.asset_cache.put_many(missing_ids, missing_values)
+            values[missing] = missing_values
+        return values
+
+    async def get_asset_features_from_fs(self, candidate_list):
+        """ ** Description: ** <em> This function fetches the lomotif level features, from the memory-mapped snapshot \
+        first, assets that are not in the snapshot are read through the local cache and the feature store </em>
 
         Args:
             candidate_list (list): list of lomotif ids generated from (ES DB) retrieval step
 
         Returns:
-            (pd.DataFrame): returns only asset level features from feature store
+            (np.ndarray): float32 matrix of asset level features in `asset_features` order, one row per candidate, \
+            NaN for assets missing from the feature store
         """
-        try:
-            logger.info("Retrieving asset feature from feature store")
-            for item in candidate_list:
-                asset_key = KEY_PREFIX + "_asset:" + item
-                self.asset_pipe.hgetall(asset_key)
-            asset_data = self.asset_pipe.execute()
-            self.model_df = pd.DataFrame.from_records(asset_data)           
-            self.model_df["lomotif_id"] = candidate_list
-            self.model_df.dropna(inplace=True)
-            return self.model_df
-        except: 
-            logger.info(f"Got the following exception: {traceback.format_exc()}")
+        logger.debug("Retrieving asset feature from feature store")
+        if self.asset_snapshot is None:
+            return await self.get_cached_asset_features(candidate_list)
+        values, missing = self.asset_snapshot.get_many(candidate_list)
+        if missing:
+            values[missing] = await self.get_cached_asset_features([candidate_list[i] for i in missing])
+        return values
+
+    def get_local_asset_features(self, candidate_list):
+        """ ** Description: ** <em> This function reads asset features from the snapshot and the local cache only, \
+        without a feature store call. It is the fallback when the feature store is slow or down </em>
+
+        Args:
+            candidate_list (list): lomotif ids
 
-    def get_user_features_from_fs(self, user_id=None):
-        """ ** Description: ** <em> This function fetches the user level features from the feature store and aggregates it with asset (lomotif) level features and makes it consumable for the recommendations model </em>
+        Returns:
+            (np.ndarray): float32 matrix of asset level features in `asset_features` order, NaN for assets that are \
+            neither in the snapshot nor cached
+        """
+        values = np.full((len(candidate_list), len(self.asset_columns)), np.nan, dtype=np.float32)
+        missing = list(range(len(candidate_list)))
+        if self.asset_snapshot is not None:
+            values, missing = self.asset_snapshot.get_many(candidate_list)
+        if missing and self.asset_cache is not None:
+            cached, _ = self.asset_cache.get_many([candidate_list[i] for i in missing])
+            values[missing] = cached
+        return values
+
+    async def get_user_features_from_fs(self, user_id=None):
+        """ ** Description: ** <em> This function fetches the user level features from the feature store. It does not depend
+        on the candidate set so it can run concurrently with the retrieval step </em>
 
         Args:
             user_id (str): user_id for which the feature needs to be retreived from the feature store
 
         Returns:
-            (pd.DataFrame): if user details exists returns combined (asset + user) features \
-            else returns only asset level features from feature store
+            (dict): user level features, empty if the user does not exist in the feature store
         """
-        try:
-            if user_id == None:
-                return self.model_df
-            
+        if not user_id:
+            return {}
+        if self.encoding == "hash":
             user_key = KEY_PREFIX + "_user:" + user_id
-            print(user_key)
-            user_data = self.user_fs.hgetall(user_key)
-            logger.info(user_data)
-            # If the user_data is empty, then it will return the model_df.
-            if len(user_data) == 0:
-                logger.warn("No user details found in feature store, returning only lomotif level info !!!")
-                return self.model_df
+            user_data = await self.read(lambda: self.user_fs.hgetall(user_key))
+        else:
+            user_data = (await self.get_users_features_from_fs([user_id]))[0]
+        if len(user_data) == 0:
+            logger.debug("No user details found in feature store, returning only lomotif level info !!!")
+        return user_data
+
+    async def get_users_features_from_fs(self, user_ids):
+        """ ** Description: ** <em> This function fetches the user level features of many users in a single pipelined \
+        round trip, an `MGET` of their vectors when those are read </em>
+
+        Args:
+            user_ids (list): user ids, empty ids are skipped
+
+        Returns:
+            (list): user level features of every user in the order of `user_ids`, empty dicts for unknown users
+        """
+        users_data = [{} for _ in user_ids]
+        known = [i for i, user_id in enumerate(user_ids) if user_id]
+        if not known:
+            return users_data
+        if self.encoding != "hash":
+            values, missing = await self.fetch_vectors(self.user_fs_raw, self.user_codec, [user_ids[i] for i in known])
+            for i, row in zip(known, values.tolist()):
+                # NaN is a missing field, like a field absent from the hash
+                users_data[i] = {column: value for column, value in zip(self.user_columns, row) if not math.isnan(value)}
+            known = [known[i] for i in missing] if self.encoding == "dual" else []
+            if not known:
+                return users_data
+
+        async def read():
+            async with self.user_fs.pipeline(transaction=False) as user_pipe:
+                for i in known:
+                    user_pipe.hgetall(KEY_PREFIX + "_user:" + user_ids[i])
+                return await user_pipe.execute()
+        for i, user_data in zip(known, await self.read(read)):
+            users_data[i] = user_data
+        return users_data
+
+    def build_feature_batch(self, candidate_list, asset_values, user_data):
+        """ ** Description: ** <em> This function assembles the model input straight into a preallocated float32 matrix in \
+        `prediction_features` (or `cold_start_features` when the user has no features) column order. User features are \
+        written once per column and broadcast over the candidates, candidates with missing asset features are dropped </em>
+
+        Args:
+            candidate_list (list): lomotif ids, in the row order of `asset_values`
+            asset_values (np.ndarray): asset level features returned by `get_asset_features_from_fs`
+            user_data (dict): user level features returned by `get_user_features_from_fs`
+
+        Returns:
+            (FeatureBatch): model matrix with the lomotif id of every row
+        """
+        if asset_values is None:
+            return None
+        user_data = user_data or {}
+        if all(column in user_data for column in self.user_columns):
+            columns = self.prediction_columns
+        else:
+            columns = self.cold_start_columns
+        keep = ~np.isnan(asset_values).any(axis=1)
+        n_rows = int(keep.sum())
+        features = np.empty((n_rows, len(columns)), dtype=np.float32)
+        asset_index = {column: i for i, column in enumerate(self.asset_columns)}
+        for j, column in enumerate(columns):
+            if column in asset_index:
+                features[:, j] = asset_values[keep, asset_index[column]]
             else:
-                logger.info("Retrieving user feature from feature store")
-                user_data = [user_data] * len(self.model_df)
-                user_df = pd.DataFrame.from_records(user_data)
-                model_data = pd.concat([self.model_df, user_df], axis = 1)
-                return model_data
-        except:
-            logger.info(f"Got the following exception: {traceback.format_exc()}")
+                features[:, j] = float(user_data[column])
+        ids = np.asarray(candidate_list, dtype=object)[keep]
+        return FeatureBatch(ids, features, columns)
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    def __init__(self, stage, timeout) -> None:
+        """
+        ** Description: ** <em> Raised when a stage did not finish within its budget, see `Deadline.run` </em>
+
+        Args:
+            stage (str): name of the stage
+            timeout (float): seconds the stage was given
+        """
+        super().__init__(f"{stage} did not finish within {timeout * 1000.0:.0f}ms")
+        self.stage = stage
+        self.timeout = timeout
+
+
+class Deadline:
+    def __init__(self, request_ms=None, stage_ms=None) -> None:
+        """
+        ** Description: ** <em> Latency budget of one request. Every stage run through `run` is cut off after its own
+        budget or after what is left of the request budget, whichever comes first, so a slow dependency costs a stage
+        its result instead of the request its latency target. Stages without a budget only get the request one </em>
+
+        Args:
+            request_ms (float): budget of the whole request in milliseconds, None for no limit
+            stage_ms (dict): budget in milliseconds per stage name
+        """
+        self.expires_at = None if request_ms is None else time.monotonic() + request_ms / 1000.0
+        self.stage_ms = stage_ms or {}
+
+    def remaining(self):
+        """
+        ** Description: ** <em> Seconds left of the request budget </em>
+
+        Returns:
+            (float): seconds left, never negative, inf without a request budget
+        """
+        if self.expires_at is None:
+            return float("inf")
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def timeout(self, stage):
+        """
+        ** Description: ** <em> Seconds a stage may take when it starts now </em>
+
+        Args:
+            stage (str): name of the stage
+
+        Returns:
+            (float): the smaller of the stage budget and the rest of the request budget, inf when neither is set
+        """
+        stage_ms = self.stage_ms.get(stage)
+        return min(self.remaining(), float("inf") if stage_ms is None else stage_ms / 1000.0)
+
+    async def run(self, stage, awaitable):
+        """
+        ** Description: ** <em> It awaits the stage within its budget. A stage that runs out of time is cancelled </em>
+
+        Args:
+            stage (str): name of the stage, a key of `stage_ms`
+            awaitable (awaitable): the work of the stage
+
+        Returns:
+            the result of the stage
+
+        Raises:
+            DeadlineExceeded: when the stage did not finish in time
+        """
+        timeout = self.timeout(stage)
+        if timeout == float("inf"):
+            return await awaitable
+        if timeout <= 0:
+            # the coroutine was never started, closing it avoids the "never awaited" warning
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise DeadlineExceeded(stage, 0.0)
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError as e:
+            if isinstance(e, DeadlineExceeded):
+                raise
+            raise DeadlineExceeded(stage, timeout) from None
+
+
+async def hedged(call, hedge_after, stats=None):
+    """
+    ** Description: ** <em> It runs a read and, when it has not answered after `hedge_after` seconds, sends the same
+    read again and returns whichever answers first. The other one is cancelled. A read that fails before the hedge is
+    sent is not retried, hedging is against slow replies, not errors. Only use it for idempotent reads </em>
+
+    Args:
+        call (coroutine function): called without arguments, once or twice
+        hedge_after (float): seconds to wait for the first read before sending the second one
+        stats (dict): optional counters, `hedged` and `hedge_wins` are incremented
+
+    Returns:
+        the result of the first read that succeeded
+    """
+    first = asyncio.ensure_future(call())
+    tasks = [first]
+    try:
+        try:
+            # shielded, running out of patience must not cancel the first read
+            return await asyncio.wait_for(asyncio.shield(first), hedge_after)
+        except asyncio.TimeoutError:
+            pass
+        second = asyncio.ensure_future(call())
+        tasks.append(second)
+        if stats is not None:
+            stats["hedged"] += 1
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second and stats is not None:
+                        stats["hedge_wins"] += 1
+                    return task.result()
+        # both reads failed
+        return first.result()
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,171 @@
+import bisect
+import threading
+
+# upper bounds in milliseconds, from a cache hit to a request that waited on a slow ES query
+LATENCY_BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _labels(labelnames, labelvalues, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()) -> None:
+        """
+        ** Description: ** <em> Monotonic counter, one value per combination of label values </em>
+
+        Args:
+            name (str): metric name
+            help (str): description shown by the metrics endpoint
+            labelnames (tuple): label names, values are passed positionally to `inc`
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def values(self):
+        """
+        ** Description: ** <em> It copies the current value of every combination of label values </em>
+
+        Returns:
+            (dict): label values tuple to value
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        # copied under the lock, `inc` may add label values from the event loop and the ranking threads meanwhile
+        for labelvalues, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def __init__(self, name, help, labelnames=()) -> None:
+        """
+        ** Description: ** <em> Last observed value, one value per combination of label values </em>
+
+        Args:
+            name (str): metric name
+            help (str): description shown by the metrics endpoint
+            labelnames (tuple): label names, values are passed positionally to `set`
+        """
+        super().__init__(name, help, labelnames)
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labelnames=()) -> None:
+        """
+        ** Description: ** <em> Cumulative histogram with fixed buckets. An observation is a bisect and two increments
+        under a lock, cheap enough for every request and safe from the ranking threads </em>
+
+        Args:
+            name (str): metric name
+            help (str): description shown by the metrics endpoint
+            buckets (tuple): sorted upper bounds, +Inf is added
+            labelnames (tuple): label names, values are passed positionally to `observe`
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labelvalues: (list(counts), total) for labelvalues, (counts, total) in self._series.items()}
+        for labelvalues, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, namespace) -> None:
+        """
+        ** Description: ** <em> In-process metrics rendered in the Prometheus text format. Besides counters, gauges and
+        histograms, the `stats` dicts the caches and the batcher already keep can be registered and are read at scrape
+        time, so the request path does not pay for them twice </em>
+
+        Args:
+            namespace (str): prefix of every metric name
+        """
+        self.namespace = namespace
+        self._metrics = []
+        self._stats = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(f"{self.namespace}_{name}", help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(f"{self.namespace}_{name}", help, labelnames))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS_MS, labelnames=()):
+        return self._register(Histogram(f"{self.namespace}_{name}", help, buckets, labelnames))
+
+    def register_stats(self, component, stats):
+        """
+        ** Description: ** <em> It exposes the numeric entries of a component's stats dict, one series per key </em>
+
+        Args:
+            component (str): label value identifying the component, e.g. asset_feature_cache
+            stats (callable): returns the current stats dict
+        """
+        self._stats.append((component, stats))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        ** Description: ** <em> It renders every metric in the Prometheus text exposition format </em>
+
+        Returns:
+            (str): exposition text
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        if self._stats:
+            name = f"{self.namespace}_component_stat"
+            lines += [f"# HELP {name} counters and sizes kept by the caches and the batcher", f"# TYPE {name} untyped"]
+            for component, stats in self._stats:
+                for key, value in stats().items():
+                    if isinstance(value, (int, float)):
+                        lines.append(f'{name}{{component="{component}",stat="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import time
+import traceback
+from collections import OrderedDict
+
+from logzero import logger
+
+from serving.deadline import DeadlineExceeded
+
+
+class ResponseCache:
+    def __init__(self, ttl_seconds, max_items, shared=None, key_prefix="recommendations_response:") -> None:
+        """
+        ** Description: ** <em> Short lived cache of API responses. Responses are kept in a bounded in-process LRU and,
+        when a redis client is given, in a shared tier every worker reads from. Identical requests arriving while a
+        response is being computed wait for that computation instead of running the pipeline again. Shared tier calls
+        run within the request's deadline, one that is slow or fails is skipped like a miss </em>
+
+        Args:
+            ttl_seconds (float): how long a response is served from the cache
+            max_items (int): maximum number of responses held in process, least recently used are evicted first
+            shared (redis.asyncio.Redis): optional client of the shared tier
+            key_prefix (str): prefix of the shared tier keys
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self.shared = shared
+        self.key_prefix = key_prefix
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "shared_errors": 0,
+                      "shared_timeouts": 0, "not_cached": 0}
+
+    async def get_or_compute(self, key, compute, deadline=None):
+        """
+        ** Description: ** <em> It returns the cached response of the key, otherwise computes it once for all concurrent
+        callers. Responses computed as not cacheable (fallbacks, empty responses) are returned to the callers waiting
+        on them but not cached, so the next request computes them again </em>
+
+        Args:
+            key (str): cache key of the request
+            compute (coroutine function): called without arguments, returns the response and whether it may be cached
+            deadline (Deadline): budget of the request, shared tier calls are cut off after its `response_cache` stage
+
+        Returns:
+            the cached or computed response
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            del self._entries[key]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(self._fill(key, compute, deadline))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield so that a cancelled caller does not cancel the computation other callers are waiting on
+        return await asyncio.shield(task)
+
+    async def _fill(self, key, compute, deadline):
+        if self.shared is not None:
+            cached = await self._shared_call("read", self.shared.get(self.key_prefix + key), deadline)
+            if cached is not None:
+                self.stats["shared_hits"] += 1
+                value = json.loads(cached)
+                self._put(key, value)
+                return value
+        self.stats["misses"] += 1
+        value, cacheable = await compute()
+        if not cacheable:
+            self.stats["not_cached"] += 1
+            return value
+        self._put(key, value)
+        if self.shared is not None:
+            await self._shared_call("write", self.shared.set(self.key_prefix + key, json.dumps(value),
+                                                             px=int(self.ttl_seconds * 1000)), deadline)
+        return value
+
+    async def _shared_call(self, action, call, deadline):
+        try:
+            if deadline is None:
+                return await call
+            return await deadline.run("response_cache", call)
+        except DeadlineExceeded as e:
+            self.stats["shared_timeouts"] += 1
+            logger.debug(f"Gave up on the shared response cache {action}: {e}")
+        except Exception:
+            self.stats["shared_errors"] += 1
+            logger.info(f"Could not {action} shared response cache: {traceback.format_exc()}")
+        return None
+
+    def _put(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
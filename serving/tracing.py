@@ -0,0 +1,123 @@
+import json
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from logzero import logger
+
+# trace of the request being served, tasks started by the request inherit it
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name, sampled, debug, attributes) -> None:
+        """
+        ** Description: ** <em> Spans and attributes of one request, only filled when the request is sampled </em>
+        """
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.sampled = sampled
+        self.debug = debug
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+class Tracer:
+    def __init__(self, stage_histogram, trace_sample_rate, debug_sample_rate) -> None:
+        """
+        ** Description: ** <em> Per request stage timing. Every span is observed by the stage latency histogram. A
+        `trace_sample_rate` share of requests also keeps its spans and logs them as one JSON line when it finishes, and a
+        `debug_sample_rate` share logs the expensive debug dumps (candidates, model input, recommendations). Unsampled
+        requests only pay for the histogram observations </em>
+
+        Args:
+            stage_histogram (serving.metrics.Histogram): latency histogram labelled by stage
+            trace_sample_rate (float): share of requests whose spans are logged
+            debug_sample_rate (float): share of requests whose debug dumps are logged
+        """
+        self.stage_histogram = stage_histogram
+        self.trace_sample_rate = trace_sample_rate
+        self.debug_sample_rate = debug_sample_rate
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        """
+        ** Description: ** <em> It opens the trace of a request, the whole block is recorded as the `name` stage </em>
+
+        Args:
+            name (str): name of the request type, e.g. get_recommendations
+            attributes (dict): logged with a sampled trace
+
+        Returns:
+            (Trace): the trace, also reachable from spans of the request
+        """
+        debug = random.random() < self.debug_sample_rate
+        trace = Trace(name, debug or random.random() < self.trace_sample_rate, debug, attributes)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            duration_ms = (time.perf_counter() - trace.start) * 1000.0
+            self.stage_histogram.observe(duration_ms, name)
+            if trace.sampled:
+                logger.info(json.dumps({"trace_id": trace.trace_id, "name": name, "duration_ms": round(duration_ms, 3),
+                                        **trace.attributes, "spans": trace.spans}, default=str))
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """
+        ** Description: ** <em> It times a stage of the current request </em>
+
+        Args:
+            stage (str): stage name, label of the latency histogram
+            attributes (dict): logged with the span when the request is sampled
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.stage_histogram.observe((end - start) * 1000.0, stage)
+            trace = _current_trace.get()
+            if trace is not None and trace.sampled:
+                trace.spans.append({"stage": stage, "start_ms": round((start - trace.start) * 1000.0, 3),
+                                    "duration_ms": round((end - start) * 1000.0, 3), **attributes})
+
+    async def timed(self, stage, awaitable):
+        """
+        ** Description: ** <em> It awaits `awaitable` inside a span, for stages that run concurrently in a gather </em>
+
+        Args:
+            stage (str): stage name
+            awaitable (coroutine): the stage
+
+        Returns:
+            (any): result of the stage
+        """
+        with self.span(stage):
+            return await awaitable
+
+    def annotate(self, **attributes):
+        """
+        ** Description: ** <em> It adds attributes to the current trace if it is sampled </em>
+        """
+        trace = _current_trace.get()
+        if trace is not None and trace.sampled:
+            trace.attributes.update(attributes)
+
+    def debug(self, label, dump):
+        """
+        ** Description: ** <em> It logs a debug dump for requests sampled for debugging. `dump` is only called for those,
+        so formatting large payloads costs nothing on the other requests </em>
+
+        Args:
+            label (str): what is dumped
+            dump (callable): returns the value to log
+        """
+        trace = _current_trace.get()
+        if trace is not None and trace.debug:
+            logger.info(f"[trace {trace.trace_id}] {label}: {dump()}")
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# modules import each other from the repository root, like the service does, and the benchmark scripts import their
+# fakes from benchmarks/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(1, str(Path(__file__).resolve().parent.parent / "benchmarks"))
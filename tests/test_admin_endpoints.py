@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import fakes
+
+fakes.setup_service_env()
+
+import internal_reco_api as api
+from ranking.src.model_reloader import ModelReloader
+
+
+@pytest.fixture
+def client():
+    # startup is not run outside of a `with` block, the endpoints below do not need the service to be ready
+    return TestClient(api.app)
+
+
+def test_admin_endpoints_are_refused_without_a_configured_token(client, monkeypatch):
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    assert client.get("/admin/models").status_code == 403
+    assert client.post("/admin/models/reload", json={}).status_code == 403
+    assert client.post("/admin/models/shadow", json={}, headers={"x-admin-token": ""}).status_code == 403
+
+
+def test_admin_token_must_match(client, monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    assert client.get("/admin/models").status_code == 403
+    assert client.get("/admin/models", headers={"x-admin-token": "wrong"}).status_code == 403
+    assert client.get("/admin/models", headers={"x-admin-token": "secret"}).status_code == 200
+
+
+def test_reload_lock_is_created_in_the_running_loop():
+    models = SimpleNamespace(names={"model": "a", "cold_start_model": "b"}, loaded_at=0.0)
+    reco = SimpleNamespace(models=models, shadow_models=None, load_model_set=lambda *names: models,
+                           warmup=lambda rows, models: None)
+    # created outside of any event loop, like the service does when it is imported
+    reloader = ModelReloader(reco, None, warmup_rows=1, check_seconds=60)
+
+    async def contend():
+        return await asyncio.gather(reloader.reload(), reloader.load_shadow("a", "b"), reloader.reload())
+    assert len(asyncio.run(contend())) == 3
+    assert reloader.stats == {"reloads": 2, "shadow_loads": 1, "load_errors": 0}
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import fakes
+
+fakes.setup_service_env()
+
+import internal_reco_api as api
+
+
+class FixedRankings:
+    # only US is ranked, like a country refreshed in the background
+    def recommend(self, user_country, k):
+        return [f"{user_country}_{i}" for i in range(k)] if user_country == "US" else None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    groups = []
+
+    async def recommend_country_group(user_country, records):
+        groups.append((user_country, [record["user_id"] for record in records]))
+        return [{"user_id": record["user_id"], "user_country": user_country, "recommendations": ["ranked"]}
+                for record in records]
+
+    monkeypatch.setattr(api, "service_ready", True)
+    monkeypatch.setattr(api, "cold_start_rankings", FixedRankings())
+    monkeypatch.setattr(api, "recommend_country_group", recommend_country_group)
+    # startup is not run outside of a `with` block, the dependencies are replaced above
+    return TestClient(api.app), groups
+
+
+def outcomes():
+    return {labels[1]: value for labels, value in api.requests_total.values().items()
+            if labels[0] == "get_recommendations_batch"}
+
+
+def test_batch_over_the_record_limit_is_refused(client, monkeypatch):
+    client, groups = client
+    monkeypatch.setitem(api.config["batch_recommendations"], "max_records", 2)
+    before = outcomes().get("too_large", 0)
+    records = [{"user_id": str(i), "user_country": "BR"} for i in range(3)]
+    assert client.post("/get_recommendations_batch/", json={"records": records}).status_code == 413
+    assert groups == [] and outcomes()["too_large"] == before + 1
+
+
+def test_anonymous_records_are_served_from_the_cold_start_rankings(client):
+    client, groups = client
+    before = outcomes().get("ok", 0)
+    records = [{"user_id": "", "user_country": "US", "k": 2}, {"user_id": "", "user_country": "FR", "k": 2},
+               {"user_id": "1", "user_country": "US", "k": 2}]
+    response = client.post("/get_recommendations_batch/", json={"records": records})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert {"user_id": "", "user_country": "US", "recommendations": ["US_0", "US_1"]} in lines
+    assert len(lines) == 3
+    # countries that are not ranked yet and users with an id still go through the ranking pipeline
+    assert sorted(groups) == [("FR", [""]), ("US", ["1"])]
+    assert outcomes()["ok"] == before + 1
@@ -0,0 +1,38 @@
+import asyncio
+
+import numpy as np
+
+from retrieval.src.blacklist import BlacklistFilter, ENTRY_OVERHEAD_BYTES, hash_ids
+
+
+def test_users_without_blacklist_are_evicted():
+    async def loader(user_id):
+        return []
+
+    blacklist_filter = BlacklistFilter(loader, max_bytes=1024, ttl_seconds=60)
+
+    async def run():
+        for i in range(1000):
+            await blacklist_filter.get(f"user_{i}")
+    asyncio.run(run())
+    assert len(blacklist_filter._entries) == 1024 // ENTRY_OVERHEAD_BYTES
+    assert blacklist_filter.nbytes <= 1024
+    assert blacklist_filter.stats["evictions"] == 1000 - len(blacklist_filter._entries)
+
+
+def test_concurrent_loads_of_a_user_share_one_lookup():
+    calls = []
+
+    async def loader(user_id):
+        calls.append(user_id)
+        await asyncio.sleep(0.01)
+        return ["a", "b"]
+
+    blacklist_filter = BlacklistFilter(loader, max_bytes=1 << 20, ttl_seconds=60)
+
+    async def run():
+        return await asyncio.gather(*[blacklist_filter.get("user") for _ in range(10)])
+    blacklists = asyncio.run(run())
+    assert calls == ["user"]
+    assert all(np.array_equal(blacklist, np.unique(hash_ids(["a", "b"]))) for blacklist in blacklists)
+    assert blacklist_filter.stats["coalesced"] == 9
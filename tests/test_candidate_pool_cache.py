@@ -0,0 +1,26 @@
+import asyncio
+
+from retrieval.src.candidate_pool_cache import CandidatePool, CandidatePoolCache
+from retrieval.src.blacklist import EMPTY_BLACKLIST
+
+
+def test_least_recently_used_countries_are_evicted():
+    loads = []
+
+    async def loader(country):
+        loads.append(country)
+        return CandidatePool([], 0, EMPTY_BLACKLIST, {})
+
+    cache = CandidatePoolCache(loader, ttl_seconds=60, max_stale_seconds=300, max_entries=3)
+
+    async def run():
+        for country in ["US", "BR", "FR"]:
+            await cache.get(country)
+        await cache.get("US")
+        for i in range(100):
+            await cache.get(f"junk_{i}")
+            await cache.get("US")
+    asyncio.run(run())
+    assert len(cache._entries) == 3
+    assert cache.peek("US") is not None and cache.peek("BR") is None
+    assert cache.stats["evictions"] == 100 and loads.count("US") == 1
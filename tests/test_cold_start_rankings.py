@@ -0,0 +1,41 @@
+import numpy as np
+
+from ranking.src.cold_start_rankings import ColdStartRankings, CountryRanking
+
+
+def rankings_with(country, ids):
+    rankings = ColdStartRankings(None, None, None, None, refresh_seconds=60, sample_from_top=50,
+                                 idle_seconds=3600)
+    rankings._rankings[country] = CountryRanking(np.array(ids, dtype=object),
+                                                 np.arange(len(ids), 0, -1, dtype=np.float32), 0.0)
+    return rankings
+
+
+def test_empty_country_ranking_recommends_nothing():
+    rankings = rankings_with("XX", [])
+    assert rankings.recommend("XX", 10) == []
+    assert rankings.stats["served"] == 1
+
+
+def test_recommendations_come_from_the_top_in_score_order():
+    ids = [f"asset_{i}" for i in range(100)]
+    rankings = rankings_with("US", ids)
+    recommendations = rankings.recommend("US", 10)
+    assert len(recommendations) == 10
+    positions = [ids.index(asset) for asset in recommendations]
+    assert positions == sorted(positions) and max(positions) < 50
+
+
+def test_small_ranking_returns_every_asset():
+    rankings = rankings_with("FR", ["a", "b", "c"])
+    assert rankings.recommend("FR", 10) == ["a", "b", "c"]
+
+
+def test_countries_not_requested_are_dropped():
+    rankings = rankings_with("US", ["a", "b"])
+    rankings._rankings["XX"] = rankings._rankings["US"]
+    rankings.recommend("US", 1)
+    rankings._requested_at["XX"] = rankings._requested_at["US"] - 2 * rankings.idle_seconds
+    rankings.drop_idle()
+    assert list(rankings._rankings) == ["US"]
+    assert rankings.stats["dropped"] == 1
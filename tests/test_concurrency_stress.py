@@ -0,0 +1,17 @@
+import asyncio
+import argparse
+
+import fakes
+
+fakes.setup_service_env()
+
+import concurrency_stress
+
+
+def test_concurrent_requests_are_isolated(capsys):
+    args = argparse.Namespace(requests=300, concurrency=100, users=200, countries=["US", "BR", "FR"],
+                              assets_per_country=300, latency_ms=1.0, threads=8, seed=0)
+    status = asyncio.run(concurrency_stress.main(args))
+    output = capsys.readouterr().out
+    assert status == 0, output
+    assert "300 requests, 0 errors" in output
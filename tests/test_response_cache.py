@@ -0,0 +1,67 @@
+import time
+import asyncio
+
+from serving.deadline import Deadline
+from serving.response_cache import ResponseCache
+
+
+def compute_returning(value, cacheable):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return value, cacheable
+    return compute, calls
+
+
+def test_cacheable_response_is_computed_once():
+    cache = ResponseCache(ttl_seconds=60, max_items=10)
+    compute, calls = compute_returning(["a", "b"], True)
+
+    async def run():
+        return [await cache.get_or_compute("key", compute) for _ in range(3)]
+    assert asyncio.run(run()) == [["a", "b"]] * 3
+    assert len(calls) == 1
+    assert cache.stats["hits"] == 2
+
+
+def test_not_cacheable_response_is_shared_by_waiters_but_not_kept():
+    cache = ResponseCache(ttl_seconds=60, max_items=10)
+    compute, calls = compute_returning(["popular"], False)
+
+    async def run():
+        concurrent = await asyncio.gather(*[cache.get_or_compute("key", compute) for _ in range(3)])
+        return concurrent, await cache.get_or_compute("key", compute)
+    concurrent, later = asyncio.run(run())
+    assert concurrent == [["popular"]] * 3 and later == ["popular"]
+    assert len(calls) == 2
+    assert cache.stats["coalesced"] == 2 and cache.stats["not_cached"] == 2
+
+
+class SlowRedis:
+    def __init__(self, delay) -> None:
+        self.delay = delay
+        self.data = {}
+
+    async def get(self, key):
+        await asyncio.sleep(self.delay)
+        return self.data.get(key)
+
+    async def set(self, key, value, px=None):
+        await asyncio.sleep(self.delay)
+        self.data[key] = value
+
+
+def test_slow_shared_tier_is_skipped_within_the_deadline():
+    cache = ResponseCache(ttl_seconds=60, max_items=10, shared=SlowRedis(delay=1.0))
+    compute, calls = compute_returning(["a"], True)
+
+    async def run():
+        start = time.monotonic()
+        value = await cache.get_or_compute("key", compute, Deadline(250, {"response_cache": 20}))
+        return value, time.monotonic() - start
+    value, seconds = asyncio.run(run())
+    assert value == ["a"] and len(calls) == 1
+    assert seconds < 0.2
+    assert cache.stats["shared_timeouts"] == 2 and cache.stats["shared_errors"] == 0
@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xgboost as xgb
+
+from ranking.inference import load_booster
+from ranking.src.tree_predictor import TreePredictor
+
+MODEL_DIR = Path(__file__).resolve().parent.parent / "ranking" / "models"
+SHIPPED_MODELS = sorted(path for path in MODEL_DIR.iterdir() if path.suffix in (".ubj", ".json", ".model"))
+
+
+def features_with_missing_values(n_rows, n_features, seed=0):
+    # the shape of the cold start input: probability like features, a view count last, some values missing
+    rng = np.random.default_rng(seed)
+    features = rng.random((n_rows, n_features), dtype=np.float32)
+    features[:, -1] = rng.integers(0, 5000, n_rows)
+    features[rng.random((n_rows, n_features)) < 0.1] = np.nan
+    features[0] = np.nan
+    return features
+
+
+@pytest.fixture(scope="module", params=SHIPPED_MODELS, ids=lambda path: path.name)
+def shipped(request):
+    booster = load_booster(request.param)
+    booster.set_param({"nthread": 1})
+    predictor = TreePredictor.from_booster(booster)
+    features = features_with_missing_values(2000, predictor.num_feature)
+    dmatrix = xgb.DMatrix(features, feature_names=booster.feature_names)
+    return predictor, features, booster.predict(dmatrix, output_margin=True), booster.predict(dmatrix)
+
+
+def test_compiled_predictions_are_identical_to_xgboost(shipped):
+    predictor, features, margins, predictions = shipped
+    if not predictor.compiled:
+        pytest.skip("numba is not installed")
+    np.testing.assert_array_equal(predictor.predict_margin(features), margins)
+    np.testing.assert_array_equal(predictor.inplace_predict(features), predictions)
+
+
+def test_numpy_fallback_matches_xgboost(shipped, monkeypatch):
+    predictor, features, margins, predictions = shipped
+    monkeypatch.setattr(predictor, "compiled", False)
+    np.testing.assert_array_equal(predictor.predict_margin(features), margins)
+    # the logistic function of numpy may round one float32 ulp away from XGBoost's expf on rare rows
+    np.testing.assert_array_max_ulp(predictor.inplace_predict(features), predictions, maxulp=1)
+
+
+def train(params, labels, n_rows=200):
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(n_rows, 4)).astype(np.float32)
+    return xgb.train(params, xgb.DMatrix(features, label=labels(rng, n_rows)), num_boost_round=5)
+
+
+@pytest.mark.parametrize("params, n_targets, unsupported", [
+    ({"objective": "binary:hinge"}, 1, "binary:hinge"),
+    ({"objective": "binary:logistic", "booster": "gblinear"}, 1, "gblinear"),
+    ({"objective": "reg:squarederror", "tree_method": "hist"}, 2, "multi output"),
+])
+def test_unsupported_boosters_are_named(params, n_targets, unsupported):
+    booster = train(params, lambda rng, n: rng.integers(0, 2, (n, n_targets)))
+    with pytest.raises(ValueError, match=unsupported):
+        TreePredictor.from_booster(booster)
@@ -1,6 +1,68 @@
+import os
 import yaml
+from functools import lru_cache
 
 def load_config(file_path):
     with open(file_path, 'r') as f:
         cfg = yaml.safe_load(f)
     return cfg
+
+@lru_cache(maxsize=None)
+def get_config(file_path="config.yml"):
+    """
+    ** Description: ** <em> It parses the config file on first use and returns the same dict to every caller afterwards,
+    so the service reads config.yml once however many modules need it </em>
+
+    Args:
+        file_path (str): The path to the YAML file
+    Returns:
+        (dict): A dictionary
+    """
+    return load_config(file_path)
+
+def available_cores():
+    """
+    ** Description: ** <em> It counts the cores this process may run on, the CPU affinity mask where the platform has
+    one (containers and `taskset` restrict it), all cores otherwise </em>
+
+    Returns:
+        (int): number of usable cores
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def worker_count(config):
+    """
+    ** Description: ** <em> It returns the number of gunicorn worker processes: `WEB_CONCURRENCY` when set, otherwise
+    `serving.workers`, 0 meaning one per available core </em>
+
+    Args:
+        config (dict): parsed config.yml
+    Returns:
+        (int): number of worker processes
+    """
+    workers = int(os.environ.get("WEB_CONCURRENCY") or config["serving"]["workers"])
+    return workers if workers > 0 else available_cores()
+
+def ranking_threads(config):
+    """
+    ** Description: ** <em> It resolves the ranking threads of one serving process: `ranking_executor_workers`
+    concurrent predictions of `ranking_nthread` XGBoost threads each. `auto` values share the available cores evenly
+    between the `SERVING_WORKERS` processes (set by gunicorn_conf.py, 1 when uvicorn runs alone), so workers x executor
+    threads x XGBoost threads matches the core count </em>
+
+    Args:
+        config (dict): parsed config.yml
+    Returns:
+        (tuple): ranking executor threads and XGBoost threads per predict call
+    """
+    cores = max(1, available_cores() // int(os.environ.get("SERVING_WORKERS", 1)))
+    executor_workers = config["ranking_executor_workers"]
+    if executor_workers == "auto":
+        executor_workers = cores
+    nthread = config["ranking_nthread"]
+    if nthread == "auto":
+        nthread = max(1, cores // executor_workers)
+    return executor_workers, nthread